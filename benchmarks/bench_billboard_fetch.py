@@ -0,0 +1,197 @@
+# bench_billboard_fetch.py
+"""Checks and measures the download of the billboard against a local server that serves the pages in fixtures and
+takes some time to answer each of them: the pages are downloaded at the same time, a page that fails with a 5xx
+error is asked for again, a snapshot whose pages haven't changed is reused after a 304 answer, a snapshot of other
+pages is not used, and PageNotFound is raised (or the snapshot used) when the server never answers well."""
+from __future__ import annotations
+
+import argparse
+import datetime as dt
+import glob
+import hashlib
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # coord_cines.json is read from here
+
+import billboard  # noqa: E402
+from billboard import Billboard, PageNotFound, fetch_page, fetch_pages  # noqa: E402
+
+FIXTURES = os.path.join('benchmarks', 'fixtures')
+
+
+class FixtureServer(http.server.ThreadingHTTPServer):
+    """Local server that answers /?page=N with the page N of the fixtures after latency seconds, with an ETag, and
+    with 304 if it is asked for the same ETag. The next failures requests are answered with a 500 error. It counts
+    the requests and answers of each kind, and the most requests it has been answering at the same time."""
+
+    def __init__(self, pages: list[bytes], latency: float) -> None:
+        self.pages = pages
+        self.etags = [f'"{hashlib.sha256(page).hexdigest()[:16]}"' for page in pages]
+        self.latency = latency
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.counts = {'peticions': 0, '200': 0, '304': 0, '404': 0, '500': 0}
+        self.active = 0
+        self.max_active = 0
+        super().__init__(('127.0.0.1', 0), FixtureHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}/?page='
+
+    def reset(self) -> None:
+        """Sets the counters back to zero."""
+        with self.lock:
+            self.counts = dict.fromkeys(self.counts, 0)
+            self.max_active = 0
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # so that the session can keep the connections alive
+
+    def do_GET(self) -> None:
+        server = self.server
+        with server.lock:
+            server.counts['peticions'] += 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            fail = server.failures > 0
+            server.failures -= fail
+        try:
+            time.sleep(server.latency)
+            page = int(self.path.rpartition('=')[2]) if self.path.startswith('/?page=') else 0
+            if fail:
+                self.answer(500)
+            elif not 1 <= page <= len(server.pages):
+                self.answer(404)
+            elif self.headers.get('If-None-Match') == server.etags[page - 1]:
+                self.answer(304, etag=server.etags[page - 1])
+            else:
+                self.answer(200, server.pages[page - 1], server.etags[page - 1])
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def answer(self, status: int, content: bytes = b'', etag: str | None = None) -> None:
+        with self.server.lock:
+            self.server.counts[str(status)] += 1
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def contents(b: Billboard) -> tuple[list, list]:
+    """Returns the cinemas and films of a billboard, to compare two of them."""
+    return [(c.name, c.address) for c in b.cinemas], [f.title for f in b.films]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--latency', type=float, default=0.2, help="time (s) the server takes to answer each page")
+    args = parser.parse_args()
+
+    pages = []
+    for filename in sorted(glob.glob(os.path.join(FIXTURES, 'cartellera_*.html'))):
+        with open(filename, 'rb') as f:
+            pages.append(f.read())
+    num_pages = len(pages)
+    server = FixtureServer(pages, args.latency)
+    billboard.BACKOFF = args.latency / 4  # so that the retries don't take most of the time
+    print(f"{num_pages} pàgines, {args.latency * 1000:.0f} ms per resposta")
+
+    # one page after the other, like before, and all of them at the same time
+    start = time.perf_counter()
+    with billboard.requests.Session() as session:
+        for i in range(1, num_pages + 1):
+            fetch_page(session, server.url + str(i))
+    seconds = time.perf_counter() - start
+    print(f"{'una per una':>20}: {seconds * 1000:7.1f} ms")
+
+    server.reset()
+    start = time.perf_counter()
+    responses = fetch_pages(server.url, num_pages)
+    seconds = time.perf_counter() - start
+    print(f"{'alhora':>20}: {seconds * 1000:7.1f} ms, {server.max_active} peticions alhora")
+    assert [response.content for response in responses] == pages, "les pàgines no arriben en ordre"
+    assert server.max_active == num_pages, "les pàgines no s'han demanat alhora"
+
+    # the first answers fail with a 500 error and the pages are asked for again
+    server.reset()
+    server.failures = 2
+    start = time.perf_counter()
+    responses = fetch_pages(server.url, num_pages)
+    seconds = time.perf_counter() - start
+    print(f"{'amb 2 errors 500':>20}: {seconds * 1000:7.1f} ms, {server.counts['peticions']} peticions")
+    assert [response.content for response in responses] == pages
+    assert server.counts['500'] == 2 and server.counts['200'] == num_pages
+
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot = os.path.join(directory, 'cartellera.json')
+
+        # the snapshot is older than the ttl, but the pages haven't changed: they are answered with 304
+        server.reset()
+        start = time.perf_counter()
+        downloaded = Billboard(num_pages, server.url, snapshot, dt.timedelta(0))
+        seconds = time.perf_counter() - start
+        print(f"{'cartellera nova':>20}: {seconds * 1000:7.1f} ms, {server.counts['200']} respostes 200")
+        server.reset()
+        start = time.perf_counter()
+        reused = Billboard(num_pages, server.url, snapshot, dt.timedelta(0))
+        seconds = time.perf_counter() - start
+        print(f"{'sense canvis':>20}: {seconds * 1000:7.1f} ms, {server.counts['304']} respostes 304")
+        assert server.counts['304'] == num_pages and server.counts['200'] == 0
+        assert contents(reused) == contents(downloaded), "la cartellera guardada no és la descarregada"
+
+        # a snapshot of other pages is not used, even if it is still new
+        server.reset()
+        Billboard(num_pages, server.url, snapshot, dt.timedelta(hours=1))
+        assert server.counts['peticions'] == 0, "no s'ha fet servir la cartellera guardada"
+        Billboard(1, server.url, snapshot, dt.timedelta(hours=1))
+        assert server.counts['200'] == 1, "s'ha fet servir una cartellera d'un altre nombre de pàgines"
+        Billboard(num_pages, server.url, snapshot, dt.timedelta(hours=1))
+        assert server.counts['200'] == 1 + num_pages, "s'ha fet servir una cartellera d'un altre nombre de pàgines"
+        print(f"{'altres pàgines':>20}: {server.counts['200']} respostes 200")
+        Billboard(num_pages, server.url, snapshot, dt.timedelta(0))  # back to the pages the next checks expect
+
+        # the server never answers well: the snapshot is used if there is one, and PageNotFound is raised if not
+        server.reset()
+        server.failures = 10**6
+        start = time.perf_counter()
+        fallback = Billboard(num_pages, server.url, snapshot, dt.timedelta(0))
+        seconds = time.perf_counter() - start
+        print(f"{'sense servidor':>20}: {seconds * 1000:7.1f} ms, {server.counts['peticions']} peticions")
+        assert server.counts['peticions'] == num_pages * billboard.MAX_ATTEMPTS
+        assert contents(fallback) == contents(downloaded)
+        try:
+            Billboard(num_pages, server.url, None)
+        except PageNotFound:
+            pass
+        else:
+            raise AssertionError("no s'ha llençat PageNotFound")
+
+    server.failures = 0
+    server.reset()
+    try:
+        fetch_pages(server.url, num_pages + 1)  # the last page doesn't exist
+    except PageNotFound as e:
+        print(f"{'pàgina inexistent':>20}: PageNotFound({e}), {server.counts['404']} respostes 404")
+    else:
+        raise AssertionError("no s'ha llençat PageNotFound")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# bench_billboard_parse.py
+"""Compares the time and peak memory needed to parse the billboard pages as a single document with the whole tree
+(the way they used to be parsed) and page by page, building only the fragments that are read."""
+from __future__ import annotations
+
+import argparse
+import glob
+import os
+import sys
+import time
+import tracemalloc
+from typing import Callable
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # coord_cines.json is read from here
+
+from billboard import BILLBOARD_URL, NUM_PAGES, Billboard, fetch_pages, parse_page  # noqa: E402
+
+# the pages kept here are synthetic: written with the structure of the sensacine pages and similar sizes, but
+# with made up cinemas and films. --record replaces them with the current real pages.
+FIXTURES = os.path.join('benchmarks', 'fixtures')
+
+
+def parse_whole(pages: list[bytes]) -> Billboard:
+    """Parses all the pages joined in a single document, building the whole tree."""
+    billboard = Billboard.__new__(Billboard)
+    billboard.read_pages([BeautifulSoup(b''.join(pages), 'html.parser')])
+    return billboard
+
+
+def parse_strained(pages: list[bytes]) -> Billboard:
+    """Parses each page separately, building only the fragments that are read."""
+    billboard = Billboard.__new__(Billboard)
+    billboard.read_pages([parse_page(page) for page in pages])
+    return billboard
+
+
+def measure(parse: Callable[[list[bytes]], Billboard], pages: list[bytes], repeat: int) -> tuple[float, float, Billboard]:
+    """Returns the best time (s) and the peak memory (MB) of parsing the pages, and the billboard read."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        billboard = parse(pages)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    parse(pages)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak / 2**20, billboard
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5, help="number of times each parser is timed")
+    parser.add_argument('--record', action='store_true', help="downloads the current pages into the fixtures first")
+    args = parser.parse_args()
+
+    if args.record:
+        for i, response in enumerate(fetch_pages(BILLBOARD_URL, NUM_PAGES), start=1):
+            with open(os.path.join(FIXTURES, f'cartellera_{i}.html'), 'wb') as f:
+                f.write(response.content)
+
+    pages = []
+    for filename in sorted(glob.glob(os.path.join(FIXTURES, 'cartellera_*.html'))):
+        with open(filename, 'rb') as f:
+            pages.append(f.read())
+    print(f"{len(pages)} pàgines, {sum(map(len, pages)) / 2**20:.2f} MB")
+
+    results = {}
+    for name, parse in (('sencer', parse_whole), ('per parts', parse_strained)):
+        seconds, peak, billboard = measure(parse, pages, args.repeat)
+        results[name] = billboard
+        print(f"{name:>10}: {seconds * 1000:7.1f} ms, pic de memòria {peak:6.1f} MB, "
+              f"{len(billboard.cinemas)} cinemes, {len(billboard.films)} pel·lícules, "
+              f"{len(billboard.projections)} projeccions")
+
+    whole, strained = results.values()
+    assert [(c.name, c.address) for c in whole.cinemas] == [(c.name, c.address) for c in strained.cinemas]
+    assert [f.title for f in whole.films] == [f.title for f in strained.films]
+    assert [(p.film.title, p.cinema.name, p.start_time, p.language) for p in whole.projections] == \
+           [(p.film.title, p.cinema.name, p.start_time, p.language) for p in strained.projections]
+
+
+if __name__ == '__main__':
+    main()
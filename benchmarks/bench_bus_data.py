@@ -0,0 +1,85 @@
+# bench_bus_data.py
+"""Compares the time and memory needed to get the stops of all the bus lines from synthetic AMB data: reading
+the indented json file and building every stop (the way it used to be done) and reading the columnar cache."""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from synthetic import synthetic_bus_data
+
+import buses
+from buses import Coord, Parada, get_lines, orig_dest_parades
+
+
+def old_orig_dest_parades(filename: str) -> tuple:
+    """Reads the json file and builds the stops of every line, copying the lists of stops twice."""
+    with open(filename) as f:
+        data = json.load(f)
+    parades_set = set()
+    orig_parades = []
+    dest_parades = []
+    for linia in data['ObtenirDadesAMBResult']['Linies']['Linia']:
+        parades = [Parada(int(elem['CodAMB']), Coord(elem['UTM_Y'], elem['UTM_X']), nom=elem['Nom'], linia=linia['Nom'])
+                   for elem in linia['Parades']['Parada']]
+        parades_set |= set(parades)
+        orig_parades.extend(list(parades)[:-1])
+        dest_parades.extend(list(parades)[1:])
+    return parades_set, orig_parades, dest_parades
+
+
+def measure(mode: str) -> None:
+    """Gets the stops in the given way and prints the time and the peak memory, measured in separate runs."""
+    get = (lambda: old_orig_dest_parades(buses.BUS_DATA_FILE)) if mode == 'json' else \
+        (lambda: orig_dest_parades(get_lines()[0]))
+    start = time.perf_counter()
+    result = get()
+    seconds = time.perf_counter() - start
+    del result
+
+    tracemalloc.start()
+    result = get()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(json.dumps({'mode': mode, 'seconds': seconds, 'peak_mb': peak / 2**20, 'edges': len(result[1])}))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lines', type=int, default=250, help="number of bus lines")
+    parser.add_argument('--stops', type=int, default=60, help="number of stops of each line")
+    parser.add_argument('--measure', choices=('json', 'columnar'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        with open(buses.BUS_DATA_FILE, 'w') as f:
+            json.dump(synthetic_bus_data(args.lines, args.stops), f, indent=4)
+        print(f"{args.lines} línies, {args.stops} parades per línia, json de "
+              f"{os.path.getsize(buses.BUS_DATA_FILE) / 2**20:.1f} MB")
+
+        get_lines()  # creates the columnar cache
+        print(f"cache columnar de {os.path.getsize(buses.BUS_DATA_CACHE_FILE) / 2**20:.1f} MB")
+
+        # each way is measured in a new process, so that nothing is already loaded or cached
+        results = {}
+        for mode in ('json', 'columnar'):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', mode], check=True,
+                                    capture_output=True, text=True, cwd=directory).stdout
+            results[mode] = json.loads(output.splitlines()[-1])
+            print(f"{mode:>9}: {results[mode]['seconds'] * 1000:7.1f} ms, pic de memòria {results[mode]['peak_mb']:6.1f} MB")
+        assert results['json']['edges'] == results['columnar']['edges']
+
+
+if __name__ == '__main__':
+    main()
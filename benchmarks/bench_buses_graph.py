@@ -0,0 +1,84 @@
+# bench_buses_graph.py
+"""Compares, with synthetic bus lines over a synthetic street grid, the time of finding the road paths between
+consecutive stops one pair at a time and with one search per distinct origin, and the time of building the bus
+graph computing the length of each segment one at a time and all of them at once (the old and new ways)."""
+from __future__ import annotations
+
+import argparse
+import time
+from itertools import pairwise
+
+import osmnx as ox
+from synthetic import synthetic_bus_lines, synthetic_road_graph
+
+from buses import (BUS_SPEED, BUS_STOP_TIME, Bus, BusesGraph, Coord, build_buses_graph, get_distance,
+                   road_shortest_paths)
+
+
+def build_one_by_one(road_graph, orig_parades, dest_parades, nearest_node_of, shortests_paths, colors_dict) -> BusesGraph:
+    """Builds the bus graph calling get_distance for each segment."""
+    buses_graph = BusesGraph()
+    for orig_parada, dest_parada, path in zip(orig_parades, dest_parades, shortests_paths):
+        if orig_parada == dest_parada:
+            continue
+        if max(nearest_node_of[orig_parada][1], nearest_node_of[dest_parada][1]) > 200:
+            continue
+        coord_list = [orig_parada.coord] + [Coord(road_graph.nodes[node]['x'], road_graph.nodes[node]['y'])
+                                            for node in path or []] + [dest_parada.coord]
+        dist = sum(get_distance(coord1, coord2) for coord1, coord2 in pairwise(coord_list))
+        buses_graph.add_edge(orig_parada, dest_parada, time=BUS_STOP_TIME + dist/BUS_SPEED,
+                             color=colors_dict[orig_parada.linia], info=Bus(dist, coord_list, linia=orig_parada.linia))
+    return buses_graph
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--grid', type=int, default=60, help="the street graph is a grid of grid x grid nodes")
+    parser.add_argument('--lines', type=int, default=200, help="number of bus lines")
+    parser.add_argument('--stops', type=int, default=40, help="number of stops of each line")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    road_graph = synthetic_road_graph(args.grid, args.seed)
+    parades_set, orig_parades, dest_parades, colors_dict = synthetic_bus_lines(road_graph, args.lines, args.stops, args.seed)
+    parades = list(parades_set)
+    nearest_nodes, nearest_dist = ox.distance.nearest_nodes(
+        road_graph, [p.coord.x for p in parades], [p.coord.y for p in parades], return_dist=True)
+    nearest_node_of = {p: (node, dist) for p, node, dist in zip(parades, nearest_nodes, nearest_dist)}
+    orig_nodes = [nearest_node_of[p][0] for p in orig_parades]
+    dest_nodes = [nearest_node_of[p][0] for p in dest_parades]
+
+    start = time.perf_counter()
+    old_paths = ox.distance.shortest_path(road_graph, orig_nodes, dest_nodes, weight='length')
+    print(f"camins d'un en un: {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    paths = road_shortest_paths(road_graph, orig_nodes, dest_nodes, verbose=True)
+    print(f"camins agrupats per origen: {time.perf_counter() - start:.2f}s")
+
+    def length(path: list[int] | None) -> float | None:
+        if path is None:
+            return None
+        return sum(min(attrs['length'] for attrs in road_graph[u][v].values()) for u, v in pairwise(path))
+
+    assert all(length(old) is None and length(new) is None or abs(length(old) - length(new)) < 1e-6
+               for old, new in zip(old_paths, paths))
+    print(f"{sum(len(path or []) for path in paths)} punts als camins")
+
+    start = time.perf_counter()
+    old = build_one_by_one(road_graph, orig_parades, dest_parades, nearest_node_of, paths, colors_dict)
+    print(f"longituds d'una en una: {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    new = build_buses_graph(road_graph, orig_parades, dest_parades, nearest_node_of, paths, colors_dict)
+    print(f"longituds totes alhora: {time.perf_counter() - start:.2f}s")
+
+    assert list(old.edges) == list(new.edges)
+    for u, v, attrs in old.edges(data=True):
+        other = new.edges[u, v]
+        assert abs(attrs['time'] - other['time']) < 1e-6 and attrs['color'] == other['color']
+        assert attrs['info'].coord_list == other['info'].coord_list and attrs['info'].linia == other['info'].linia
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# bench_matrix.py
+"""Measures the throughput (origins per second) of computing the travel times from many random origins to every
+cinema of a synthetic city with different numbers of worker processes, and checks them against the paths found
+with find_paths_to_cinemas."""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from synthetic import synthetic_city
+
+from city import (Coord, build_cinema_tables, find_paths_to_cinemas, load_cinema_tables, load_graph, save_cinema_tables,
+                  save_graph)
+from matrix import travel_matrix
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--grid', type=int, default=120, help="the street graph is a grid of grid x grid nodes")
+    parser.add_argument('--lines', type=int, default=200, help="number of bus lines")
+    parser.add_argument('--stops', type=int, default=35, help="number of stops of each line")
+    parser.add_argument('--cinemas', type=int, default=20, help="number of cinemas")
+    parser.add_argument('--origins', type=int, default=20000, help="number of origins")
+    parser.add_argument('--workers', type=int, nargs='+', default=None,
+                        help="numbers of processes to try (1, 2, 4, ... up to the number of cores by default)")
+    parser.add_argument('--checks', type=int, default=50, help="number of origins checked against their paths")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    street_graph, _, _, city_graph = synthetic_city(args.grid, args.lines, args.stops, args.seed)
+    rnd = random.Random(args.seed)
+    X = [x for _, x in street_graph.nodes(data='x')]
+    Y = [y for _, y in street_graph.nodes(data='y')]
+
+    def random_coord() -> Coord:
+        return Coord(rnd.uniform(min(X), max(X)), rnd.uniform(min(Y), max(Y)))
+
+    cinemas = {f'Cinema {i}': random_coord() for i in range(args.cinemas)}
+    origins = [random_coord() for _ in range(args.origins)]
+    workers = args.workers or [2**k for k in range((os.cpu_count() or 1).bit_length())]
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = {'graph_file': os.path.join(directory, 'barcelona.grf'),
+                 'index_file': os.path.join(directory, 'barcelona.idx'),
+                 'tables_file': os.path.join(directory, 'cinemes')}
+        save_graph(city_graph, files['graph_file'])
+        graph = load_graph(files['graph_file'])
+        start = time.perf_counter()
+        save_cinema_tables(build_cinema_tables(graph, graph, cinemas), files['tables_file'])
+        print(f"taules de {len(graph)} nodes i {len(cinemas)} cinemes creades en {time.perf_counter() - start:.1f}s")
+
+        for num_workers in workers:
+            start = time.perf_counter()
+            matrix = travel_matrix(origins, num_workers, **files)
+            seconds = time.perf_counter() - start
+            print(f"{num_workers:>3} processos: {seconds:6.2f}s, {len(origins) / seconds:8.0f} origens/s")
+
+        # the way it used to be done, one origin at a time
+        tables = load_cinema_tables(files['tables_file'])
+        checked = rnd.sample(range(len(origins)), min(args.checks, len(origins)))
+        start = time.perf_counter()
+        paths = [find_paths_to_cinemas(graph, graph, tables, origins[i], tables.names) for i in checked]
+        seconds = time.perf_counter() - start
+        print(f"find_paths_to_cinemas: {len(checked) / seconds:8.0f} origens/s")
+
+        for i, origin_paths in zip(checked, paths):
+            for column, path in enumerate(origin_paths):
+                assert abs(matrix.durations[i, column] - path.duration.total_seconds()) < 0.1
+                assert abs(matrix.distances[i, column] - path.distance) < 0.1
+                assert abs(matrix.walking_distances[i, column] - path.walking_distance) < 0.1
+        print(f"{len(checked)} origens comprovats")
+
+
+if __name__ == '__main__':
+    main()
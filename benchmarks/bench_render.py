@@ -0,0 +1,69 @@
+# bench_render.py
+"""Measures the time of drawing the map of a synthetic city: drawing every edge as its own line, like plot did
+before, rendering it with merged and simplified polylines (render_graph), and plotting it again when the image of
+the graph is already saved. The map is rendered offline, so only the lines are measured."""
+from __future__ import annotations
+
+import argparse
+import os
+import tempfile
+import time
+
+import staticmap
+from synthetic import synthetic_city
+
+import render
+import tiles
+
+
+def edge_lines(graph) -> staticmap.StaticMap:
+    """Returns the map with one line for each edge of the graph."""
+    m = tiles.static_map(800, 600)
+    for _, _, attrs in graph.edges(data=True):
+        if attrs['info'].coord_list == []:
+            continue
+        color = '#%02x%02x%02x' % attrs['color']
+        m.add_line(staticmap.Line([coord.xy for coord in attrs['info'].coord_list], color, 1))
+    return m
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--grid', type=int, default=80, help="the street graph is a grid of grid x grid nodes")
+    parser.add_argument('--lines', type=int, default=40, help="number of bus lines")
+    parser.add_argument('--repeat', type=int, default=3, help="number of times each render is done")
+    args = parser.parse_args()
+
+    _, _, _, city_graph = synthetic_city(args.grid, args.lines, 20)
+
+    with tempfile.TemporaryDirectory() as directory:
+        tiles.tile_provider = tiles.TileProvider(directory=directory, offline=True)
+        render.RASTER_DIRECTORY = os.path.join(directory, 'mapes')
+
+        m = edge_lines(city_graph)
+        lines, points = len(m.lines), sum(len(line.coords) for line in m.lines)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            edge_lines(city_graph).render()
+        seconds = (time.perf_counter() - start) / args.repeat
+        print(f"    una línia per aresta: {seconds * 1000:7.1f} ms, {lines} línies, {points} punts")
+
+        _, _, polylines = render.graph_polylines(city_graph, 800, 600)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            render.render_graph(city_graph, 800, 600)
+        seconds = (time.perf_counter() - start) / args.repeat
+        print(f"polilínies simplificades: {seconds * 1000:7.1f} ms, {len(polylines)} línies, "
+              f"{sum(len(line) for _, line in polylines)} punts")
+
+        filename = os.path.join(directory, 'mapa.png')
+        render.save_graph_image(city_graph, filename, 800, 600)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            render.save_graph_image(city_graph, filename, 800, 600)
+        seconds = (time.perf_counter() - start) / args.repeat
+        print(f"        imatge ja desada: {seconds * 1000:7.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
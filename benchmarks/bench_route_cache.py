@@ -0,0 +1,78 @@
+# bench_route_cache.py
+"""Measures the time of finding the paths of a synthetic stream of queries, where most of them go between a few
+popular areas and many are the return trip of an earlier one, with and without the route cache of find_path. It
+also checks that the cached paths are the same ones and that the cache can be saved and loaded."""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from synthetic import synthetic_city
+
+from city import Coord, find_path, route_cache
+from routing import RouteCache, compile_graph
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--grid', type=int, default=120, help="the street graph is a grid of grid x grid nodes")
+    parser.add_argument('--lines', type=int, default=200, help="number of bus lines")
+    parser.add_argument('--stops', type=int, default=35, help="number of stops of each line")
+    parser.add_argument('--queries', type=int, default=300, help="number of paths searched")
+    parser.add_argument('--areas', type=int, default=10, help="number of popular areas")
+    parser.add_argument('--popular', type=float, default=0.8, help="fraction of the queries between popular areas")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    street_graph, _, _, city_graph = synthetic_city(args.grid, args.lines, args.stops, args.seed)
+    graph = compile_graph(city_graph)
+    rnd = random.Random(args.seed)
+    X = [x for _, x in street_graph.nodes(data='x')]
+    Y = [y for _, y in street_graph.nodes(data='y')]
+
+    def random_coord() -> Coord:
+        return Coord(rnd.uniform(min(X), max(X)), rnd.uniform(min(Y), max(Y)))
+
+    # each popular area is a point and the places a few meters around it, which have the same nearest node
+    areas = [random_coord() for _ in range(args.areas)]
+
+    def coord() -> Coord:
+        if rnd.random() >= args.popular:
+            return random_coord()
+        area = rnd.choice(areas)
+        return Coord(area.x + rnd.uniform(-1e-5, 1e-5), area.y + rnd.uniform(-1e-5, 1e-5))
+
+    queries: list[tuple[Coord, Coord]] = []
+    while len(queries) < args.queries:
+        queries.append((coord(), coord()))
+        if rnd.random() < 0.5:
+            queries.append(queries[-1][::-1])  # the return trip
+
+    results = {}
+    for name, maxsize in (('sense memòria cau', 0), ('amb memòria cau', route_cache.maxsize)):
+        route_cache.clear()
+        route_cache.maxsize = maxsize
+        start = time.perf_counter()
+        results[name] = [find_path(street_graph, graph, src, dst, 'astar') for src, dst in queries]
+        seconds = time.perf_counter() - start
+        print(f"{name:>17}: {seconds / len(queries) * 1000:6.2f} ms per camí, {route_cache.hits} encerts, "
+              f"{route_cache.misses} errades, {route_cache.evictions} expulsions")
+
+    without, with_cache = results.values()
+    for old, new in zip(without, with_cache):
+        assert abs(old.duration.total_seconds() - new.duration.total_seconds()) < 1e-6
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'rutes.npz')
+        route_cache.save(filename)
+        loaded = RouteCache(route_cache.maxsize)
+        loaded.load(filename)
+        assert loaded.routes == route_cache.routes
+        print(f"{len(loaded)} rutes desades i carregades ({os.path.getsize(filename) / 2**10:.0f} KB)")
+
+
+if __name__ == '__main__':
+    main()
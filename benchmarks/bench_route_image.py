@@ -0,0 +1,85 @@
+# bench_route_image.py
+"""Measures the time of drawing routes of a synthetic city from the same origin: rendering the whole map for each
+route, like plot_path did before, and drawing only the route over the base maps kept by render.base_maps, both when
+they still have to be rendered and when they are already kept. The tiles come from a local tile server and are
+downloaded before measuring."""
+from __future__ import annotations
+
+import argparse
+import random
+import tempfile
+import time
+from itertools import pairwise
+
+import staticmap
+from bench_tiles import tile_server
+from synthetic import synthetic_city
+
+import render
+import tiles
+from city import Bus, Coord, Path, Transbord, find_path, get_color, route_image
+
+
+def full_render(city_graph, p: Path) -> None:
+    """Draws the route rendering the whole map with staticmap."""
+    m = tiles.static_map(800, 600)
+    bus_colors = get_color()
+    m.add_marker(staticmap.CircleMarker(p.source.xy, 'green', 10))
+    m.add_marker(staticmap.CircleMarker(p.destination.xy, 'black', 10))
+    for node1, node2 in pairwise(p.route):
+        info = city_graph.get_edge_data(node1, node2)['info']
+        if isinstance(info, Transbord):
+            bus_color = next(bus_colors)
+            m.add_marker(staticmap.CircleMarker(node1.coord.xy, 'gray', 6))
+        else:
+            color = bus_color if isinstance(info, Bus) else 'deepskyblue'
+            m.add_line(staticmap.Line([coord.xy for coord in info.coord_list], color, 4))
+    m.render()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--grid', type=int, default=40, help="the street graph is a grid of grid x grid nodes")
+    parser.add_argument('--routes', type=int, default=30, help="number of routes drawn")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    road_graph, _, _, city_graph = synthetic_city(args.grid, 10, 12)
+    rnd = random.Random(args.seed)
+    X = [x for _, x in road_graph.nodes(data='x')]
+    Y = [y for _, y in road_graph.nodes(data='y')]
+
+    def random_coord() -> Coord:
+        return Coord(rnd.uniform(min(X), max(X)), rnd.uniform(min(Y), max(Y)))
+    home = random_coord()
+    paths = [find_path(road_graph, city_graph, home, random_coord()) for _ in range(args.routes)]
+
+    server, _ = tile_server(0)
+    with tempfile.TemporaryDirectory() as directory:
+        tiles.tile_provider = tiles.TileProvider(f'http://127.0.0.1:{server.server_port}/{{z}}/{{x}}/{{y}}.png',
+                                                 directory)
+        for p in paths:
+            full_render(city_graph, p)
+            route_image(city_graph, p)
+        render.base_maps.clear()
+
+        start = time.perf_counter()
+        for p in paths:
+            full_render(city_graph, p)
+        seconds = (time.perf_counter() - start) / len(paths)
+        print(f"{'mapa sencer':>17}: {seconds * 1000:6.1f} ms per ruta")
+
+        for name in ('mapes base nous', 'mapes base desats'):
+            hits, misses = render.base_maps.hits, render.base_maps.misses
+            start = time.perf_counter()
+            for p in paths:
+                route_image(city_graph, p)
+            seconds = (time.perf_counter() - start) / len(paths)
+            print(f"{name:>17}: {seconds * 1000:6.1f} ms per ruta, {render.base_maps.hits - hits} encerts, "
+                  f"{render.base_maps.misses - misses} errades")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# bench_search.py
+"""Compares the time of searching projections in a synthetic billboard by scanning all of them (the way it used
+to be done) and with the trigram index of the billboard."""
+from __future__ import annotations
+
+import argparse
+import random
+import time
+
+from synthetic import synthetic_billboard
+
+from billboard import Billboard, Projection, is_str_in_any, lower_ASCII
+
+
+def scan_projections(billboard: Billboard, title='', cinema_name='', genre='', director='', actor='') -> list[Projection]:
+    """Returns the projections that match the query looking at all of them."""
+    return [projection for projection in billboard.projections
+            if lower_ASCII(title) in lower_ASCII(projection.film.title)
+            and lower_ASCII(cinema_name) in lower_ASCII(projection.cinema.name)
+            and is_str_in_any(genre, projection.film.genres)
+            and is_str_in_any(director, projection.film.directors)
+            and is_str_in_any(actor, projection.film.actors)]
+
+
+def random_queries(billboard: Billboard, num_queries: int, seed: int) -> list[tuple[str, ...]]:
+    """Returns queries made of pieces of the titles, cinemas, genres, directors and actors of the billboard."""
+    rnd = random.Random(seed)
+
+    def piece(strings: list[str]) -> str:
+        if not strings or rnd.random() < 0.6:
+            return ''
+        string = rnd.choice(strings)
+        start = rnd.randrange(len(string))
+        return string[start:start + rnd.randint(1, 8)].upper() if rnd.random() < 0.2 else string[start:start + rnd.randint(1, 8)]
+
+    queries = []
+    for _ in range(num_queries):
+        film = rnd.choice(billboard.films)
+        queries.append((piece([film.title]), piece([rnd.choice(billboard.cinemas).name]), piece(film.genres),
+                        piece(film.directors), piece(film.actors)))
+    return queries
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--projections', type=int, default=50000, help="number of projections of the billboard")
+    parser.add_argument('--queries', type=int, default=200, help="number of queries")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    billboard = synthetic_billboard(args.projections, seed=args.seed)
+    queries = random_queries(billboard, args.queries, args.seed)
+    print(f"{len(billboard.projections)} projeccions, {len(billboard.films)} pel·lícules, "
+          f"{len(billboard.cinemas)} cinemes, {len(queries)} cerques")
+
+    start = time.perf_counter()
+    expected = [scan_projections(billboard, *query) for query in queries]
+    scan = time.perf_counter() - start
+
+    start = time.perf_counter()
+    billboard.search_index
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    found = [billboard.search_projections(*query) for query in queries]
+    indexed = time.perf_counter() - start
+
+    assert found == expected
+    print(f"recorrent-les: {scan / len(queries) * 1000:8.2f} ms per cerca")
+    print(f"amb l'índex:  {indexed / len(queries) * 1000:8.2f} ms per cerca (creat en {build * 1000:.0f} ms)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# bench_tiles.py
+"""Measures the time of rendering the map of a synthetic city when its tiles have to be downloaded, when they are
+already in the tile cache and in offline mode, using a local tile server that takes some time to answer each tile
+instead of the real one."""
+from __future__ import annotations
+
+import argparse
+import http.server
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+from PIL import Image
+from synthetic import synthetic_city
+
+import city
+import tiles
+
+
+def tile_server(latency: float) -> tuple[http.server.ThreadingHTTPServer, list[int]]:
+    """Starts a local server that answers every tile with the same image after latency seconds, and returns it
+    together with the number of tiles it has been asked for."""
+    buffer = BytesIO()
+    Image.new('RGB', (tiles.TILE_SIZE, tiles.TILE_SIZE), (230, 230, 220)).save(buffer, format='PNG')
+    content = buffer.getvalue()
+    asked_tiles = [0]
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            asked_tiles[0] += 1
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args) -> None:
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, asked_tiles
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--grid', type=int, default=40, help="the street graph is a grid of grid x grid nodes")
+    parser.add_argument('--latency', type=float, default=0.1, help="time (s) the server takes to answer each tile")
+    parser.add_argument('--repeat', type=int, default=3, help="number of renders with the cached tiles")
+    args = parser.parse_args()
+
+    _, _, _, city_graph = synthetic_city(args.grid, 5, 10)
+    server, asked_tiles = tile_server(args.latency)
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = f'http://127.0.0.1:{server.server_port}/{{z}}/{{x}}/{{y}}.png'
+        providers = [('descarregant', tiles.TileProvider(url, directory)),
+                     ('de la memòria cau', tiles.TileProvider(url, directory)),
+                     ('fora de línia', tiles.TileProvider(url, directory, offline=True))]
+        for name, provider in providers:
+            tiles.tile_provider = provider
+            asked = asked_tiles[0]
+            repeat = 1 if name == 'descarregant' else args.repeat
+            start = time.perf_counter()
+            for _ in range(repeat):
+                city.plot(city_graph, f'{directory}/mapa.png')
+            seconds = (time.perf_counter() - start) / repeat
+            print(f"{name:>17}: {seconds * 1000:7.1f} ms per mapa, {asked_tiles[0] - asked} rajoles demanades")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# bench_transit.py
+"""Compares, over a synthetic city, the time of finding the fastest path between random points searching the
+whole city graph (streets, stops and buses together) with Dijkstra and A*, and with the round-based (RAPTOR)
+transit engine, checking that the paths found by the transit engine can be followed in the city graph and are
+exactly as fast as the shortest ones (which never take more than MAX_ROUNDS buses in these cities)."""
+from __future__ import annotations
+
+import argparse
+import random
+import time
+from itertools import pairwise
+
+from synthetic import synthetic_city
+
+from city import Coord, find_path, route_cache
+from routing import compile_graph
+from transit import build_network
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--grid', type=int, default=120, help="the street graph is a grid of grid x grid nodes")
+    parser.add_argument('--lines', type=int, default=200, help="number of bus lines")
+    parser.add_argument('--stops', type=int, default=35, help="number of stops of each line")
+    parser.add_argument('--queries', type=int, default=100, help="number of paths searched")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    street_graph, orig_parades, dest_parades, city_graph = synthetic_city(args.grid, args.lines, args.stops, args.seed)
+    graph = compile_graph(city_graph)
+    network = build_network(graph, orig_parades, dest_parades, verbose=True)
+    print(f"graf de la ciutat: {len(graph)} nodes, {graph.number_of_edges()} arestes")
+
+    rnd = random.Random(args.seed)
+    X = [x for _, x in street_graph.nodes(data='x')]
+    Y = [y for _, y in street_graph.nodes(data='y')]
+    queries = [(Coord(rnd.uniform(min(X), max(X)), rnd.uniform(min(Y), max(Y))),
+                Coord(rnd.uniform(min(X), max(X)), rnd.uniform(min(Y), max(Y)))) for _ in range(args.queries)]
+
+    results = {}
+    for algorithm in ('dijkstra', 'astar', 'raptor'):
+        route_cache.clear()  # the routes found by the previous algorithm would be reused
+        start = time.perf_counter()
+        paths = [find_path(street_graph, graph, src, dst, algorithm, network=network) for src, dst in queries]
+        seconds = time.perf_counter() - start
+        results[algorithm] = paths
+        print(f"{algorithm:>8}: {seconds / len(queries) * 1000:6.1f} ms per camí, "
+              f"{sum(p.settled_nodes for p in paths) / len(paths):7.0f} nodes visitats de mitjana")
+
+    for path in results['raptor']:
+        assert all(graph.edge_id(node1, node2) is not None for node1, node2 in pairwise(path.route))
+    differences = [new.duration.total_seconds() - old.duration.total_seconds()
+                   for old, new in zip(results['dijkstra'], results['raptor'])]
+    slower = sum(d > 1e-6 for d in differences)
+    assert min(differences) > -1e-6
+    assert slower == 0, f"{slower}/{len(differences)} camins més lents, {max(differences):.0f}s de diferència màxima"
+    print(f"{len(differences)}/{len(differences)} camins igual de ràpids")
+
+
+if __name__ == '__main__':
+    main()
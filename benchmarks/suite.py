@@ -0,0 +1,172 @@
+# suite.py
+"""Runs the main steps of the application over synthetic data and the billboard pages in fixtures, without any network
+access, and writes the timings as json so that two branches can be compared: building the street, buses and city
+graphs from a grid of streets, finding paths over it, indexing and searching a billboard, and parsing the pages."""
+from __future__ import annotations
+
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from typing import Callable
+
+from synthetic import nearest_road_nodes, synthetic_billboard, synthetic_bus_lines, synthetic_road_graph, word
+
+from billboard import Billboard, parse_page
+from buses import build_buses_graph, road_shortest_paths
+from city import Coord, build_city_graph, build_street_graph, find_path, route_cache
+from routing import from_networkx
+
+# synthetic pages with the structure of the sensacine billboard, not recorded ones (see bench_billboard_parse.py)
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+SIZES = {  # (grid, lines, stops, projections) of each size of the synthetic data
+    'petita': (40, 20, 20, 2000),
+    'mitjana': (80, 80, 30, 20000),
+    'gran': (150, 250, 40, 100000),
+}
+
+
+def measure(function: Callable[[], object], repeat: int) -> dict[str, float]:
+    """Runs the function repeat times and returns the best and the mean time (s)."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'best': min(times), 'mean': sum(times) / len(times), 'repeat': repeat}
+
+
+def git_commit() -> str | None:
+    """Returns the commit the code being measured comes from, if it is in a git repository."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(grid: int, lines: int, stops: int, projections: int, queries: int, repeat: int, seed: int) -> dict[str, dict]:
+    """Returns the timings of every benchmark of the suite."""
+    results = {}
+
+    road_graph = synthetic_road_graph(grid, seed)
+    parades, orig_parades, dest_parades, colors = synthetic_bus_lines(road_graph, lines, stops, seed)
+    nearest_node_of = nearest_road_nodes(road_graph, parades)
+    orig_nodes = [nearest_node_of[p][0] for p in orig_parades]
+    dest_nodes = [nearest_node_of[p][0] for p in dest_parades]
+
+    results['street_graph'] = measure(lambda: build_street_graph(road_graph), repeat)
+
+    def buses() -> object:
+        paths = road_shortest_paths(road_graph, orig_nodes, dest_nodes)
+        return build_buses_graph(road_graph, orig_parades, dest_parades, nearest_node_of, paths, colors)
+    results['buses_graph'] = measure(buses, repeat)
+
+    buses_graph = buses()
+    results['city_graph'] = measure(lambda: build_city_graph(road_graph, buses_graph), repeat)
+
+    city_graph = build_city_graph(road_graph, buses_graph)
+    results['compile_graph'] = measure(lambda: from_networkx(city_graph), repeat)
+
+    rnd = random.Random(seed)
+    X = [x for _, x in road_graph.nodes(data='x')]
+    Y = [y for _, y in road_graph.nodes(data='y')]
+    pairs = [(Coord(rnd.uniform(min(X), max(X)), rnd.uniform(min(Y), max(Y))),
+              Coord(rnd.uniform(min(X), max(X)), rnd.uniform(min(Y), max(Y)))) for _ in range(queries)]
+    # the graph is compiled, the nodes indexed and the landmarks of A* chosen only once
+    find_path(road_graph, city_graph, *pairs[0], 'astar')
+
+    for algorithm in ('dijkstra', 'astar'):
+        def paths() -> None:
+            route_cache.clear()  # the routes would be found only the first time
+            for src, dst in pairs:
+                find_path(road_graph, city_graph, src, dst, algorithm)
+        results[f'find_path_{algorithm}'] = measure(paths, repeat)
+    route_cache.clear()
+
+    billboard = synthetic_billboard(projections, seed=seed)
+
+    def index() -> None:
+        billboard.invalidate_indexes()
+        billboard.search_index
+    results['billboard_index'] = measure(index, repeat)
+
+    searches = [{'title': word(rnd, 1)[:3]} for _ in range(queries)] + \
+               [{'genre': rnd.choice(['dra', 'comedia', 'terror'])} for _ in range(queries)] + \
+               [{'actor': word(rnd, 2)[:4], 'cinema_name': 'cines'} for _ in range(queries)]
+    results['search_projections'] = measure(lambda: [billboard.search_projections(**search) for search in searches],
+                                            repeat)
+
+    pages = []
+    for filename in sorted(glob.glob(os.path.join(FIXTURES, 'cartellera_*.html'))):
+        with open(filename, 'rb') as f:
+            pages.append(f.read())
+
+    def parse() -> None:
+        parsed = Billboard.__new__(Billboard)
+        parsed.read_pages([parse_page(page) for page in pages])
+    if pages:
+        # coord_cines.json is read from the root of the repository
+        cwd = os.getcwd()
+        os.chdir(os.path.join(FIXTURES, '..', '..'))
+        try:
+            results['billboard_parse'] = measure(parse, repeat)
+        finally:
+            os.chdir(cwd)
+
+    return results
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict]) -> None:
+    """Shows how many times slower (>1) or faster (<1) every benchmark is compared to the baseline. It is shown in
+    the standard error, so that the standard output is only the json."""
+    for name, timing in results.items():
+        if name in baseline:
+            ratio = timing['best'] / baseline[name]['best']
+            print(f"{name:>20}: {ratio:5.2f}x {'més lent' if ratio > 1 else 'més ràpid'}", file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', choices=SIZES, default='petita', help="size of the synthetic data")
+    parser.add_argument('--grid', type=int, help="the street graph is a grid of grid x grid nodes")
+    parser.add_argument('--lines', type=int, help="number of bus lines")
+    parser.add_argument('--stops', type=int, help="number of stops of each line")
+    parser.add_argument('--projections', type=int, help="number of projections of the billboard")
+    parser.add_argument('--queries', type=int, default=50, help="number of paths and searches of each benchmark")
+    parser.add_argument('--repeat', type=int, default=3, help="number of times each benchmark is run")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="json file where the timings are written (by default, the standard output)")
+    parser.add_argument('--compare', help="json file written by an earlier run, to compare the timings with")
+    args = parser.parse_args()
+
+    grid, lines, stops, projections = SIZES[args.size]
+    params = {'grid': args.grid or grid, 'lines': args.lines or lines, 'stops': args.stops or stops,
+              'projections': args.projections or projections, 'queries': args.queries, 'repeat': args.repeat,
+              'seed': args.seed}
+    report = {'params': params, 'commit': git_commit(), 'python': platform.python_version(),
+              'machine': platform.machine(), 'results': run(**params)}
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if {k: v for k, v in baseline['params'].items() if k != 'repeat'} != \
+                {k: v for k, v in params.items() if k != 'repeat'}:
+            print("Atenció: les dues execucions no fan servir les mateixes dades.", file=sys.stderr)
+        compare(report['results'], baseline['results'])
+
+
+if __name__ == '__main__':
+    main()
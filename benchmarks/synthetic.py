@@ -0,0 +1,155 @@
+# synthetic.py
+"""Synthetic data of any size for the benchmarks, generated from a seed so that every run uses the same."""
+from __future__ import annotations
+
+import datetime as dt
+import math
+import os
+import random
+import sys
+
+import networkx as nx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from billboard import Billboard, Cinema, Film, Projection  # noqa: E402
+from buses import (Coord, Parada, build_buses_graph, generate_colors, get_distance,  # noqa: E402
+                   road_shortest_paths)
+from city import CityGraph, build_city_graph  # noqa: E402
+from spatial import build_index  # noqa: E402
+
+SYLLABLES = ['ca', 'sa', 'ma', 'ri', 'to', 'ne', 'lo', 'vi', 'bé', 'ça', 'ño', 'rà', 'el', 'es', 'ur', 'lla', 'gü']
+GENRES = ['Acción', 'Animación', 'Aventura', 'Comedia', 'Ciencia ficción', 'Documental', 'Drama', 'Fantasía',
+          'Histórico', 'Música', 'Romántico', 'Suspense', 'Terror', 'Thriller']
+LANGUAGES = ['Castellano', 'VOSE', 'Català', 'Digital 3D']
+
+
+def word(rnd: random.Random, syllables: int) -> str:
+    """Returns a capitalized made-up word."""
+    return ''.join(rnd.choice(SYLLABLES) for _ in range(syllables)).capitalize()
+
+
+def name(rnd: random.Random) -> str:
+    """Returns a made-up full name."""
+    return f'{word(rnd, 2)} {word(rnd, 3)}'
+
+
+def synthetic_billboard(num_projections: int, num_films: int | None = None, num_cinemas: int | None = None,
+                        seed: int = 0) -> Billboard:
+    """Returns a billboard with the given number of projections during the next days, spread over made-up
+    films and cinemas in Barcelona."""
+    rnd = random.Random(seed)
+    num_films = num_films or max(num_projections // 50, 1)
+    num_cinemas = num_cinemas or max(num_projections // 500, 1)
+    people = [name(rnd) for _ in range(max(num_films, 10))]
+
+    billboard = Billboard.__new__(Billboard)
+    billboard.cinemas = [Cinema(f'Cines {word(rnd, 3)} {i}', f'Carrer {word(rnd, 2)}, {rnd.randrange(1, 300)}',
+                                Coord(rnd.uniform(2.08, 2.22), rnd.uniform(41.35, 41.45))) for i in range(num_cinemas)]
+    billboard.films = [Film(' '.join(word(rnd, rnd.randint(1, 3)) for _ in range(rnd.randint(1, 4))),
+                            rnd.sample(GENRES, rnd.randint(1, 3)), rnd.sample(people, rnd.randint(1, 2)),
+                            rnd.sample(people, rnd.randint(0, 5))) for _ in range(num_films)]
+    billboard.projections = []
+
+    now = dt.datetime.now().replace(second=0, microsecond=0)
+    for _ in range(num_projections):
+        start = now + dt.timedelta(minutes=rnd.randrange(1, 4 * 24 * 60))
+        billboard.add_projection(Projection(rnd.choice(billboard.films), rnd.choice(billboard.cinemas), start,
+                                            start + dt.timedelta(minutes=rnd.randrange(80, 180)),
+                                            rnd.choice(LANGUAGES)))
+    return billboard
+
+
+def synthetic_road_graph(n: int, seed: int = 0) -> nx.MultiDiGraph:
+    """Returns an osmnx-like street graph: a slightly distorted n x n grid of two-way streets over Barcelona."""
+    rnd = random.Random(seed)
+    graph = nx.MultiDiGraph(crs='epsg:4326')
+    x0, y0, step = 2.10, 41.35, 0.001
+    for i in range(n):
+        for j in range(n):
+            graph.add_node(i * n + j, x=x0 + (i + rnd.uniform(-0.2, 0.2)) * step,
+                           y=y0 + (j + rnd.uniform(-0.2, 0.2)) * step, street_count=4)
+    for i in range(n):
+        for j in range(n):
+            for di, dj in ((1, 0), (0, 1)):
+                if i + di < n and j + dj < n:
+                    u, v = i * n + j, (i + di) * n + j + dj
+                    length = get_distance(Coord(graph.nodes[u]['x'], graph.nodes[u]['y']),
+                                          Coord(graph.nodes[v]['x'], graph.nodes[v]['y']))
+                    name = f'Carrer {word(rnd, 2)} {i}' if dj else f'Avinguda {word(rnd, 2)} {j}'
+                    graph.add_edge(u, v, length=length, name=name)
+                    graph.add_edge(v, u, length=length, name=name)
+    return graph
+
+
+def synthetic_bus_lines(road_graph: nx.MultiDiGraph, num_lines: int, stops: int,
+                        seed: int = 0) -> tuple[set[Parada], list[Parada], list[Parada], dict[str, tuple[int]]]:
+    """Returns bus lines with stops next to random nodes of the road graph, in the same form as get_orig_dest_parades."""
+    rnd = random.Random(seed)
+    nodes = list(road_graph.nodes)
+    colors = generate_colors()
+    parades_set: set[Parada] = set()
+    orig_parades: list[Parada] = []
+    dest_parades: list[Parada] = []
+    colors_dict = {}
+    for i in range(num_lines):
+        linia = f'L{i}'
+        colors_dict[linia] = next(colors)
+        # consecutive stops are a few blocks apart and, like the ones of a real line, mostly go the same way
+        node = rnd.choice(nodes)
+        heading = rnd.uniform(0, 2 * math.pi)
+        parades = []
+        for k in range(stops):
+            data = road_graph.nodes[node]
+            parades.append(Parada(rnd.randrange(10**6), Coord(data['x'] + rnd.uniform(-1e-4, 1e-4), data['y']),
+                                  nom=f'Parada {word(rnd, 3)}', linia=linia))
+            for _ in range(rnd.randint(2, 6)):
+                x, y = road_graph.nodes[node]['x'], road_graph.nodes[node]['y']
+                successors = list(road_graph.successors(node))
+                node = max(successors, key=lambda n: math.cos(heading) * (road_graph.nodes[n]['x'] - x)
+                           + math.sin(heading) * (road_graph.nodes[n]['y'] - y)) \
+                    if rnd.random() < 0.7 else rnd.choice(successors)
+        parades_set |= set(parades)
+        orig_parades.extend(parades[:-1])
+        dest_parades.extend(parades[1:])
+    return parades_set, orig_parades, dest_parades, colors_dict
+
+
+def synthetic_city(grid: int, num_lines: int, stops: int,
+                   seed: int = 0) -> tuple[nx.MultiDiGraph, list[Parada], list[Parada], CityGraph]:
+    """Returns a synthetic street graph (used both to walk and to drive), bus lines over it in the same form as
+    the origin and destination stops of get_orig_dest_parades, and the city graph built from them."""
+    road_graph = synthetic_road_graph(grid, seed)
+    parades_set, orig_parades, dest_parades, colors_dict = synthetic_bus_lines(road_graph, num_lines, stops, seed)
+    nearest_node_of = nearest_road_nodes(road_graph, parades_set)
+    paths = road_shortest_paths(road_graph, [nearest_node_of[p][0] for p in orig_parades],
+                                [nearest_node_of[p][0] for p in dest_parades])
+    buses_graph = build_buses_graph(road_graph, orig_parades, dest_parades, nearest_node_of, paths, colors_dict)
+    return road_graph, orig_parades, dest_parades, build_city_graph(road_graph, buses_graph)
+
+
+def nearest_road_nodes(road_graph: nx.MultiDiGraph, parades: set[Parada]) -> dict[Parada, tuple[int, float]]:
+    """Returns the nearest node of the road graph to each stop and the distance (m) to it."""
+    parades = list(parades)
+    index = build_index(list(road_graph.nodes), [x for _, x in road_graph.nodes(data='x')],
+                        [y for _, y in road_graph.nodes(data='y')])
+    nearest_nodes, nearest_dist = index.nearest([p.coord.x for p in parades], [p.coord.y for p in parades])
+    return {p: (node, dist) for p, node, dist in zip(parades, nearest_nodes[:, 0].tolist(), nearest_dist[:, 0].tolist())}
+
+
+def synthetic_bus_data(num_lines: int, stops: int, seed: int = 0) -> dict:
+    """Returns data of bus lines over Barcelona with the same structure (and the same kind of extra fields) as the
+    one given by the AMB."""
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(num_lines):
+        x, y = rnd.uniform(2.08, 2.22), rnd.uniform(41.35, 41.45)
+        parades = []
+        for k in range(stops):
+            x, y = x + rnd.uniform(-0.003, 0.003), y + rnd.uniform(-0.003, 0.003)
+            parades.append({'CodAMB': str(rnd.randrange(1, 10**5)), 'CodiTipusParada': 'BUS', 'Nom': f'{word(rnd, 2)} - {word(rnd, 3)}',
+                            'Adreca': f'Carrer {word(rnd, 3)}, {rnd.randrange(1, 300)}', 'Municipi': 'Barcelona',
+                            'UTM_X': f'{y:.6f}', 'UTM_Y': f'{x:.6f}', 'Ordre': k + 1, 'Sentit': rnd.choice('AT')})
+        lines.append({'Codi': str(i), 'Nom': f'{rnd.choice("HVDX")}{i}', 'Descripcio': f'{word(rnd, 3)} - {word(rnd, 3)}',
+                      'Operador': 'TMB', 'Parades': {'Parada': parades}})
+    return {'ObtenirDadesAMBResult': {'Linies': {'Linia': lines}}}
@@ -3,14 +3,35 @@ from __future__ import annotations
 import datetime as dt
 import json
 import operator
+import os
+import re
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from functools import reduce
+from functools import cached_property
+from typing import Iterator
 
 import requests
-from bs4 import BeautifulSoup, Tag
+from bs4 import BeautifulSoup, SoupStrainer, Tag
+from requests.adapters import HTTPAdapter
 from unidecode import unidecode
 
 from buses import Coord
+from metrics import stage
+
+BILLBOARD_URL = 'https://www.sensacine.com/cines/cines-en-72480/?page='
+NUM_PAGES = 3  # number of pages of the billboard
+TIMEOUT = 10  # maximum time (s) waiting for the webpage to answer
+MAX_ATTEMPTS = 4  # number of times each page is requested before giving up
+BACKOFF = 0.5  # time (s) waited before the first retry, it doubles on each one
+SNAPSHOT_FILE = 'cartellera.json'  # file where the last billboard read is kept
+SNAPSHOT_TTL = dt.timedelta(hours=3)  # time during which the saved billboard is used without asking the webpage
+GRAM = 3  # length of the substrings indexed by TextIndex
+
+# only the cinema names (h2.tt_18), their addresses (span.lighten) and the days of projections (div.item-N, which
+# contain the div.item_resa of each film) are needed, so the rest of the page is not even built
+PAGE_STRAINER = SoupStrainer(class_=re.compile(r'(^|\s)(tt_18|lighten|item-\d+)(\s|$)'))
 
 
 class PageNotFound(Exception):
@@ -35,8 +56,9 @@ class Cinema:
     projections: list[Projection] = field(default_factory=list)
 
     def get_projections_in_1_day(self) -> list[Projection]:
+        now = dt.datetime.now()
         def starts_in_1_day(proj) -> bool: return dt.timedelta(
-        ) < proj.start_time - dt.datetime.now() < dt.timedelta(days=1)
+        ) < proj.start_time - now < dt.timedelta(days=1)
         return [proj for proj in self.projections if starts_in_1_day(proj)]
 
 
@@ -55,32 +77,144 @@ class Billboard:
     films: list[Film]
     projections: list[Projection]
 
-    def __init__(self) -> None:
-        """ Reads the information from the sensacine webpage and returns a Billbord element with all the cinemas, films and projections"""
-        try:
-            url = 'https://www.sensacine.com/cines/cines-en-72480/?page='
-            pages = [requests.get(url + str(i)) for i in range(1, 4)]
-
-            if any(200 != p.status_code for p in pages):
-                raise PageNotFound
-
-            contents = reduce(operator.add, map(lambda p: p.content, pages))
-            soup = BeautifulSoup(contents, 'html.parser')
+    @stage('billboard')
+    def __init__(self, num_pages: int = NUM_PAGES, url: str = BILLBOARD_URL, snapshot: str | None = SNAPSHOT_FILE,
+                 ttl: dt.timedelta = SNAPSHOT_TTL) -> None:
+        """ Reads the information from the sensacine webpage and returns a Billbord element with all the cinemas, films and projections.
+        The first num_pages pages are downloaded at the same time. Raises PageNotFound if any of them can't be obtained.
+        The billboard read is saved in the snapshot file, which is used instead of the webpage while it is newer than ttl.
+        After that, the webpage is only read again if it has changed, and the snapshot is used if the webpage can't be reached.
+        A snapshot of another url or number of pages is ignored."""
+        cached = read_snapshot(snapshot, url, num_pages) if snapshot is not None else None
+        if cached is not None and dt.datetime.now() - cached['fetched_at'] < ttl:
+            self.load_snapshot(cached)
+            return
+
+        headers = None
+        if cached is not None:
+            headers = [conditional_headers(validator) for validator in cached['validators']]
 
+        try:
+            # each page is parsed as soon as it arrives, while the next ones are still being downloaded
+            responses = []
+            soups = []
+            for response in iter_pages(url, num_pages, headers):
+                responses.append(response)
+                if response.status_code == 200:
+                    soups.append(parse_page(response.content))
+
+            not_modified = [response.status_code == 304 for response in responses]
+            if any(not_modified) and not all(not_modified):
+                # the snapshot doesn't keep the pages separately, so all of them are needed again
+                responses = fetch_pages(url, num_pages)
+                soups = [parse_page(response.content) for response in responses]
+        except PageNotFound:
+            if cached is None:
+                raise
+            print("No s'ha pogut obtenir la informació de la pàgina web. Es fa servir l'última cartellera guardada.")
+            self.load_snapshot(cached)
+            return
+
+        if responses and all(response.status_code == 304 for response in responses):
+            self.load_snapshot(cached)
+            validators = cached['validators']
+        else:
+            self.read_pages(soups)
+            validators = [{'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+                          for response in responses]
+
+        if snapshot is not None:
+            self.save_snapshot(snapshot, validators, url, num_pages)
+
+    @stage('billboard.read')
+    def read_pages(self, soups: list[BeautifulSoup]) -> None:
+        """ Reads all the cinemas, films and projections in the parsed pages."""
+        self.invalidate_indexes()
+        self.cinemas = []
+        for soup in soups:
             self.read_cinemas(soup)
-            cinema_dict = {cinema.name: cinema for cinema in self.cinemas}
+        cinema_dict = {cinema.name: cinema for cinema in self.cinemas}
 
-            self.films = []
-            self.projections = []
+        self.films = []
+        self.projections = []
+        for soup in soups:
             self.read_films_and_projections(soup, cinema_dict)
 
-        except PageNotFound:
-            print(
-                "No s'ha pogut obtenir la informació de la pàgina web. S'està tornant a intentar...")
-            return self.__init__()
+    def save_snapshot(self, filename: str, validators: list[dict[str, str | None]], url: str = BILLBOARD_URL,
+                      num_pages: int = NUM_PAGES) -> None:
+        """ Saves the billboard in a json file, together with the current time, the pages it was read from and the
+        validators of each of them. The file is replaced at once, so that it is never read half written."""
+        film_index = {id(film): i for i, film in enumerate(self.films)}
+        cinema_index = {id(cinema): i for i, cinema in enumerate(self.cinemas)}
+
+        data = {
+            'fetched_at': dt.datetime.now().isoformat(),
+            'url': url,
+            'num_pages': num_pages,
+            'validators': validators,
+            'cinemas': [[cinema.name, cinema.address, *cinema.loc.xy] for cinema in self.cinemas],
+            'films': [[film.title, film.genres, film.directors, film.actors] for film in self.films],
+            'projections': [[film_index[id(proj.film)], cinema_index[id(proj.cinema)], proj.start_time.isoformat(),
+                             proj.end_time.isoformat(), proj.language] for proj in self.projections]}
+
+        with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(filename + '.tmp', filename)
+
+    def load_snapshot(self, cached: dict) -> None:
+        """ Reads the cinemas, films and projections of a snapshot, leaving out the projections that have already started."""
+        self.invalidate_indexes()
+        self.cinemas = [Cinema(name, address, Coord(x, y)) for name, address, x, y in cached['cinemas']]
+        self.films = [Film(*attrs) for attrs in cached['films']]
+        self.projections = []
+
+        now = dt.datetime.now()
+        for film_index, cinema_index, start, end, language in cached['projections']:
+            start_time = dt.datetime.fromisoformat(start)
+            if start_time < now:
+                continue  # the film has already been projected
+            self.add_projection(Projection(self.films[film_index], self.cinemas[cinema_index], start_time,
+                                           dt.datetime.fromisoformat(end), language))
+
+    def add_projection(self, projection: Projection) -> None:
+        """ Adds the projection to the billboard and to its film and cinema."""
+        self.projections.append(projection)
+        projection.film.projections.append(projection)
+        projection.cinema.projections.append(projection)
+        self.invalidate_indexes()
+
+    def invalidate_indexes(self) -> None:
+        """ Discards the indexes built over the billboard, so that they are built again the next time they are used."""
+        self.__dict__.pop('search_index', None)
+        self.__dict__.pop('time_index', None)
+
+    @cached_property
+    def search_index(self) -> SearchIndex:
+        """ Returns the index used to search the films and projections, built the first time it is needed."""
+        return SearchIndex(self.films, self.projections)
+
+    @cached_property
+    def time_index(self) -> TimeIndex:
+        """ Returns the projections sorted by start time, built the first time it is needed."""
+        return TimeIndex(self.projections)
+
+    def projections_between(self, start: dt.datetime, end: dt.datetime, cinema: Cinema | None = None,
+                            film: Film | None = None) -> list[Projection]:
+        """ Returns the projections that start from start until before end, of the given cinema and film if any,
+        sorted by start time."""
+        return self.time_index.between(start, end, cinema, film)
+
+    def count_projections_between(self, start: dt.datetime, end: dt.datetime, cinema: Cinema | None = None,
+                                  film: Film | None = None) -> int:
+        """ Returns the number of projections that start from start until before end, of the given cinema and film if any."""
+        return self.time_index.count_between(start, end, cinema, film)
+
+    def next_projections(self, n: int, cinema: Cinema | None = None, film: Film | None = None) -> list[Projection]:
+        """ Returns the first n projections that haven't started yet, of the given cinema and film if any."""
+        return self.time_index.between(dt.datetime.now(), dt.datetime.max, cinema, film, n)
 
     def read_cinemas(self, soup: BeautifulSoup) -> None:
-        """ Reads all the cinemas in the soup."""
+        """ Reads all the cinemas in the soup and adds them to the billboard."""
         def get_text(x) -> str: return x.text.strip()
 
         cinema_names = [get_text(name)
@@ -88,15 +222,15 @@ class Billboard:
         addresses = [get_text(addr) for addr in soup.find_all(
             'span', class_='lighten') if get_text(addr)[-2:] != 'Km']
 
-        f = open('coord_cines.json', encoding='utf-8')
-        cinema_coords = json.load(f)
+        with open('coord_cines.json', encoding='utf-8') as f:
+            cinema_coords = json.load(f)
 
-        self.cinemas = [Cinema(name, addr, Coord(*cinema_coords[name].values()))
-                        for (name, addr) in zip(cinema_names, addresses) if name in cinema_coords]
+        self.cinemas += [Cinema(name, addr, Coord(*cinema_coords[name].values()))
+                         for (name, addr) in zip(cinema_names, addresses) if name in cinema_coords]
 
     def read_films_and_projections(self, soup: BeautifulSoup, cinema_dict: dict[str, Cinema]) -> None:
-        """ Reads all the films and projections in the soup."""
-        film_titles: dict[str, Film] = {}
+        """ Reads all the films and projections in the soup and adds them to the billboard."""
+        film_titles = {film.title: film for film in self.films}
 
         movie_segments = soup.find_all('div', class_='item_resa')
         for movie_segment in movie_segments:
@@ -151,23 +285,198 @@ class Billboard:
             if start_time > end_time:
                 end_time += dt.timedelta(days=1)
 
-            projection = Projection(
-                film, cinema, start_time, end_time, language)
-            self.projections.append(projection)
-            film.projections.append(projection)
-            cinema.projections.append(projection)
+            self.add_projection(Projection(
+                film, cinema, start_time, end_time, language))
 
     def search_film_title(self, title: str) -> list[Film]:
         """Returns films whose title contains substring title."""
-        return [film for film in self.films if lower_ASCII(title) in lower_ASCII(film.title)]
+        return [self.films[i] for i in sorted(self.search_index.search_films(title))]
 
     def search_projections(self, title='', cinema_name='', genre='', director='', actor='') -> list[Projection]:
-        return [projection for projection in self.projections
-                if lower_ASCII(title) in lower_ASCII(projection.film.title)
-                and lower_ASCII(cinema_name) in lower_ASCII(projection.cinema.name)
-                and is_str_in_any(genre, projection.film.genres)
-                and is_str_in_any(director, projection.film.directors)
-                and is_str_in_any(actor, projection.film.actors)]
+        """Returns the projections whose film title and cinema name contain the given substrings, and whose film has
+        some genre, director and actor containing the given ones. Case and accents are ignored."""
+        ids = self.search_index.search_projections(title, cinema_name, genre, director, actor)
+        return [self.projections[i] for i in sorted(ids)]
+
+
+class TextIndex:
+    """Index of the trigrams of a list of normalized strings, which finds the strings that contain a substring
+    by intersecting the strings that contain each of its trigrams instead of looking at all of them."""
+
+    def __init__(self, strings: list[str]) -> None:
+        self.strings = strings
+        self.postings: dict[str, set[int]] = {}
+        for i, string in enumerate(strings):
+            for gram in grams(string):
+                self.postings.setdefault(gram, set()).add(i)
+
+    def search(self, query: str) -> set[int]:
+        """Returns the positions of the strings that contain the normalized query."""
+        if len(query) < GRAM:
+            return {i for i, string in enumerate(self.strings) if query in string}
+
+        postings = sorted((self.postings.get(gram, set()) for gram in grams(query)), key=len)
+        candidates = postings[0].intersection(*postings[1:])
+        # all the trigrams of the query being in a string doesn't mean that the query is
+        return {i for i in candidates if query in self.strings[i]}
+
+
+class TimeIndex:
+    """Projections sorted by start time, all together and for each cinema and film, so that the ones in a time window
+    are found with a binary search. Each group keeps the start times apart in order to bisect them."""
+
+    def __init__(self, projections: list[Projection]) -> None:
+        self.groups: dict[int | None, tuple[list[dt.datetime], list[Projection]]] = {None: ([], [])}
+        for projection in sorted(projections, key=operator.attrgetter('start_time')):
+            for key in (None, id(projection.cinema), id(projection.film)):
+                times, group = self.groups.setdefault(key, ([], []))
+                times.append(projection.start_time)
+                group.append(projection)
+
+    def window(self, start: dt.datetime, end: dt.datetime, cinema: Cinema | None,
+               film: Film | None) -> tuple[list[Projection], int, int]:
+        """Returns the smallest group containing the projections of the cinema and film, and the positions where the
+        ones in the time window begin and end. If both are given, the group still has projections of other ones."""
+        keys = [id(x) for x in (film, cinema) if x is not None] or [None]
+        times, group = min((self.groups.get(key, ([], [])) for key in keys), key=lambda g: len(g[1]))
+        return group, bisect_left(times, start), bisect_left(times, end)
+
+    def between(self, start: dt.datetime, end: dt.datetime, cinema: Cinema | None = None, film: Film | None = None,
+                limit: int | None = None) -> list[Projection]:
+        """Returns the first limit projections (all by default) of the cinema and film in the time window."""
+        group, lo, hi = self.window(start, end, cinema, film)
+        if cinema is None or film is None:
+            return group[lo:hi if limit is None else min(hi, lo + limit)]
+        selected = [proj for proj in group[lo:hi] if proj.cinema is cinema and proj.film is film]
+        return selected[:limit]
+
+    def count_between(self, start: dt.datetime, end: dt.datetime, cinema: Cinema | None = None,
+                      film: Film | None = None) -> int:
+        """Returns the number of projections of the cinema and film in the time window."""
+        group, lo, hi = self.window(start, end, cinema, film)
+        if cinema is None or film is None:
+            return hi - lo
+        return sum(1 for proj in group[lo:hi] if proj.cinema is cinema and proj.film is film)
+
+
+class SearchIndex:
+    """Normalized titles, cinema names, genres, directors and actors of a billboard, indexed by their trigrams.
+    Films and projections are identified by their position in the lists of the billboard."""
+
+    def __init__(self, films: list[Film], projections: list[Projection]) -> None:
+        self.titles = TextIndex([lower_ASCII(film.title) for film in films])
+        film_ids = {id(film): i for i, film in enumerate(films)}
+
+        # film id -> projection ids, and each normalized value of the other fields -> film or projection ids
+        self.film_projections: dict[int, list[int]] = {}
+        self.values: dict[str, tuple[TextIndex, list[set[int]]]] = {}
+        values: dict[str, dict[str, set[int]]] = {field: {} for field in ('cinema', 'genre', 'director', 'actor')}
+
+        for i, film in enumerate(films):
+            for field, strings in (('genre', film.genres), ('director', film.directors), ('actor', film.actors)):
+                for string in strings:
+                    values[field].setdefault(lower_ASCII(string), set()).add(i)
+
+        for i, projection in enumerate(projections):
+            self.film_projections.setdefault(film_ids[id(projection.film)], []).append(i)
+            values['cinema'].setdefault(lower_ASCII(projection.cinema.name), set()).add(i)
+
+        for field, ids in values.items():
+            self.values[field] = (TextIndex(list(ids)), list(ids.values()))
+
+    def matching(self, field: str, query: str) -> set[int]:
+        """Returns the films (or projections, for the cinema field) with some value of the field containing the query."""
+        index, ids = self.values[field]
+        return set().union(*(ids[i] for i in index.search(lower_ASCII(query))))
+
+    def search_films(self, title: str) -> set[int]:
+        """Returns the films whose title contains the given substring."""
+        return self.titles.search(lower_ASCII(title))
+
+    def search_projections(self, title: str, cinema_name: str, genre: str, director: str, actor: str) -> set[int]:
+        """Returns the projections that match all the given substrings."""
+        films = self.search_films(title)
+        for field, query in (('genre', genre), ('director', director), ('actor', actor)):
+            if not films:
+                break
+            films &= self.matching(field, query)
+
+        projections = {i for film in films for i in self.film_projections.get(film, [])}
+        if cinema_name and projections:
+            projections &= self.matching('cinema', cinema_name)
+        return projections
+
+
+def fetch_pages(url: str, num_pages: int, headers: list[dict[str, str]] | None = None) -> list[requests.Response]:
+    """Downloads concurrently the pages 1 to num_pages of the url, and returns the responses in order."""
+    return list(iter_pages(url, num_pages, headers))
+
+
+def iter_pages(url: str, num_pages: int, headers: list[dict[str, str]] | None = None) -> Iterator[requests.Response]:
+    """Downloads concurrently the pages 1 to num_pages of the url, using a single session with keep-alive connections,
+    and yields each response, in order, as soon as it has arrived. Each page can be requested with its own extra headers."""
+    if headers is None:
+        headers = [{}] * num_pages
+
+    with requests.Session() as session:
+        adapter = HTTPAdapter(pool_maxsize=max(num_pages, 1))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        with ThreadPoolExecutor(max_workers=max(num_pages, 1)) as executor:
+            yield from executor.map(lambda i: fetch_page(session, url + str(i), headers[i - 1]), range(1, num_pages + 1))
+
+
+@stage('billboard.parse')
+def parse_page(content: bytes) -> BeautifulSoup:
+    """Parses a page of the billboard, building only the parts of it that are read."""
+    return BeautifulSoup(content, 'html.parser', parse_only=PAGE_STRAINER)
+
+
+@stage('billboard.fetch')
+def fetch_page(session: requests.Session, url: str, headers: dict[str, str] | None = None) -> requests.Response:
+    """Returns the response of the webpage, which is either its content or 'not modified' (304). If the request fails,
+    it is retried a few times waiting longer and longer between them, and if it never succeeds PageNotFound is raised."""
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt > 0:
+            print("No s'ha pogut obtenir la informació de la pàgina web. S'està tornant a intentar...")
+            time.sleep(BACKOFF * 2 ** (attempt - 1))
+        try:
+            response = session.get(url, headers=headers, timeout=TIMEOUT)
+            if response.status_code in (200, 304):
+                return response
+        except requests.RequestException:
+            pass
+
+    raise PageNotFound(url)
+
+
+def conditional_headers(validator: dict[str, str | None]) -> dict[str, str]:
+    """Returns the headers that ask for a page only if it has changed since it had the given ETag and Last-Modified."""
+    headers = {}
+    if validator.get('etag'):
+        headers['If-None-Match'] = validator['etag']
+    if validator.get('last_modified'):
+        headers['If-Modified-Since'] = validator['last_modified']
+    return headers
+
+
+def read_snapshot(filename: str, url: str = BILLBOARD_URL, num_pages: int = NUM_PAGES) -> dict | None:
+    """Returns the contents of a billboard snapshot, or None if there is no valid snapshot in the file or it was read
+    from another url or number of pages."""
+    try:
+        with open(filename, encoding='utf-8') as f:
+            cached = json.load(f)
+        cached['fetched_at'] = dt.datetime.fromisoformat(cached['fetched_at'])
+        same_pages = cached['url'] == url and cached['num_pages'] == num_pages and len(cached['validators']) == num_pages
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return cached if same_pages else None
+
+
+def grams(string: str) -> set[str]:
+    """Returns all the substrings of length GRAM of the string."""
+    return {string[i:i + GRAM] for i in range(len(string) - GRAM + 1)}
 
 
 def is_str_in_any(string: str, str_list: list[str]) -> bool:
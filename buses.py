@@ -1,21 +1,34 @@
+import hashlib
 import json
 import os
+import time
+from collections.abc import Sequence
 from dataclasses import dataclass
-from itertools import pairwise  # <=> pairwise(list) = zip(list, list[1:])
+from functools import cached_property
 from typing import Iterator
 
 import haversine as hs
 import matplotlib.pyplot as plt
 import networkx as nx
+import numpy as np
 import osmnx as ox
 import requests
-import staticmap
+
+from metrics import stage
+from osm import PLACE, find_extract, graph_from_extract
+from render import save_graph_image
+from routing import dijkstra_many, from_networkx, route_nodes
+from spatial import build_index
 
 BusesGraph = nx.DiGraph
 RoadGraph = nx.DiGraph
 
 BUS_SPEED = 5  # average speed (m/s) of a bus
 BUS_STOP_TIME = 10  # waiting time (s) of a bus in a stop
+ROAD_GRAPH_FILE = 'road.graphml'  # road graph used to build the bus edges, kept so that they can be updated later
+BUSES_CACHE_FILE = 'buses_cache.json'  # hash of each line and road path of each pair of road nodes already used
+BUS_DATA_FILE = 'data_bus.json'  # data of the bus lines, as downloaded
+BUS_DATA_CACHE_FILE = 'data_bus.npz'  # the same data stored column by column, read instead of the json
 
 
 class PageNotFound(Exception):
@@ -84,41 +97,156 @@ def get_data() -> None:
             raise PageNotFound
         data = request.json()
 
-        with open('data_bus.json', 'w') as f:
-            json.dump(data, f, indent=4)
+        with open(BUS_DATA_FILE, 'w') as f:
+            json.dump(data, f)
 
     except PageNotFound:
         print("No s'ha pogut obtenir la informació de la pàgina web dels busos. S'està tornant a intentar...")
         return get_data()
 
 
+@dataclass(frozen=True)
+class BusData:
+    """The stops of all the bus lines, stored column by column. The stops of line i are the ones from
+    line_offsets[i] to line_offsets[i+1], and the names of the stops and lines are positions in the names table."""
+    stop_id: np.ndarray  # int64, CodAMB of each stop
+    stop_x: np.ndarray  # float64, longitude (UTM_Y in the json) of each stop
+    stop_y: np.ndarray  # float64, latitude (UTM_X in the json) of each stop
+    stop_name: np.ndarray  # int32
+    line_offsets: np.ndarray  # int64 array of length lines + 1
+    line_name: np.ndarray  # int32
+    line_hash: np.ndarray  # hash of the data of each line, which changes whenever anything of the line changes
+    names: np.ndarray
+    source: np.ndarray  # int64 [size, modification time (ns)] of the json file the data was read from
+
+    @cached_property
+    def lists(self) -> dict[str, list]:
+        """Returns the columns as python lists, which are faster to read one element at a time."""
+        return {name: getattr(self, name).tolist() for name in ('stop_id', 'stop_x', 'stop_y', 'stop_name', 'names')}
+
+    def line_names(self) -> list[str]:
+        """Returns the names of the lines, in the order of the json file."""
+        names = self.lists['names']
+        return [names[i] for i in self.line_name.tolist()]
+
+    def lines(self) -> dict[str, list['LineStops']]:
+        """Returns the stops of each line, which are only built when they are read. Each name has the list of all the
+        lines of the json file with that name, since a few of them appear more than once with different stops."""
+        lines: dict[str, list[LineStops]] = {}
+        for i, name in enumerate(self.line_names()):
+            lines.setdefault(name, []).append(LineStops(self, i))
+        return lines
+
+    def line_hashes(self) -> dict[str, str]:
+        """Returns a hash of the data of each line name, which changes whenever anything of any of its lines changes."""
+        hashes: dict[str, list[str]] = {}
+        for name, line_hash in zip(self.line_names(), self.line_hash.tolist()):
+            hashes.setdefault(name, []).append(line_hash)
+        return {name: line_hashes[0] if len(line_hashes) == 1 else
+                hashlib.sha256(''.join(line_hashes).encode('utf-8')).hexdigest()
+                for name, line_hashes in hashes.items()}
+
+
+class LineStops(Sequence):
+    """The stops of a line of the bus data, built as Parada objects when they are read."""
+
+    def __init__(self, data: BusData, line: int) -> None:
+        self.data = data
+        self.linia = data.lists['names'][int(data.line_name[line])]
+        self.first = int(data.line_offsets[line])
+        self.last = int(data.line_offsets[line + 1])
+
+    def __len__(self) -> int:
+        return self.last - self.first
+
+    def __getitem__(self, i: int | slice) -> Parada | list[Parada]:
+        if isinstance(i, slice):
+            return [self.parada(self.first + k) for k in range(*i.indices(len(self)))]
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        return self.parada(self.first + i % len(self))
+
+    def parada(self, k: int) -> Parada:
+        """Returns the k-th stop of the bus data."""
+        lists = self.data.lists
+        return Parada(lists['stop_id'][k], Coord(lists['stop_x'][k], lists['stop_y'][k]),
+                      nom=lists['names'][lists['stop_name'][k]], linia=self.linia)
+
+
+def get_bus_data() -> BusData:
+    """Returns the data of the bus lines, read from the columnar cache. The cache is created from the json file
+    (which is downloaded if needed) the first time, and again whenever the json file changes."""
+
+    if not os.path.exists(BUS_DATA_FILE) or os.path.getsize(BUS_DATA_FILE) == 0:
+        get_data()
+
+    stat = os.stat(BUS_DATA_FILE)
+    source = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    if os.path.exists(BUS_DATA_CACHE_FILE):
+        with np.load(BUS_DATA_CACHE_FILE) as arrays:
+            if np.array_equal(arrays['source'], source):
+                return BusData(**{name: arrays[name] for name in BusData.__dataclass_fields__})
+
+    data = read_bus_json(BUS_DATA_FILE, source)
+    # written aside and then renamed, so that a half written cache is never read
+    with open(BUS_DATA_CACHE_FILE + '.tmp', 'wb') as f:
+        np.savez(f, **{name: getattr(data, name) for name in data.__dataclass_fields__})
+    os.replace(BUS_DATA_CACHE_FILE + '.tmp', BUS_DATA_CACHE_FILE)
+    return data
+
+
+def read_bus_json(filename: str, source: np.ndarray) -> BusData:
+    """Reads the json file with the data of the bus lines and returns it column by column."""
+    with open(filename) as f:
+        data = json.load(f)
+
+    names: dict[str, int] = {}
+    stop_id, stop_x, stop_y, stop_name = [], [], [], []
+    line_offsets, line_name, line_hash = [0], [], []
+    for linia in data['ObtenirDadesAMBResult']['Linies']['Linia']:
+        for elem in linia['Parades']['Parada']:
+            stop_id.append(int(elem['CodAMB']))
+            stop_x.append(float(elem['UTM_Y']))
+            stop_y.append(float(elem['UTM_X']))
+            stop_name.append(names.setdefault(elem['Nom'], len(names)))
+        line_offsets.append(len(stop_id))
+        line_name.append(names.setdefault(linia['Nom'], len(names)))
+        line_hash.append(hashlib.sha256(json.dumps(linia, sort_keys=True).encode('utf-8')).hexdigest())
+
+    return BusData(np.array(stop_id, dtype=np.int64), np.array(stop_x, dtype=np.float64),
+                   np.array(stop_y, dtype=np.float64), np.array(stop_name, dtype=np.int32),
+                   np.array(line_offsets, dtype=np.int64), np.array(line_name, dtype=np.int32),
+                   np.array(line_hash, dtype=str), np.array(list(names), dtype=str), source)
+
+
+def get_lines() -> tuple[dict[str, list[LineStops]], dict[str, str], dict[str, tuple[int]]]:
+    """Returns the stops of each line in the bus data (a list, in case several lines have the same name), a hash of
+    the data of each line (which changes whenever anything of the line changes), and a dictionary with a random
+    color associated to each line."""
+    data = get_bus_data()
+    colors_dict = {linia: line_color(linia) for linia in data.line_names()}
+    return data.lines(), data.line_hashes(), colors_dict
+
+
 def get_orig_dest_parades() -> tuple[set[Parada], list[Parada], list[Parada], dict[str, tuple[int]]]:
     """Returns a set of all the bus stops in the data_bus json file, a list of all the stops that are the start (origin) of one edge,
     a list of all the stops that are at the end (destination) of one edge, and a dicitonary with a random color associated to each line."""
+    lines, _, colors_dict = get_lines()
+    return orig_dest_parades(lines) + (colors_dict,)
 
-    if not os.path.exists('data_bus.json') or os.path.getsize('data_bus.json') == 0:
-        get_data()
-
-    f = open('data_bus.json')
-    data = json.load(f)
 
+def orig_dest_parades(lines: dict[str, list[Sequence[Parada]]]) -> tuple[set[Parada], list[Parada], list[Parada]]:
+    """Returns a set of all the stops of the given lines, and the lists of the origin and destination stops of their edges."""
     parades_set = set()
     orig_parades = []
     dest_parades = []
-
-    for linia in data['ObtenirDadesAMBResult']['Linies']['Linia']:
-        def get_parada(elem): return Parada(int(elem['CodAMB']), Coord(
-            elem['UTM_Y'], elem['UTM_X']), nom=elem['Nom'], linia=linia['Nom'])
-        parades = [get_parada(elem) for elem in linia['Parades']['Parada']]
-
-        parades_set |= set(parades)
-        orig_parades.extend(list(parades)[:-1])
-        dest_parades.extend(list(parades)[1:])
-
-    colors_gen = generate_colors()
-    colors_dict = {linia['Nom']: next(
-        colors_gen) for linia in data['ObtenirDadesAMBResult']['Linies']['Linia']}
-    return parades_set, orig_parades, dest_parades, colors_dict
+    for same_name in lines.values():
+        for parades in same_name:
+            parades = list(parades)
+            parades_set |= set(parades)
+            orig_parades.extend(parades[:-1])
+            dest_parades.extend(parades[1:])
+    return parades_set, orig_parades, dest_parades
 
 
 def generate_colors() -> Iterator[tuple[int]]:
@@ -132,37 +260,163 @@ def generate_colors() -> Iterator[tuple[int]]:
         i += 1
 
 
+def line_color(linia: str) -> tuple[int]:
+    """Returns an apparently random color for the line, which only depends on its name, so that the colors of the
+    other lines don't change when a line appears or disappears."""
+    digest = hashlib.sha256(linia.encode('utf-8')).digest()
+    return (digest[0], digest[1], digest[2])
+
+
+def get_road_graph() -> RoadGraph:
+    """Returns the graph of the roads of Barcelona, which is built the first time (from the local OSM extract if there
+    is one, or else downloading it) and then read from a file."""
+    if os.path.exists(ROAD_GRAPH_FILE):
+        return ox.load_graphml(ROAD_GRAPH_FILE)
+    extract = find_extract()
+    if extract is not None:
+        road_graph = graph_from_extract(extract, 'drive')
+    else:
+        road_graph = ox.graph_from_place(PLACE, network_type='drive', simplify=True)
+    ox.save_graphml(road_graph, ROAD_GRAPH_FILE)
+    return road_graph
+
+
 def get_buses_graph() -> BusesGraph:
     """Loads the json file of the data, and returns the graph with bus stops as nodes and the distance between them as edges.
-    It correctly Sets the distance and path from to bus stops to be the distance and path following the shortest road there is."""
+    It correctly Sets the distance and path from to bus stops to be the distance and path following the shortest road there is.
+    The hash and color of each line and the road paths found are saved, so that the graph can be updated with
+    update_buses_graph."""
+
+    lines, hashes, colors_dict = get_lines()
+    segments: dict[tuple[int, int], list[int] | None] = {}
+    buses_graph = build_lines(get_road_graph(), lines, colors_dict, segments)
+    save_buses_cache(hashes, colors_dict, segments)
+    return buses_graph
 
-    parades_set, orig_parades, dest_parades, colors_dict = get_orig_dest_parades()
 
-    road_graph = ox.graph_from_place(
-        'Barcelona, Spain', network_type='drive', simplify=True)
+def changed_lines(hashes: dict[str, str], colors_dict: dict[str, tuple[int]]) \
+        -> tuple[set[str], set[str], dict[tuple[int, int], list[int] | None]]:
+    """Returns the lines of the json file that have changed (in their data or their color) or appeared, and the ones
+    that have disappeared, since the buses graph was built, together with the road paths already found. Only the
+    buses cache file is read, so nothing else needs to be loaded when no line has changed."""
+    if not os.path.exists(BUSES_CACHE_FILE):
+        # the graph was built before the lines were kept track of, so it is taken as built with the current ones
+        save_buses_cache(hashes, colors_dict, {})
+        return set(), set(), {}
+
+    old_hashes, old_colors, segments = load_buses_cache()
+    changed = {linia for linia in hashes
+               if old_hashes.get(linia) != hashes[linia] or old_colors.get(linia) != colors_dict[linia]}
+    return changed, set(old_hashes) - set(hashes), segments
+
+
+def update_buses_graph(buses_graph: BusesGraph, lines: dict[str, list[LineStops]], colors_dict: dict[str, tuple[int]],
+                       changed: set[str], removed: set[str], segments: dict[tuple[int, int], list[int] | None]) \
+        -> BusesGraph:
+    """Updates the buses graph, in place, with the lines found by changed_lines: the stops of the lines that have
+    changed or disappeared are removed, and the lines that have changed or appeared are built again, reusing the
+    road paths between pairs of road nodes already found (the new ones are added to segments).
+    Returns the graph of the lines added."""
+
+    old_parades = [parada for parada in buses_graph.nodes if parada.linia in changed | removed]
+    buses_graph.remove_nodes_from(old_parades)
+
+    new_lines = BusesGraph()
+    if changed:
+        new_lines = build_lines(get_road_graph(), {linia: lines[linia] for linia in changed}, colors_dict, segments)
+    buses_graph.add_edges_from(new_lines.edges(data=True))
+
+    print(f"{len(changed)} línies noves o modificades i {len(removed)} eliminades: "
+          f"{len(old_parades)} parades tretes i {new_lines.number_of_nodes()} afegides.")
+    return new_lines
+
+
+def build_lines(road_graph: RoadGraph, lines: dict[str, list[Sequence[Parada]]], colors_dict: dict[str, tuple[int]],
+                segments: dict[tuple[int, int], list[int] | None]) -> BusesGraph:
+    """Returns the graph of the given lines. The road paths between pairs of road nodes are taken from segments,
+    and the ones that are not there are found and added to it."""
+
+    parades_set, orig_parades, dest_parades = orig_dest_parades(lines)
 
     parades_x = [p.coord.x for p in parades_set]
     parades_y = [p.coord.y for p in parades_set]
-    nearest_nodes, nearest_dist = ox.distance.nearest_nodes(
-        road_graph, parades_x, parades_y, return_dist=True)
+    road_index = build_index(list(road_graph.nodes), [x for _, x in road_graph.nodes(data='x')],
+                             [y for _, y in road_graph.nodes(data='y')])
+    nearest_nodes, nearest_dist = road_index.nearest(parades_x, parades_y)
 
     nearest_node_of = {parada: (nearest_node, dist_to_nearest) for parada, nearest_node, dist_to_nearest in
-                       zip(parades_set, nearest_nodes, nearest_dist)}
+                       zip(parades_set, nearest_nodes[:, 0].tolist(), nearest_dist[:, 0].tolist())}
 
     orig_nodes = [nearest_node_of[p][0] for p in orig_parades]
     dest_nodes = [nearest_node_of[p][0] for p in dest_parades]
-    shortests_paths = ox.distance.shortest_path(
-        road_graph, orig_nodes, dest_nodes, cpus=None)
-
-    return build_buses_graph(road_graph, orig_parades, dest_parades, nearest_node_of, shortests_paths, colors_dict)
+    missing = [(orig, dest) for orig, dest in zip(orig_nodes, dest_nodes) if (orig, dest) not in segments]
+    if missing:
+        paths = road_shortest_paths(road_graph, *map(list, zip(*missing)), verbose=True)
+        segments.update(zip(missing, paths))
+    shortests_paths = [segments[orig, dest] for orig, dest in zip(orig_nodes, dest_nodes)]
+
+    return build_buses_graph(road_graph, orig_parades, dest_parades, nearest_node_of, shortests_paths, colors_dict,
+                             verbose=True)
+
+
+def save_buses_cache(hashes: dict[str, str], colors_dict: dict[str, tuple[int]],
+                     segments: dict[tuple[int, int], list[int] | None]) -> None:
+    """Saves the hash and color of each line and the road path between each pair of road nodes in the buses cache
+    file, replacing it at once so that it is never read half written."""
+    with open(BUSES_CACHE_FILE + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'lines': hashes, 'colors': colors_dict,
+                   'segments': [[orig, dest, path] for (orig, dest), path in segments.items()]}, f)
+    os.replace(BUSES_CACHE_FILE + '.tmp', BUSES_CACHE_FILE)
+
+
+def load_buses_cache() -> tuple[dict[str, str], dict[str, tuple[int]], dict[tuple[int, int], list[int] | None]]:
+    """Returns the hash and color of each line and the road paths saved in the buses cache file. The lines of a
+    file saved before their colors were kept have no color, so they are all taken as changed."""
+    with open(BUSES_CACHE_FILE, encoding='utf-8') as f:
+        cache = json.load(f)
+    colors = {linia: tuple(color) for linia, color in cache.get('colors', {}).items()}
+    return cache['lines'], colors, {(orig, dest): path for orig, dest, path in cache['segments']}
+
+
+def road_shortest_paths(road_graph: RoadGraph, orig_nodes: list[int], dest_nodes: list[int],
+                        verbose: bool = False) -> list[list[int] | None]:
+    """Returns the shortest path (by length) over the road graph from each origin node to its destination node, as
+    the list of road nodes it goes through, or None if there is no path. Lines share stops and streets, so repeated
+    pairs are only searched once, and all the destinations of an origin are found with a single search from it
+    that stops as soon as all of them have been reached."""
+    road_digraph = ox.utils_graph.get_digraph(road_graph, weight='length')  # the shortest of the parallel edges
+    coords = np.array([(data['x'], data['y']) for _, data in road_digraph.nodes(data=True)], dtype=np.float64)
+    graph = from_networkx(road_digraph, weight='length', coords=coords)
+
+    targets_of: dict[int, set[int]] = {}
+    for orig, dest in zip(orig_nodes, dest_nodes):
+        targets_of.setdefault(orig, set()).add(dest)
+
+    path_of: dict[tuple[int, int], list[int] | None] = {}
+    for orig, dests in targets_of.items():
+        src = graph.index[orig]
+        paths, _ = dijkstra_many(graph, src, [graph.index[dest] for dest in dests])
+        for dest in dests:
+            edges = paths[graph.index[dest]]
+            path_of[orig, dest] = None if edges is None else route_nodes(graph, src, edges)
+
+    if verbose:
+        print(f"{len(orig_nodes)} parelles de parades, {len(path_of)} parelles de nodes diferents: "
+              f"{len(targets_of)} cerques en comptes de {len(orig_nodes)} ({len(orig_nodes) - len(targets_of)} estalviades).")
+    return [path_of[orig, dest] for orig, dest in zip(orig_nodes, dest_nodes)]
 
 
 def build_buses_graph(road_graph: RoadGraph, orig_parades: list[Parada], dest_parades: list[Parada], nearest_node_of: dict[Parada, tuple[int, float]],
-                      shortests_paths: list[list[int]], colors_dict: Iterator[tuple[int]]) -> BusesGraph:
+                      shortests_paths: list[list[int]], colors_dict: Iterator[tuple[int]], verbose: bool = False) -> BusesGraph:
     """Builds and returns the bus graph from the given attributes, savindg the geometry of each bus edge as
-    the shortest path from the nearest nodes of the origin bus stop to the nearest nodes of destination bus stop"""
-
-    buses_graph = BusesGraph()
+    the shortest path from the nearest nodes of the origin bus stop to the nearest nodes of destination bus stop.
+    The points of all the edges are gathered in flat arrays, so that their lengths are computed all at once."""
+    start = time.perf_counter()
+
+    edges = []
+    X: list[float] = []
+    Y: list[float] = []
+    offsets = [0]  # the points of the k-th edge are the ones from offsets[k] to offsets[k+1]
     for orig_parada, dest_parada, path in zip(orig_parades, dest_parades, shortests_paths):
         if orig_parada == dest_parada:
             continue
@@ -171,18 +425,42 @@ def build_buses_graph(road_graph: RoadGraph, orig_parades: list[Parada], dest_pa
 
         if path is None:
             path = []
-        coord_list = [orig_parada.coord] + [Coord(road_graph.nodes[node]['x'],
-                                                  road_graph.nodes[node]['y']) for node in path] + [dest_parada.coord]
+        edges.append((orig_parada, dest_parada))
+        X.append(orig_parada.coord.x)
+        Y.append(orig_parada.coord.y)
+        for node in path:
+            X.append(road_graph.nodes[node]['x'])
+            Y.append(road_graph.nodes[node]['y'])
+        X.append(dest_parada.coord.x)
+        Y.append(dest_parada.coord.y)
+        offsets.append(len(X))
+
+    dists = edge_lengths(np.array(X), np.array(Y), np.array(offsets))
 
-        dist = sum(get_distance(coord1, coord2)
-                   for coord1, coord2 in pairwise(coord_list))
+    buses_graph = BusesGraph()
+    for (orig_parada, dest_parada), first, last, dist in zip(edges, offsets, offsets[1:], dists.tolist()):
+        coord_list = [Coord(x, y) for x, y in zip(X[first:last], Y[first:last])]
         bus = Bus(dist, coord_list, linia=orig_parada.linia)
         buses_graph.add_edge(orig_parada, dest_parada, time=BUS_STOP_TIME + dist/BUS_SPEED,
                              color=colors_dict[orig_parada.linia], info=bus)
 
+    if verbose:
+        print(f"Graf de busos creat en {time.perf_counter() - start:.2f}s: {len(edges)} arestes, {len(X)} punts.")
     return buses_graph
 
 
+def edge_lengths(X: np.ndarray, Y: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Returns the length (m) of each polyline, where the points of the k-th one are (X[i], Y[i]) for i from
+    offsets[k] to offsets[k+1], taking into account Earth's curvature."""
+    if len(offsets) < 2:
+        return np.zeros(0)
+    points = np.column_stack((Y, X))
+    segments = np.zeros(len(points))  # segments[i] goes from point i to point i+1
+    segments[:-1] = hs.haversine_vector(points[:-1], points[1:], unit=hs.Unit.METERS)
+    segments[offsets[1:] - 1] = 0  # the last point of each polyline isn't joined to the next one
+    return np.add.reduceat(segments, offsets[:-1])
+
+
 def get_distance(loc1: Coord, loc2: Coord) -> float:
     """Returns the distance between two points, taking into account Earth's curvature"""
     return hs.haversine((loc1.y, loc1.x), (loc2.y, loc2.x), unit=hs.Unit.METERS)
@@ -190,6 +468,8 @@ def get_distance(loc1: Coord, loc2: Coord) -> float:
 
 def show_buses(buses_graph: BusesGraph) -> None:
     """Shows the graph of the buses interactively."""
+    if not isinstance(buses_graph, nx.Graph):
+        buses_graph = buses_graph.to_networkx()
     positions = {parada: (parada.coord.x, parada.coord.y)
                  for parada in buses_graph.nodes}
 
@@ -199,14 +479,7 @@ def show_buses(buses_graph: BusesGraph) -> None:
     plt.show()
 
 
+@stage('plot_buses')
 def plot_buses(g: BusesGraph, nom_fitxer: str) -> None:
     """Saves the graph as an image with the background city map."""
-    m = staticmap.StaticMap(800, 600)
-
-    for _, _, attrs in g.edges(data=True):
-        color = '#%02x%02x%02x' % attrs['color']
-        coords = [(coord.x, coord.y) for coord in attrs['info'].coord_list]
-        m.add_line(staticmap.Line(coords, color, 1))
-
-    image = m.render()
-    image.save(nom_fitxer)
+    save_graph_image(g, nom_fitxer, 800, 600)
@@ -2,18 +2,30 @@
 from __future__ import annotations
 
 import datetime as dt
+import json
 import os
-import pickle
+import struct
+import weakref
+from collections.abc import Mapping, Sequence
 from dataclasses import dataclass
 from itertools import pairwise  # pairwise(list) = zip(list, list[1:])
-from typing import Iterable
+from typing import Any, Iterable, Iterator
 
 import matplotlib.pyplot as plt
 import networkx as nx
+import numpy as np
 import osmnx as ox
-import staticmap
+from PIL import Image
 
 from buses import *
+from contraction import ContractionHierarchy, ch_query
+from metrics import stage
+from osm import PLACE, find_extract, graph_from_extract
+from render import OverlayLine, OverlayMarker, overlay_map, save_graph_image
+from routing import (CompiledGraph, RouteCache, astar, compile_graph, dijkstra, dijkstra_many, edges_from,
+                     from_networkx, graph_version, path_sums, reverse_dijkstra, route_nodes)
+from spatial import SpatialIndex, build_index, load_index, save_index
+from transit import TransitNetwork, raptor
 
 OsmnxGraph = nx.MultiDiGraph
 StreetGraph = nx.Graph
@@ -22,6 +34,17 @@ CityGraph = nx.DiGraph
 WALKING_SPEED = 1.5  # average walking speed (m/s) of a person
 BUS_WAITING_TIME = 300  # waiting time (s) for the bus
 
+GRAPH_FILE_MAGIC = b'CINEBUS\0'
+GRAPH_FILE_VERSION = 2
+GRAPH_FILE_ALIGNMENT = 64  # every array in a graph file starts at a multiple of this many bytes
+ROUTE_CACHE_SIZE = 10000  # number of routes find_path remembers
+ROUTE_CACHE_FILE = 'rutes.npz'
+CINEMA_TABLE_FILES = ('.json', '_temps.npy', '_successors.npy', '_distancies.npy', '_caminant.npy')  # suffixes
+
+# node and edge kinds stored in the graph files
+CRUILLA, MULTIPARADA, PARADA = 1, 2, 3
+CARRER, TRANSBORD, BUS = 1, 2, 3
+
 
 @dataclass(frozen=True)
 class Cruilla(Node):
@@ -51,23 +74,309 @@ class Path:
     duration: dt.timedelta
     distance: float
     walking_distance: float
+    settled_nodes: int = 0  # number of nodes settled by the search that found the path
+
+
+@dataclass(frozen=True)
+class CinemaTables:
+    """Travel times from every node of the city graph to each cinema, together with the first edge of each of these
+    shortest paths so that the routes can be rebuilt. Rows are city graph node ids and columns are cinemas."""
+    names: list[str]
+    locations: list[Coord]
+    snap_distances: list[float]  # distance (m) from each cinema to its nearest street node
+    times: np.ndarray  # float32 (nodes x cinemas), time (s) from each node to each cinema's nearest node
+    successors: np.ndarray  # int32 (nodes x cinemas), first edge of the path from each node (-1 if there is none)
+    distances: np.ndarray  # float32 (nodes x cinemas), length (m) of the path from each node (inf if there is none)
+    walking_distances: np.ndarray  # float32 (nodes x cinemas), part (m) of it walked along the streets
+    version: str  # graph_version of the city graph the tables were computed from
+
+    def column(self, name: str) -> int:
+        """Returns the column of the cinema with the given name."""
+        return self.names.index(name)
 
 
 def get_osmnx_graph() -> OsmnxGraph:
-    """Gets the graph osmnx from Barcelona."""
-    return ox.graph_from_place('Barcelona, Spain', network_type='walk', simplify=True)
+    """Gets the graph osmnx from Barcelona, from the local OSM extract if there is one, or else downloading it."""
+    extract = find_extract()
+    if extract is not None:
+        return graph_from_extract(extract, 'walk')
+    return ox.graph_from_place(PLACE, network_type='walk', simplify=True)
+
+
+class StringTable(Sequence):
+    """Strings stored as utf-8 bytes one after the other. String i goes from offsets[i] to offsets[i+1]."""
+
+    def __init__(self, offsets: np.ndarray, data: np.ndarray) -> None:
+        self.offsets = offsets
+        self.data = data
+        self.cache: dict[int, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if i not in self.cache:
+            self.cache[i] = self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+        return self.cache[i]
+
+
+class NodeTable(Sequence):
+    """Side table of a graph file: builds the Cruilla, MultiParada or Parada with the given integer id when asked for it."""
+
+    def __init__(self, arrays: dict[str, np.ndarray], strings: StringTable) -> None:
+        self.kinds = arrays['node_kind']
+        self.ids = arrays['node_id']
+        self.coords = arrays['coords']
+        self.names = arrays['node_name']
+        self.linies = arrays['node_linia']
+        self.strings = strings
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def __getitem__(self, i: int) -> Node:
+        coord = Coord(*self.coords[i])
+        if self.kinds[i] == CRUILLA:
+            return Cruilla(int(self.ids[i]), coord)
+        nom = self.strings[self.names[i]]
+        if self.kinds[i] == MULTIPARADA:
+            return MultiParada(int(self.ids[i]), coord, nom=nom)
+        return Parada(int(self.ids[i]), coord, nom=nom, linia=self.strings[self.linies[i]])
+
+
+class NodeIndex(Mapping):
+    """Inverse of a NodeTable: finds the integer id of a node by binary search on the sorted node ids."""
+
+    def __init__(self, nodes: NodeTable, order: np.ndarray) -> None:
+        self.nodes = nodes
+        self.order = order  # integer ids sorted by node id
+        self.sorted_ids = nodes.ids[order]
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __iter__(self) -> Iterator[Node]:
+        return iter(self.nodes)
+
+    def __getitem__(self, node: Node) -> int:
+        start, end = np.searchsorted(self.sorted_ids, [node.id, node.id + 1])
+        for i in self.order[start:end].tolist():
+            if self.nodes[i] == node:
+                return i
+        raise KeyError(node)
+
+
+class EdgeTable(Sequence):
+    """Side table of a graph file: builds the attributes ('time', 'color' and 'info') of the edge with the given id."""
+
+    def __init__(self, arrays: dict[str, np.ndarray], strings: StringTable) -> None:
+        self.kinds = arrays['edge_kind']
+        self.times = arrays['weights']
+        self.distances = arrays['edge_distance']
+        self.colors = arrays['edge_color']
+        self.names = arrays['edge_name']
+        self.geometry_offsets = arrays['geometry_offsets']
+        self.geometry = arrays['geometry']
+        self.strings = strings
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def __getitem__(self, e: int) -> dict[str, Any]:
+        coords = self.geometry[self.geometry_offsets[e]:self.geometry_offsets[e + 1]].tolist()
+        coord_list = [Coord(x, y) for x, y in coords]
+        distancia = float(self.distances[e])
+        nom = self.strings[self.names[e]]
+
+        if self.kinds[e] == CARRER:
+            info = Carrer(distancia, coord_list, nom=nom)
+        elif self.kinds[e] == TRANSBORD:
+            info = Transbord(distancia, coord_list, nom=nom)
+        else:
+            info = Bus(distancia, coord_list, linia=nom)
+        return {'time': float(self.times[e]), 'color': tuple(self.colors[e].tolist()), 'info': info}
+
+
+def save_graph(graph: BusesGraph | CityGraph, filename: str) -> None:
+    """Saves the given graph in a versioned binary file made of aligned arrays, so that it can be memory-mapped."""
+    compiled = graph if isinstance(graph, CompiledGraph) else from_networkx(graph)
+    strings: dict[str, int] = {}
+
+    def intern(string: str) -> int:
+        """Returns the position of the string in the string table, adding it if needed."""
+        return strings.setdefault(string, len(strings))
+
+    node_kind = np.empty(len(compiled), dtype=np.uint8)
+    node_id = np.empty(len(compiled), dtype=np.int64)
+    node_name = np.full(len(compiled), -1, dtype=np.int32)
+    node_linia = np.full(len(compiled), -1, dtype=np.int32)
+    for i, node in enumerate(compiled.nodes):
+        node_id[i] = node.id
+        if isinstance(node, Parada):
+            node_kind[i] = PARADA
+            node_linia[i] = intern(node.linia)
+        elif isinstance(node, MultiParada):
+            node_kind[i] = MULTIPARADA
+        else:
+            node_kind[i] = CRUILLA
+        if isinstance(node, MultiParada):
+            node_name[i] = intern(node.nom)
+
+    num_edges = compiled.number_of_edges()
+    edge_kind = np.empty(num_edges, dtype=np.uint8)
+    edge_distance = np.empty(num_edges, dtype=np.float64)
+    edge_color = np.empty((num_edges, 3), dtype=np.uint8)
+    edge_name = np.empty(num_edges, dtype=np.int32)
+    geometry_offsets = np.zeros(num_edges + 1, dtype=np.int64)
+    geometry = []
+    for e, attrs in enumerate(compiled.edge_attrs):
+        info = attrs['info']
+        edge_kind[e] = CARRER if isinstance(info, Carrer) else TRANSBORD if isinstance(info, Transbord) else BUS
+        edge_distance[e] = info.distancia
+        edge_color[e] = attrs['color']
+        edge_name[e] = intern(info.linia if isinstance(info, Bus) else info.nom)
+        geometry.extend(coord.xy for coord in info.coord_list)
+        geometry_offsets[e + 1] = len(geometry)
+
+    encoded = [string.encode('utf-8') for string in strings]
+    string_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=string_offsets[1:])
+
+    arrays = {
+        'node_kind': node_kind, 'node_id': node_id, 'coords': compiled.coords, 'node_name': node_name,
+        'node_linia': node_linia, 'node_order': np.argsort(node_id, kind='stable'),
+        'offsets': compiled.offsets, 'targets': compiled.targets, 'weights': compiled.weights,
+        'edge_kind': edge_kind, 'edge_distance': edge_distance, 'edge_color': edge_color, 'edge_name': edge_name,
+        'geometry_offsets': geometry_offsets, 'geometry': np.array(geometry, dtype=np.float64).reshape(-1, 2),
+        'string_offsets': string_offsets, 'string_data': np.frombuffer(b''.join(encoded), dtype=np.uint8)}
+    write_arrays(arrays, filename, graph_version(compiled))
+
+
+def write_arrays(arrays: dict[str, np.ndarray], filename: str, version: str) -> None:
+    """Writes the arrays in a graph file: the magic bytes, the version and the length of the header, a json header
+    with the graph_version of the graph and the dtype, shape and position of each array, and the arrays themselves."""
+    header = {}
+    position = 0
+    for name, array in arrays.items():
+        header[name] = {'dtype': array.dtype.str, 'shape': array.shape, 'offset': position}
+        position += -(-array.nbytes // GRAPH_FILE_ALIGNMENT) * GRAPH_FILE_ALIGNMENT
+
+    header_bytes = json.dumps({'graph_version': version, 'arrays': header}).encode('utf-8')
+    prefix_size = len(GRAPH_FILE_MAGIC) + 8 + len(header_bytes)
+    start = -(-prefix_size // GRAPH_FILE_ALIGNMENT) * GRAPH_FILE_ALIGNMENT
+
+    # the file is written aside and then replaces the old one, which may still be memory-mapped
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(GRAPH_FILE_MAGIC + struct.pack('<II', GRAPH_FILE_VERSION, len(header_bytes)) + header_bytes)
+        for name, array in arrays.items():
+            f.seek(start + header[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(start + position)
+    os.replace(filename + '.tmp', filename)
+
+
+def read_arrays(filename: str) -> tuple[dict[str, np.ndarray], str]:
+    """Returns the arrays of a graph file as read-only views of the memory-mapped file, and the graph_version
+    of the graph, so that it doesn't need to be computed again."""
+    with open(filename, 'rb') as f:
+        magic = f.read(len(GRAPH_FILE_MAGIC))
+        version, header_size = struct.unpack('<II', f.read(8)) if magic == GRAPH_FILE_MAGIC else (None, 0)
+        if version != GRAPH_FILE_VERSION:
+            raise ValueError(f"{filename} no és un fitxer de graf de la versió {GRAPH_FILE_VERSION}.")
+        header = json.loads(f.read(header_size))
+
+    prefix_size = len(GRAPH_FILE_MAGIC) + 8 + header_size
+    start = -(-prefix_size // GRAPH_FILE_ALIGNMENT) * GRAPH_FILE_ALIGNMENT
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+
+    arrays = {}
+    for name, info in header['arrays'].items():
+        dtype = np.dtype(info['dtype'])
+        count = int(np.prod(info['shape']))
+        arrays[name] = np.frombuffer(data, dtype, count, start + info['offset']).reshape(info['shape'])
+    return arrays, header['graph_version']
+
+
+def load_graph(filename: str) -> CompiledGraph:
+    """Loads the graph in the file. The arrays are memory-mapped, so nothing is read until it is used,
+    and the nodes and edges are only built when they are asked for."""
+    arrays, version = read_arrays(filename)
+    strings = StringTable(arrays['string_offsets'], arrays['string_data'])
+    nodes = NodeTable(arrays, strings)
+
+    return CompiledGraph(nodes, arrays['offsets'], arrays['targets'], arrays['weights'], EdgeTable(arrays, strings),
+                         arrays['coords'], NodeIndex(nodes, arrays['node_order']), version)
+
+
+def is_graph_file(filename: str) -> bool:
+    """Checks if a file exists and it is a graph file of the current version."""
+    if not os.path.exists(filename):
+        return False
+    with open(filename, 'rb') as f:
+        prefix = f.read(len(GRAPH_FILE_MAGIC) + 4)
+    return prefix == GRAPH_FILE_MAGIC + struct.pack('<I', GRAPH_FILE_VERSION)
 
 
-def save_graph(graph: nx.Graph, filename: str) -> None:
-    """Saves the given graph in a file."""
-    with open(filename, 'wb') as f:
-        pickle.dump(graph, f)
+def nearest_cruilles(graph: OsmnxGraph | CompiledGraph, coords: list[Coord]) -> tuple[list[Cruilla], list[float]]:
+    """Returns the street intersection nearest to each of the coordinates and the distance (m) to it. The graph
+    can be either the osmnx graph or a compiled graph whose Cruilla nodes are the ones of the osmnx graph."""
+    X = [coord.x for coord in coords]
+    Y = [coord.y for coord in coords]
+    ids, dists = spatial_index(graph).nearest(X, Y)
+    ids, dists = ids[:, 0].tolist(), dists[:, 0].tolist()
 
+    if isinstance(graph, CompiledGraph):
+        return [graph.nodes[i] for i in ids], dists
+    return [Cruilla(id, Coord(graph.nodes[id]['x'], graph.nodes[id]['y'])) for id in ids], dists
 
-def load_graph(filename: str) -> nx.Graph:
-    """Loads the graph in the file."""
-    with open(filename, 'rb') as f:
-        return pickle.load(f)
+
+_spatial_indexes: weakref.WeakKeyDictionary[OsmnxGraph | CompiledGraph, SpatialIndex] = weakref.WeakKeyDictionary()
+
+
+def spatial_index(graph: OsmnxGraph | CompiledGraph, filename: str | None = None) -> SpatialIndex:
+    """Returns the spatial index of the street nodes of the graph: the Cruilla nodes of a compiled graph (by their
+    integer id) or all the nodes of the osmnx graph. If a filename is given, the index is read from it if it was
+    built for the same nodes and coordinates, and otherwise it is built and saved there. It is only built or read
+    once per graph."""
+    if graph not in _spatial_indexes:
+        if isinstance(graph, CompiledGraph):
+            ids = street_nodes(graph)
+            lon, lat = graph.coords[ids].T
+        else:
+            ids = np.fromiter(graph.nodes, dtype=np.int64, count=len(graph))
+            lon = np.fromiter((x for _, x in graph.nodes(data='x')), dtype=np.float64, count=len(graph))
+            lat = np.fromiter((y for _, y in graph.nodes(data='y')), dtype=np.float64, count=len(graph))
+
+        index = load_index(filename) if filename is not None and os.path.exists(filename) else None
+        if index is None or not same_points(index, ids, lon, lat):
+            index = build_index(ids, lon, lat)
+            if filename is not None:
+                save_index(index, filename)
+        _spatial_indexes[graph] = index
+    return _spatial_indexes[graph]
+
+
+_street_nodes: weakref.WeakKeyDictionary[CompiledGraph, np.ndarray] = weakref.WeakKeyDictionary()
+
+
+def street_nodes(graph: CompiledGraph) -> np.ndarray:
+    """Returns the integer ids of the Cruilla nodes of the compiled graph."""
+    if graph not in _street_nodes:
+        if isinstance(graph.nodes, NodeTable):
+            _street_nodes[graph] = np.flatnonzero(graph.nodes.kinds == CRUILLA)
+        else:
+            _street_nodes[graph] = np.array([i for i, node in enumerate(graph.nodes) if isinstance(node, Cruilla)],
+                                            dtype=np.int64)
+    return _street_nodes[graph]
+
+
+def same_points(index: SpatialIndex, ids: np.ndarray, lon: np.ndarray, lat: np.ndarray) -> bool:
+    """Checks if the spatial index has exactly the points with the given ids and coordinates."""
+    if len(index.ids) != len(ids):
+        return False
+    order, index_order = np.argsort(ids), np.argsort(index.ids)
+    return (np.array_equal(ids[order], index.ids[index_order]) and np.array_equal(lon[order], index.lon[index_order])
+            and np.array_equal(lat[order], index.lat[index_order]))
 
 
 def build_city_graph(osmnx_graph: OsmnxGraph, buses_graph: BusesGraph) -> CityGraph:
@@ -78,16 +387,17 @@ def build_city_graph(osmnx_graph: OsmnxGraph, buses_graph: BusesGraph) -> CityGr
 
     city_graph = street_graph.to_directed()
     city_graph.add_edges_from(buses_graph.edges(data=True))
+    connect_parades(city_graph, osmnx_graph, list(buses_graph.nodes))
+
+    return city_graph
 
-    X = [parada.coord.x for parada in buses_graph.nodes]
-    Y = [parada.coord.y for parada in buses_graph.nodes]
 
-    nearest_nodes, nearest_dist = ox.distance.nearest_nodes(
-        osmnx_graph, X, Y, return_dist=True)
+def connect_parades(city_graph: CityGraph, osmnx_graph: OsmnxGraph | CompiledGraph, parades: list[Parada]) -> None:
+    """Joins each of the bus stops to the city graph: to the MultiParada of its stop with Transbord edges, and the
+    MultiParada to the nearest street intersection with Carrer edges."""
+    cruilles, nearest_dist = nearest_cruilles(osmnx_graph, [parada.coord for parada in parades])
 
-    for id, dist, parada in zip(nearest_nodes, nearest_dist, buses_graph.nodes):
-        cruilla = Cruilla(
-            id, Coord(osmnx_graph.nodes[id]['x'], osmnx_graph.nodes[id]['y']))
+    for cruilla, dist, parada in zip(cruilles, nearest_dist, parades):
         multiparada = MultiParada(parada.id, parada.coord, nom=parada.nom)
         carrer = Carrer(
             dist, [cruilla.coord, multiparada.coord], nom=parada.nom)
@@ -101,7 +411,22 @@ def build_city_graph(osmnx_graph: OsmnxGraph, buses_graph: BusesGraph) -> CityGr
         city_graph.add_edge(parada, multiparada, time=0,
                             color=(0, 0, 0), info=transbord)
 
-    return city_graph
+
+def update_city_graph(city_graph: CityGraph, osmnx_graph: OsmnxGraph | CompiledGraph, lines: set[str],
+                      new_lines: BusesGraph) -> None:
+    """Updates the city graph, in place, with the changes made by update_buses_graph: the stops of the given lines are
+    removed, together with their MultiParada if no other line stops there anymore, and the new lines are added and
+    joined to the streets. The stops removed are the ones in the city graph, so that it is updated correctly even
+    if the buses graph was updated before and the city graph wasn't."""
+    old_parades = [node for node in city_graph.nodes if isinstance(node, Parada) and node.linia in lines]
+    city_graph.remove_nodes_from(old_parades)
+    for parada in old_parades:
+        multiparada = MultiParada(parada.id, parada.coord, nom=parada.nom)
+        if multiparada in city_graph and not any(isinstance(node, Parada) for node in city_graph.successors(multiparada)):
+            city_graph.remove_node(multiparada)
+
+    city_graph.add_edges_from(new_lines.edges(data=True))
+    connect_parades(city_graph, osmnx_graph, list(new_lines.nodes))
 
 
 def build_street_graph(osmnx_graph: OsmnxGraph) -> StreetGraph:
@@ -132,28 +457,160 @@ def build_street_graph(osmnx_graph: OsmnxGraph) -> StreetGraph:
 
 
 def build_and_save_graphs() -> None:
-    """Builds and saves all the graphs (osmnx, buses and barcelona) if they don't exist already."""
+    """Builds and saves all the graphs (osmnx, buses and barcelona) and the cinema tables if they don't exist already."""
 
     def file_exists_and_not_empty(filename: str) -> bool:
         """Checks if a file exists and it is not empty."""
         return os.path.exists(filename) and os.path.getsize(filename) > 0
 
-    if not file_exists_and_not_empty('osmnx.grf'):
+    if not file_exists_and_not_empty('osmnx.graphml'):
         print("S'està creant el graf osmnx.")
-        save_graph(get_osmnx_graph(), 'osmnx.grf')
+        with stage('graphs.osmnx'):
+            osmnx_graph = get_osmnx_graph()
+        with stage('graphs.save'):
+            ox.save_graphml(osmnx_graph, 'osmnx.graphml')
 
-    if not file_exists_and_not_empty('buses.grf'):
+    if not is_graph_file('buses.grf'):
         print("S'està creant el graf de busos.")
-        save_graph(get_buses_graph(), 'buses.grf')
-
-    if not file_exists_and_not_empty('barcelona.grf'):
-        city_graph = build_city_graph(load_graph(
-            'osmnx.grf'), load_graph('buses.grf'))
-        save_graph(city_graph, 'barcelona.grf')
-
-
-def show(graph: nx.Graph) -> None:
+        with stage('graphs.buses'):
+            buses_graph = get_buses_graph()
+        with stage('graphs.save'):
+            save_graph(buses_graph, 'buses.grf')
+
+    if is_graph_file('buses.grf') and is_graph_file('barcelona.grf'):
+        with stage('graphs.update'):
+            update_graphs()
+
+    if not is_graph_file('barcelona.grf'):
+        # the files computed from the old city graph don't correspond to the new one
+        remove_city_graph_files()
+        with stage('graphs.city'):
+            osmnx_graph = ox.load_graphml('osmnx.graphml')
+            spatial_index(osmnx_graph, 'osmnx.idx')
+            city_graph = build_city_graph(osmnx_graph, load_graph('buses.grf'))
+        with stage('graphs.save'):
+            save_graph(city_graph, 'barcelona.grf')
+
+    city_graph = load_graph('barcelona.grf')
+    if not all(file_exists_and_not_empty('cinemes' + suffix) for suffix in CINEMA_TABLE_FILES) or \
+            load_cinema_tables('cinemes').version != graph_version(city_graph):
+        print("S'estan calculant els temps fins als cinemes.")
+        with stage('graphs.cinema_tables'):
+            spatial_index(city_graph, 'barcelona.idx')
+            tables = build_cinema_tables(city_graph, city_graph, get_cinema_coords())
+        with stage('graphs.save'):
+            save_cinema_tables(tables, 'cinemes')
+
+
+def update_graphs() -> None:
+    """Updates the saved buses and city graphs with the bus lines that have changed in the json file since they were
+    built. The files computed from the city graph (the cinema tables and the contraction hierarchy) are removed,
+    since they don't correspond to it anymore, so that they are computed again. The graphs are only loaded if some
+    line has changed, and the buses cache is only saved once both graph files have been replaced, so that if the
+    update is interrupted it is done again the next time."""
+    lines, hashes, colors_dict = get_lines()
+    changed, removed, segments = changed_lines(hashes, colors_dict)
+    if not changed and not removed:
+        return
+
+    print("S'estan actualitzant els grafs de busos i de la ciutat.")
+    buses_graph = load_graph('buses.grf').to_networkx()
+    new_lines = update_buses_graph(buses_graph, lines, colors_dict, changed, removed, segments)
+    city_graph = load_graph('barcelona.grf').to_networkx()
+    osmnx_graph = ox.load_graphml('osmnx.graphml')
+    spatial_index(osmnx_graph, 'osmnx.idx')
+    update_city_graph(city_graph, osmnx_graph, changed | removed, new_lines)
+
+    save_graph(buses_graph, 'buses.grf')
+    save_graph(city_graph, 'barcelona.grf')
+    remove_city_graph_files()
+    save_buses_cache(hashes, colors_dict, segments)
+
+
+def remove_city_graph_files() -> None:
+    """Removes the files computed from the city graph (the cinema tables and the contraction hierarchy), so that they
+    are computed again from the new one."""
+    for filename in [f'cinemes{suffix}' for suffix in CINEMA_TABLE_FILES] + ['barcelona.ch']:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def get_cinema_coords() -> dict[str, Coord]:
+    """Returns the coordinates of every cinema in the coord_cines json file."""
+    with open('coord_cines.json', encoding='utf-8') as f:
+        return {name: Coord(*coords.values()) for name, coords in json.load(f).items()}
+
+
+def build_cinema_tables(snap_graph: OsmnxGraph | CompiledGraph, city_graph: CityGraph | CompiledGraph, cinemas: dict[str, Coord]) -> CinemaTables:
+    """Runs a backward search from each of the cinemas and stores the travel time from every node to them, and the
+    distance and walking distance of these paths."""
+    names = list(cinemas)
+    locations = list(cinemas.values())
+    cruilles, nearest_dist = nearest_cruilles(snap_graph, locations)
+
+    graph = compile_graph(city_graph)
+    targets = graph.targets
+    lengths = np.stack(edge_distances(graph), axis=1)
+    times = np.empty((len(graph), len(names)), dtype=np.float32)
+    successors = np.empty((len(graph), len(names)), dtype=np.int32)
+    distances = np.empty((len(graph), len(names)), dtype=np.float32)
+    walking_distances = np.empty((len(graph), len(names)), dtype=np.float32)
+
+    for column, cruilla in enumerate(cruilles):
+        times[:, column], successors[:, column] = reverse_dijkstra(graph, graph.index[cruilla])
+        sums = path_sums(successors[:, column], targets, lengths)
+        sums[np.isinf(times[:, column])] = np.inf
+        distances[:, column], walking_distances[:, column] = sums.T
+
+    return CinemaTables(names, locations, nearest_dist, times, successors, distances, walking_distances,
+                        graph_version(graph))
+
+
+def edge_distances(graph: CompiledGraph) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the distance (m) of each edge of the compiled city graph and the part of it that is walked (all of it
+    for the streets, none for the rest)."""
+    if isinstance(graph.edge_attrs, EdgeTable):
+        distances = np.asarray(graph.edge_attrs.distances, dtype=np.float64)
+        return distances, np.where(graph.edge_attrs.kinds == CARRER, distances, 0.0)
+    distances = np.array([attrs['info'].distancia for attrs in graph.edge_attrs], dtype=np.float64)
+    walked = np.array([isinstance(attrs['info'], Carrer) for attrs in graph.edge_attrs], dtype=bool)
+    return distances, np.where(walked, distances, 0.0)
+
+
+def save_cinema_tables(tables: CinemaTables, filename: str) -> None:
+    """Saves the cinema tables in the files filename.json, filename_temps.npy, filename_successors.npy,
+    filename_distancies.npy and filename_caminant.npy."""
+    info = {'names': tables.names,
+            'locations': [loc.xy for loc in tables.locations],
+            'snap_distances': tables.snap_distances,
+            'version': tables.version}
+    with open(filename + '.json', 'w', encoding='utf-8') as f:
+        json.dump(info, f, ensure_ascii=False)
+
+    np.save(filename + '_temps.npy', tables.times)
+    np.save(filename + '_successors.npy', tables.successors)
+    np.save(filename + '_distancies.npy', tables.distances)
+    np.save(filename + '_caminant.npy', tables.walking_distances)
+
+
+def load_cinema_tables(filename: str) -> CinemaTables:
+    """Loads the cinema tables saved with save_cinema_tables. The arrays are memory-mapped, not read. The tables
+    saved before their graph version was kept have none, so they don't correspond to any graph."""
+    with open(filename + '.json', encoding='utf-8') as f:
+        info = json.load(f)
+
+    return CinemaTables(info['names'], [Coord(*xy) for xy in info['locations']], info['snap_distances'],
+                        np.load(filename + '_temps.npy', mmap_mode='r'),
+                        np.load(filename + '_successors.npy', mmap_mode='r'),
+                        np.load(filename + '_distancies.npy', mmap_mode='r'),
+                        np.load(filename + '_caminant.npy', mmap_mode='r'),
+                        info.get('version', ''))
+
+
+def show(graph: nx.Graph | CompiledGraph) -> None:
     """Shows the graph's nodes and edges in a pop-up window."""
+    if isinstance(graph, CompiledGraph):
+        graph = graph.to_networkx()
     positions = {node: node.coord.xy for node in graph.nodes}
     colors = [[c/255 for c in col]
               for col in nx.get_edge_attributes(graph, 'color').values()]
@@ -162,72 +619,159 @@ def show(graph: nx.Graph) -> None:
     plt.show()
 
 
-def plot(graph: nx.Graph, nom_fitxer: str) -> None:
+@stage('plot')
+def plot(graph: nx.Graph | CompiledGraph, nom_fitxer: str) -> None:
     """Saves an image of the graph with the map of the city in the background."""
-    m = staticmap.StaticMap(800, 600)
+    save_graph_image(graph, nom_fitxer, 800, 600)
+
+
+route_cache = RouteCache(ROUTE_CACHE_SIZE)  # routes found by find_path, for all the graphs of the process
+
+
+@stage('find_path')
+def find_path(snap_graph: OsmnxGraph | CompiledGraph, city_graph: CityGraph | CompiledGraph, src: Coord, dst: Coord,
+              algorithm: str = 'dijkstra', hierarchy: ContractionHierarchy | None = None,
+              network: TransitNetwork | None = None) -> Path:
+    """Returns the shotest path to go from a source point to a destination point.
+    The algorithm used to search the city graph can be 'dijkstra', 'astar', 'ch' (which needs the contraction
+    hierarchy of the city graph) or 'raptor' (which needs the transit network of the city graph).
+    The routes found are kept in route_cache, so the search is skipped if the same nodes are asked for again.
+    The points are snapped to the nearest street intersection of snap_graph, which can be the osmnx graph or the
+    city graph itself, since its street nodes are the intersections of the osmnx graph."""
+
+    if algorithm not in ('dijkstra', 'astar', 'ch', 'raptor') or (algorithm == 'ch' and hierarchy is None) \
+            or (algorithm == 'raptor' and network is None):
+        raise ValueError(f"Unknown algorithm '{algorithm}' or missing contraction hierarchy or transit network.")
+
+    with stage('find_path.snap'):
+        (src_cruilla, dst_cruilla), (dist_start, dist_end) = nearest_cruilles(snap_graph, [src, dst])
+        graph = compile_graph(city_graph)
+        src_index = graph.index[src_cruilla]
+        dst_index = graph.index[dst_cruilla]
+
+    with stage('find_path.search'):
+        key = (src_index, dst_index, graph_version(graph))
+        edges = route_cache.get(key)
+        settled = 0
+        if edges is None:
+            if algorithm == 'dijkstra':
+                edges, settled = dijkstra(graph, src_index, dst_index)
+            elif algorithm == 'astar':
+                # buses are the fastest way to move, so the heuristic never overestimates the remaining time
+                edges, settled = astar(graph, src_index, dst_index, BUS_SPEED)
+            elif algorithm == 'ch':
+                edges, settled = ch_query(hierarchy, src_index, dst_index)
+            else:
+                if network.graph is not graph:
+                    raise ValueError("La xarxa de transport no correspon al graf de la ciutat.")
+                edges, settled = raptor(network, src_index, dst_index)
+
+            # the routes of the transit engine take at most MAX_ROUNDS buses, so they may not be the fastest ones and
+            # they are not given to others
+            if edges is not None and algorithm != 'raptor':
+                route_cache.put(key, edges)
+
+    if edges is None:
+        raise nx.NetworkXNoPath(f"No hi ha cap camí entre {src} i {dst}.")
+
+    with stage('find_path.path'):
+        return build_path(graph, src, dst, src_index, edges, dist_start, dist_end, settled)
+
+
+def check_cinema_tables(tables: CinemaTables, graph: CompiledGraph) -> None:
+    """Raises ValueError if the cinema tables weren't computed from the graph (or from one with the same nodes,
+    edges and times)."""
+    if tables.version != graph_version(graph):
+        raise ValueError("Les taules dels cinemes no corresponen al graf de la ciutat.")
 
-    for _, _, attrs in graph.edges(data=True):
-        if attrs['info'].coord_list == []:
-            continue
-        color = '#%02x%02x%02x' % attrs['color']
-        coords = [coord.xy for coord in attrs['info'].coord_list]
-        m.add_line(staticmap.Line(coords, color, 1))
 
-    image = m.render()
-    image.save(nom_fitxer)
+def find_paths_to_cinemas(snap_graph: OsmnxGraph | CompiledGraph, city_graph: CityGraph | CompiledGraph, tables: CinemaTables,
+                          src: Coord, cinema_names: list[str]) -> list[Path]:
+    """Returns the shortest path from a source point to each of the given cinemas, using the precomputed cinema
+    tables instead of searching the city graph. If the tables are of another version of the city graph, the paths
+    are found with a single search from the source instead."""
 
+    graph = compile_graph(city_graph)
+    if tables.version != graph_version(graph):
+        return find_paths(snap_graph, graph, src, [tables.locations[tables.column(name)] for name in cinema_names])
 
-def find_path(osmnx_graph: OsmnxGraph, city_graph: CityGraph, src: Coord, dst: Coord) -> Path:
-    """Returns the shotest path to go from a source point to a destination point."""
+    (src_cruilla,), (dist_start,) = nearest_cruilles(snap_graph, [src])
+    src_index = graph.index[src_cruilla]
+    _, targets, _ = graph.adjacency
 
-    (src_id, dst_id), (dist_start, dist_end) = ox.distance.nearest_nodes(
-        osmnx_graph, [src.x, dst.x], [src.y, dst.y], return_dist=True)
+    paths = []
+    for name in cinema_names:
+        column = tables.column(name)
+        if np.isinf(tables.times[src_index, column]):
+            raise nx.NetworkXNoPath(f"No hi ha cap camí entre {src} i {name}.")
+        edges = edges_from(tables.successors[:, column], src_index, targets)
+        paths.append(build_path(graph, src, tables.locations[column], src_index, edges,
+                                dist_start, tables.snap_distances[column]))
+    return paths
 
-    src_node = osmnx_graph.nodes[src_id]
-    src_cruilla = Cruilla(src_id, Coord(src_node['x'], src_node['y']))
 
-    dst_node = osmnx_graph.nodes[dst_id]
-    dst_cruilla = Cruilla(dst_id, Coord(dst_node['x'], dst_node['y']))
+def build_path(graph: CompiledGraph, src: Coord, dst: Coord, src_index: int, edges: list[int],
+               dist_start: float, dist_end: float, settled_nodes: int = 0) -> Path:
+    """Returns the Path that follows the given edges of the compiled city graph, starting at dist_start meters
+    from its first node and ending at dist_end meters from its last one."""
 
     distance = dist_start + dist_end
     walking_dist = distance
     time = distance / WALKING_SPEED
 
-    route = ox.distance.shortest_path(
-        city_graph, src_cruilla, dst_cruilla, cpus=None, weight='time')
-
-    for node1, node2 in pairwise(route):
-        edge = city_graph[node1][node2]
+    for e in edges:
+        edge = graph.edge_attrs[e]
         time += edge['time']
         distance += edge['info'].distancia
 
         if isinstance(edge['info'], Carrer):
             walking_dist += edge['info'].distancia
 
+    route = route_nodes(graph, src_index, edges)
     duration = dt.timedelta(0, time)
-    return Path(src, dst, route, duration, distance, walking_dist)
+    return Path(src, dst, route, duration, distance, walking_dist, settled_nodes)
+
+
+def find_paths(snap_graph: OsmnxGraph | CompiledGraph, city_graph: CityGraph | CompiledGraph, src: Coord, destinations: list[Coord]) -> list[Path]:
+    """Returns the shortest path from a source point to each of the destinations, in the same order.
+    All of them are found with a single search from the source."""
+
+    cruilles, nearest_dist = nearest_cruilles(snap_graph, [src] + destinations)
+
+    graph = compile_graph(city_graph)
+    src_index, *dst_indices = [graph.index[cruilla] for cruilla in cruilles]
+
+    routes, settled = dijkstra_many(graph, src_index, dst_indices)
 
+    paths = []
+    for dst, dst_index, dist_end in zip(destinations, dst_indices, nearest_dist[1:]):
+        if routes[dst_index] is None:
+            raise nx.NetworkXNoPath(f"No hi ha cap camí entre {src} i {dst}.")
+        paths.append(build_path(graph, src, dst, src_index,
+                     routes[dst_index], nearest_dist[0], dist_end, settled))
+    return paths
 
-def show_path(city_graph: CityGraph, p: Path) -> None:
+
+def show_path(city_graph: CityGraph | CompiledGraph, p: Path) -> None:
     """Shows the path to follow to reach destination interactively in a window."""
     path_graph = city_graph.subgraph(p.route)
     show(path_graph)
 
 
-def plot_path(city_graph: CityGraph, p: Path, filename: str) -> None:
-    """Shows as a picture the route in the file filename."""
-    m = staticmap.StaticMap(800, 600)
+@stage('route_image')
+def route_image(city_graph: CityGraph | CompiledGraph, p: Path, width: int = 800, height: int = 600) -> Image.Image:
+    """Returns a picture of the route over the map of the city. Only the route is drawn: the map comes from the base
+    maps already rendered for nearby routes."""
+    lines: list[OverlayLine] = []
+    markers: list[OverlayMarker] = [(p.source.xy, 'green', 10), (p.destination.xy, 'black', 10)]
     bus_colors = get_color()
 
-    m.add_marker(staticmap.CircleMarker(p.source.xy, 'green', 10))
-    m.add_marker(staticmap.CircleMarker(p.destination.xy, 'black', 10))
-
     for node1, node2 in pairwise(p.route):
         info = city_graph.get_edge_data(node1, node2)['info']
 
         if isinstance(info, Transbord):
             bus_color = next(bus_colors)
-            m.add_marker(staticmap.CircleMarker(node1.coord.xy, 'gray', 6))
+            markers.append((node1.coord.xy, 'gray', 6))
 
         else:
             if isinstance(info, Bus):
@@ -236,10 +780,15 @@ def plot_path(city_graph: CityGraph, p: Path, filename: str) -> None:
                 color = 'deepskyblue'
 
             coords = [coord.xy for coord in info.coord_list]
-            m.add_line(staticmap.Line(coords, color, 4))
+            lines.append((coords, color, 4))
 
-    image = m.render()
-    image.save(filename)
+    return overlay_map(lines, markers, width, height)
+
+
+@stage('plot_path')
+def plot_path(city_graph: CityGraph | CompiledGraph, p: Path, filename: str) -> None:
+    """Shows as a picture the route in the file filename."""
+    route_image(city_graph, p).save(filename)
 
 
 def get_color() -> Iterable[str | None]:
@@ -251,7 +800,7 @@ def get_color() -> Iterable[str | None]:
         yield None
 
 
-def obtenir_indicacions(city_graph: CityGraph, path: Path, dest_name: str = 'casa', hora_inici: dt.datetime | None = None, hora_fi: dt.datetime | None = None, anada=True) -> str:
+def obtenir_indicacions(city_graph: CityGraph | CompiledGraph, path: Path, dest_name: str = 'casa', hora_inici: dt.datetime | None = None, hora_fi: dt.datetime | None = None, anada=True) -> str:
     """Returns the indications that the person should follow in order to arrive to the path destination from the path origin.
     Also returns useful information about the journey."""
     message = ''
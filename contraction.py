@@ -0,0 +1,285 @@
+# contraction.py
+from __future__ import annotations
+
+import heapq
+import time
+from dataclasses import dataclass
+from functools import cached_property
+
+import numpy as np
+
+from routing import CompiledGraph, graph_version
+
+WITNESS_SETTLE_LIMIT = 60  # maximum number of nodes settled by each witness search while contracting a node
+
+
+@dataclass(frozen=True)
+class ContractionHierarchy:
+    """Contraction hierarchy of a compiled graph. Every arc is either an original edge of the graph (edge != -1)
+    or a shortcut that replaces the two arcs first and second. Arcs are stored twice in CSR form: the upward
+    arcs leaving each node (forward search) and the upward arcs arriving at each node (backward search)."""
+    rank: np.ndarray  # contraction order of each node
+    arc_tail: np.ndarray
+    arc_head: np.ndarray
+    arc_weight: np.ndarray
+    arc_edge: np.ndarray  # original edge id, or -1 for shortcuts
+    arc_first: np.ndarray  # first arc replaced by a shortcut, or -1
+    arc_second: np.ndarray  # second arc replaced by a shortcut, or -1
+    up_offsets: np.ndarray  # upward arcs leaving node i are up_arcs[up_offsets[i]:up_offsets[i+1]]
+    up_arcs: np.ndarray
+    down_offsets: np.ndarray  # upward arcs arriving at node i are down_arcs[down_offsets[i]:down_offsets[i+1]]
+    down_arcs: np.ndarray
+    version: str  # graph_version of the graph it was built from
+
+    @property
+    def shortcuts(self) -> int:
+        """Returns the number of shortcut arcs added by the contraction."""
+        return int(np.count_nonzero(self.arc_edge == -1))
+
+    @property
+    def nbytes(self) -> int:
+        """Returns the size in bytes of all the arrays of the hierarchy."""
+        return sum(getattr(self, name).nbytes for name in self.__dataclass_fields__ if name != 'version')
+
+    @cached_property
+    def lists(self) -> dict[str, list]:
+        """Returns the arrays needed by the queries as python lists, which are faster to index one element at a time."""
+        return {name: getattr(self, name).tolist() for name in
+                ('arc_tail', 'arc_head', 'arc_weight', 'arc_edge', 'arc_first', 'arc_second',
+                 'up_offsets', 'up_arcs', 'down_offsets', 'down_arcs')}
+
+
+def build_hierarchy(graph: CompiledGraph, verbose: bool = False) -> ContractionHierarchy:
+    """Contracts all the nodes of the graph, one at a time in order of importance, adding the shortcuts
+    needed to keep the shortest distances between the remaining nodes."""
+    start = time.perf_counter()
+    offsets, targets, weights = graph.adjacency
+    n = len(graph)
+
+    tail: list[int] = []
+    head: list[int] = []
+    weight: list[float] = []
+    edge: list[int] = []
+    first: list[int] = []
+    second: list[int] = []
+
+    # out_arcs[u][v] and in_arcs[v][u] are the id of the best arc from u to v among the uncontracted nodes
+    out_arcs: list[dict[int, int]] = [{} for _ in range(n)]
+    in_arcs: list[dict[int, int]] = [{} for _ in range(n)]
+
+    def add_arc(u: int, v: int, w: float, e: int, a1: int, a2: int) -> None:
+        """Adds an arc from u to v, unless there already is a shorter one."""
+        if v in out_arcs[u] and weight[out_arcs[u][v]] <= w:
+            return
+        tail.append(u)
+        head.append(v)
+        weight.append(w)
+        edge.append(e)
+        first.append(a1)
+        second.append(a2)
+        out_arcs[u][v] = in_arcs[v][u] = len(tail) - 1
+
+    for u in range(n):
+        for e in range(offsets[u], offsets[u + 1]):
+            if targets[e] != u:
+                add_arc(u, targets[e], weights[e], e, -1, -1)
+
+    def witness_distance(u: int, excluded: int, limit: float, goals: set[int]) -> dict[int, float]:
+        """Runs a bounded Dijkstra search from u that doesn't go through the excluded node."""
+        dist = {u: 0.0}
+        heap = [(0.0, u)]
+        settled = 0
+        pending = set(goals)
+        while heap and pending and settled < WITNESS_SETTLE_LIMIT:
+            d, x = heapq.heappop(heap)
+            if d > dist[x]:
+                continue
+            if d > limit:
+                break
+            settled += 1
+            pending.discard(x)
+            for y, a in out_arcs[x].items():
+                if y == excluded:
+                    continue
+                new_dist = d + weight[a]
+                if new_dist < dist.get(y, float('inf')):
+                    dist[y] = new_dist
+                    heapq.heappush(heap, (new_dist, y))
+        return dist
+
+    def shortcuts_for(v: int) -> list[tuple[int, int, float, int, int]]:
+        """Returns the shortcuts needed to contract v, as (u, w, weight, first arc, second arc)."""
+        shortcuts = []
+        for u, a1 in in_arcs[v].items():
+            goals = {w for w in out_arcs[v] if w != u}
+            if not goals:
+                continue
+            limit = weight[a1] + max(weight[out_arcs[v][w]] for w in goals)
+            dist = witness_distance(u, v, limit, goals)
+            for w in goals:
+                a2 = out_arcs[v][w]
+                through_v = weight[a1] + weight[a2]
+                if dist.get(w, float('inf')) > through_v:
+                    shortcuts.append((u, w, through_v, a1, a2))
+        return shortcuts
+
+    contracted_neighbours = [0] * n
+    level = [0] * n
+
+    def priority(v: int) -> int:
+        """Returns the importance of v: the edge difference of contracting it plus its contracted neighbours
+        and its level in the hierarchy."""
+        return 2 * len(shortcuts_for(v)) - len(in_arcs[v]) - len(out_arcs[v]) + contracted_neighbours[v] + level[v]
+
+    heap = [(priority(v), v) for v in range(n)]
+    heapq.heapify(heap)
+    rank = np.empty(n, dtype=np.int64)
+    up_arcs_of: list[list[int]] = [[] for _ in range(n)]
+    down_arcs_of: list[list[int]] = [[] for _ in range(n)]
+
+    for order in range(n):
+        # lazy updates: the priority of the best node is recomputed before contracting it
+        while True:
+            _, v = heapq.heappop(heap)
+            new_priority = priority(v)
+            if not heap or new_priority <= heap[0][0]:
+                break
+            heapq.heappush(heap, (new_priority, v))
+
+        rank[v] = order
+        for u, w, through_v, a1, a2 in shortcuts_for(v):
+            add_arc(u, w, through_v, -1, a1, a2)
+
+        up_arcs_of[v] = list(out_arcs[v].values())
+        down_arcs_of[v] = list(in_arcs[v].values())
+        for w in out_arcs[v]:
+            del in_arcs[w][v]
+            contracted_neighbours[w] += 1
+            level[w] = max(level[w], level[v] + 1)
+        for u in in_arcs[v]:
+            del out_arcs[u][v]
+            contracted_neighbours[u] += 1
+            level[u] = max(level[u], level[v] + 1)
+        out_arcs[v] = {}
+        in_arcs[v] = {}
+
+        if verbose and (order + 1) % 10000 == 0:
+            print(f"{order + 1}/{n} nodes contractats ({time.perf_counter() - start:.0f}s)")
+
+    up_offsets, up_arcs = to_csr(up_arcs_of)
+    down_offsets, down_arcs = to_csr(down_arcs_of)
+    hierarchy = ContractionHierarchy(
+        rank, np.array(tail, dtype=np.int64), np.array(head, dtype=np.int64), np.array(weight, dtype=np.float64),
+        np.array(edge, dtype=np.int64), np.array(first, dtype=np.int64), np.array(second, dtype=np.int64),
+        up_offsets, up_arcs, down_offsets, down_arcs, graph_version(graph))
+
+    if verbose:
+        print(f"Jerarquia de contracció creada en {time.perf_counter() - start:.1f}s: {hierarchy.shortcuts} dreceres, "
+              f"{hierarchy.nbytes / 2**20:.1f} MB.")
+    return hierarchy
+
+
+def to_csr(lists: list[list[int]]) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the offsets and the concatenation of the given lists."""
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(l) for l in lists], out=offsets[1:])
+    values = np.fromiter((x for l in lists for x in l), dtype=np.int64, count=offsets[-1])
+    return offsets, values
+
+
+def save_hierarchy(hierarchy: ContractionHierarchy, filename: str) -> None:
+    """Saves the contraction hierarchy in a file."""
+    with open(filename, 'wb') as f:
+        np.savez(f, **{name: getattr(hierarchy, name) for name in hierarchy.__dataclass_fields__})
+
+
+def load_hierarchy(filename: str, graph: CompiledGraph) -> ContractionHierarchy:
+    """Loads the contraction hierarchy in the file, which must have been built from the given graph (or from one
+    with the same nodes, edges and times). Otherwise, ValueError is raised: its arcs would stand for other edges."""
+    with np.load(filename) as arrays:
+        version = str(arrays['version']) if 'version' in arrays else ''
+        if version != graph_version(graph):
+            raise ValueError("La jerarquia de contracció no correspon al graf de la ciutat.")
+        return ContractionHierarchy(**{name: arrays[name] for name in ContractionHierarchy.__dataclass_fields__
+                                       if name != 'version'}, version=version)
+
+
+def ch_query(hierarchy: ContractionHierarchy, src: int, dst: int) -> tuple[list[int] | None, int]:
+    """Returns the ids of the original edges of the shortest path from src to dst (None if dst is not reachable),
+    found with a bidirectional search that only goes up in the hierarchy, and the number of nodes settled."""
+    lists = hierarchy.lists
+    arc_tail, arc_head, arc_weight = lists['arc_tail'], lists['arc_head'], lists['arc_weight']
+
+    # each direction: (distances, arc used to reach each node, heap, settled nodes, CSR offsets, CSR arcs, arc end)
+    forward = ({src: 0.0}, {}, [(0.0, src)], set(), lists['up_offsets'], lists['up_arcs'], arc_head)
+    backward = ({dst: 0.0}, {}, [(0.0, dst)], set(), lists['down_offsets'], lists['down_arcs'], arc_tail)
+
+    best = float('inf')
+    meeting = -1
+    while forward[2] or backward[2]:
+        for this, other in ((forward, backward), (backward, forward)):
+            dist, pred, heap, settled, offsets, arcs, arc_end = this
+            if not heap:
+                continue
+            d, u = heapq.heappop(heap)
+            if d >= best:
+                heap.clear()
+                continue
+            if u in settled:
+                continue
+            settled.add(u)
+            if u in other[0] and d + other[0][u] < best:
+                best = d + other[0][u]
+                meeting = u
+
+            for i in range(offsets[u], offsets[u + 1]):
+                a = arcs[i]
+                v = arc_end[a]
+                new_dist = d + arc_weight[a]
+                if new_dist < dist.get(v, float('inf')):
+                    dist[v] = new_dist
+                    pred[v] = a
+                    heapq.heappush(heap, (new_dist, v))
+
+    settled = len(forward[3]) + len(backward[3])
+    if meeting == -1:
+        return None, settled
+
+    arcs = []
+    node = meeting
+    while node != src:
+        arcs.append(forward[1][node])
+        node = arc_tail[arcs[-1]]
+    arcs.reverse()
+    node = meeting
+    while node != dst:
+        arcs.append(backward[1][node])
+        node = arc_head[arcs[-1]]
+
+    return unpack(hierarchy, arcs), settled
+
+
+def unpack(hierarchy: ContractionHierarchy, arcs: list[int]) -> list[int]:
+    """Replaces recursively every shortcut by the two arcs it stands for, and returns the original edge ids."""
+    lists = hierarchy.lists
+    arc_edge, arc_first, arc_second = lists['arc_edge'], lists['arc_first'], lists['arc_second']
+
+    edges = []
+    stack = list(reversed(arcs))
+    while stack:
+        a = stack.pop()
+        if arc_edge[a] != -1:
+            edges.append(arc_edge[a])
+        else:
+            stack.append(arc_second[a])
+            stack.append(arc_first[a])
+    return edges
+
+
+if __name__ == '__main__':
+    from city import load_graph
+    from routing import compile_graph
+
+    print("S'està creant la jerarquia de contracció del graf de la ciutat.")
+    hierarchy = build_hierarchy(compile_graph(load_graph('barcelona.grf')), verbose=True)
+    save_hierarchy(hierarchy, 'barcelona.ch')
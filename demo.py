@@ -1,4 +1,5 @@
 
+import operator
 import tkinter as tk
 from tkinter import messagebox, ttk
 
@@ -6,6 +7,7 @@ from PIL import Image, ImageTk
 
 from billboard import *
 from city import *
+from contraction import load_hierarchy
 
 
 class App():
@@ -20,8 +22,18 @@ class App():
         self.billboard = Billboard()
         build_and_save_graphs()
         self.buses_graph = load_graph('buses.grf')
-        self.osmnx_graph = load_graph('osmnx.grf')
         self.city_graph = load_graph('barcelona.grf')
+        spatial_index(self.city_graph, 'barcelona.idx')
+        self.cinema_tables = load_cinema_tables('cinemes')
+        self.hierarchy = None
+        if os.path.exists('barcelona.ch'):
+            try:
+                self.hierarchy = load_hierarchy('barcelona.ch', compile_graph(self.city_graph))
+            except ValueError:
+                print("La jerarquia de contracció és d'un altre graf de la ciutat: cal tornar a executar contraction.py.")
+        # the routes found in the previous runs, only the ones of the current city graph
+        if os.path.exists(ROUTE_CACHE_FILE):
+            route_cache.load(ROUTE_CACHE_FILE, graph_version(compile_graph(self.city_graph)))
 
         self.frame = StartPage(self.root)
         self.frame.pack()
@@ -43,6 +55,7 @@ class App():
 
     def close(self) -> None:
         """Closes application."""
+        route_cache.save(ROUTE_CACHE_FILE)
         self.root.destroy()
 
 
@@ -187,7 +200,9 @@ class PageBillboard(tk.Frame):  # the frame inherits atributes from general Fram
         self.cinemas_tree.heading(
             3, text='# Projeccions en menys de 24h', anchor=tk.CENTER)
 
-        cinema_vals = [(cinema.name, cinema.address, len(cinema.get_projections_in_1_day()))
+        now = dt.datetime.now()
+        cinema_vals = [(cinema.name, cinema.address,
+                        app.billboard.count_projections_between(now, now + dt.timedelta(days=1), cinema))
                        for cinema in app.billboard.cinemas]
 
         for cinema_value in sorted(cinema_vals):
@@ -238,8 +253,7 @@ class PageMapes(tk.Frame):  # the frame inherits atributes from general Frame
         self.top.protocol('WM_DELETE_WINDOW', self.ask_quit)
         self.top.title('CineBus')
 
-        if not os.path.exists('buses.png'):
-            plot(app.buses_graph, 'buses.png')
+        plot(app.buses_graph, 'buses.png')  # only rendered again if the graph has changed
 
         image = Image.open('buses.png')
         self.display = ImageTk.PhotoImage(image)
@@ -252,8 +266,7 @@ class PageMapes(tk.Frame):  # the frame inherits atributes from general Frame
         self.top.protocol('WM_DELETE_WINDOW', self.ask_quit)
         self.top.title('CineBus')
 
-        if not os.path.exists('barcelona.png'):
-            plot(app.city_graph, 'barcelona.png')
+        plot(app.city_graph, 'barcelona.png')  # only rendered again if the graph has changed
 
         image = Image.open('barcelona.png')
         self.display = ImageTk.PhotoImage(image)
@@ -359,14 +372,11 @@ class PageRuta(tk.Frame):
         self.top.protocol('WM_DELETE_WINDOW', self.ask_quit)
         self.top.title('CineBus')
 
-        self.path_to_cinemas: dict[str, Path] = {}
+        now = dt.datetime.now()
 
-        def dona_temps_a_arribar(src: Coord, projection: Projection) -> bool:
+        def dona_temps_a_arribar(projection: Projection) -> bool:
             """Retorna si dona temps a arribar des de la coordenada fins al cinema de la projecció."""
-            if projection.cinema.name not in self.path_to_cinemas:
-                self.path_to_cinemas[projection.cinema.name] = find_path(
-                    app.osmnx_graph, app.city_graph, src, projection.cinema.loc)
-            return dt.datetime.now() + self.path_to_cinemas[projection.cinema.name].duration < projection.start_time
+            return now + self.path_to_cinemas[projection.cinema.name].duration < projection.start_time
 
         tk.Label(self.top, text="Projeccions de " + nom + "\n(a les que pots arribar a temps)",
                  font=('Source Sans Pro', 12, 'bold')).grid(row=0, column=0, columnspan=3, padx=10, pady=10)
@@ -383,10 +393,16 @@ class PageRuta(tk.Frame):
         self.projections_tree.heading(2, text='Horari', anchor=tk.CENTER)
 
         print("S'estan obtenint les projeccions a les que et dona temps a arribar...")
-        self.projections = sorted(
-            self.peli.projections, key=operator.attrgetter('start_time'))
+        self.projections = app.billboard.projections_between(now, dt.datetime.max, film=self.peli)
+
+        cinemas = list({proj.cinema.name: proj.cinema for proj in self.projections}.values())
+        paths = find_paths_to_cinemas(app.city_graph, app.city_graph, app.cinema_tables,
+                                      self.src, [cinema.name for cinema in cinemas])
+        self.path_to_cinemas: dict[str, Path] = {
+            cinema.name: path for cinema, path in zip(cinemas, paths)}
+
         for projection in self.projections:
-            if dona_temps_a_arribar(self.src, projection):
+            if dona_temps_a_arribar(projection):
                 self.projections_tree.insert('', 'end', values=(
                     projection.cinema.name, projection.start_time))
 
@@ -411,10 +427,7 @@ class PageRuta(tk.Frame):
         print("S'està creant la ruta fins al cinema " + nom_cine + "...")
         path = self.path_to_cinemas[nom_cine]
 
-        plot_path(app.city_graph, path, 'path_graph.png')
-
-        image = Image.open('path_graph.png')
-        self.display = ImageTk.PhotoImage(image)
+        self.display = ImageTk.PhotoImage(route_image(app.city_graph, path))
         tk.Label(self.top, image=self.display).grid(
             row=0, column=0, columnspan=2)
 
@@ -437,12 +450,10 @@ class PageRuta(tk.Frame):
         self.top.protocol('WM_DELETE_WINDOW', self.ask_quit)
         self.top.title('CineBus')
 
-        path = find_path(app.osmnx_graph, app.city_graph,
-                         self.projeccio.cinema.loc, self.src)
-        plot_path(app.city_graph, path, 'path_graph_tornada.png')
-
-        image = Image.open('path_graph_tornada.png')
-        self.display = ImageTk.PhotoImage(image)
+        algorithm = 'astar' if app.hierarchy is None else 'ch'
+        path = find_path(app.city_graph, app.city_graph,
+                         self.projeccio.cinema.loc, self.src, algorithm, app.hierarchy)
+        self.display = ImageTk.PhotoImage(route_image(app.city_graph, path))
         tk.Label(self.top, image=self.display).grid(row=0, column=0)
         tk.Button(self.top, text='Cancel·lar', command=self.ask_quit, cursor='hand2').grid(
             row=1, column=0, padx=100, pady=10, sticky='se')
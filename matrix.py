@@ -0,0 +1,163 @@
+# matrix.py
+"""Travel times from many origins to every cinema, computed in parallel from the cinema tables.
+
+Usage: python matrix.py origens.csv matriu.csv [--workers N] [--chunk-size N]
+The origins file has a header with the columns x (longitude) and y (latitude)."""
+from __future__ import annotations
+
+import argparse
+import csv
+import os
+import time
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator, TextIO
+
+import numpy as np
+
+from buses import Coord
+from city import (WALKING_SPEED, CinemaTables, build_and_save_graphs, check_cinema_tables, load_cinema_tables,
+                  load_graph, spatial_index)
+from spatial import SpatialIndex
+
+CHUNK_SIZE = 500  # number of origins each worker is given at a time
+
+
+@dataclass(frozen=True)
+class TravelTimes:
+    """Travel from some consecutive origins to every cinema, with the same numbers as the Path to each of them.
+    Rows are origins and columns are cinemas, and the pairs without any path are inf."""
+    first: int  # position of the first of these origins in the list of all of them
+    cinemas: list[str]
+    durations: np.ndarray  # float64 (origins x cinemas), time (s)
+    distances: np.ndarray  # float64 (origins x cinemas), distance (m)
+    walking_distances: np.ndarray  # float64 (origins x cinemas), walking distance (m)
+
+
+@dataclass(frozen=True)
+class MatrixWorker:
+    """What a worker needs to compute the travel times: the spatial index of the street nodes of the city graph
+    and the cinema tables, both read from the files and shared read-only with the other workers."""
+    index: SpatialIndex
+    tables: CinemaTables
+
+    def travel_times(self, first: int, X: Sequence[float], Y: Sequence[float]) -> TravelTimes:
+        """Returns the travel times from the origins (X[i], Y[i]) to every cinema, snapping all of them at once."""
+        ids, snap = self.index.nearest(X, Y)
+        nodes = ids[:, 0]
+        walked = snap[:, 0][:, np.newaxis] + np.asarray(self.tables.snap_distances)[np.newaxis, :]
+        return TravelTimes(first, self.tables.names,
+                           self.tables.times[nodes] + walked / WALKING_SPEED,
+                           self.tables.distances[nodes] + walked,
+                           self.tables.walking_distances[nodes] + walked)
+
+
+def load_worker(graph_file: str, index_file: str, tables_file: str) -> MatrixWorker:
+    """Returns the worker for the saved city graph, its spatial index and its cinema tables."""
+    graph = load_graph(graph_file)
+    tables = load_cinema_tables(tables_file)
+    check_cinema_tables(tables, graph)
+    return MatrixWorker(spatial_index(graph, index_file), tables)
+
+
+_worker: MatrixWorker | None = None  # the worker of each process of the pool
+
+
+def start_worker(graph_file: str, index_file: str, tables_file: str) -> None:
+    """Loads the worker of the current process of the pool."""
+    global _worker
+    _worker = load_worker(graph_file, index_file, tables_file)
+
+
+def run_worker(first: int, X: Sequence[float], Y: Sequence[float]) -> TravelTimes:
+    """Computes the travel times from some origins in the current process of the pool."""
+    assert _worker is not None
+    return _worker.travel_times(first, X, Y)
+
+
+def travel_times(origins: Sequence[Coord], workers: int | None = None, chunk_size: int = CHUNK_SIZE,
+                 graph_file: str = 'barcelona.grf', index_file: str = 'barcelona.idx',
+                 tables_file: str = 'cinemes') -> Iterator[TravelTimes]:
+    """Yields the travel times from the origins to every cinema, chunk_size origins at a time and in order, as
+    soon as they are computed. The chunks are shared out among a pool of worker processes (as many as cores by
+    default), which memory-map the same graph files and cinema tables instead of each having a copy of them."""
+    workers = workers or os.cpu_count() or 1
+    # the spatial index is built and saved here if needed, so that the workers only have to read it
+    worker = load_worker(graph_file, index_file, tables_file)
+
+    X = [coord.x for coord in origins]
+    Y = [coord.y for coord in origins]
+    firsts = range(0, len(origins), chunk_size)
+    chunks_X = [X[first:first + chunk_size] for first in firsts]
+    chunks_Y = [Y[first:first + chunk_size] for first in firsts]
+
+    if workers == 1:
+        yield from map(worker.travel_times, firsts, chunks_X, chunks_Y)
+        return
+
+    with ProcessPoolExecutor(workers, initializer=start_worker,
+                             initargs=(graph_file, index_file, tables_file)) as pool:
+        yield from pool.map(run_worker, firsts, chunks_X, chunks_Y)
+
+
+def travel_matrix(origins: Sequence[Coord], workers: int | None = None, chunk_size: int = CHUNK_SIZE,
+                  graph_file: str = 'barcelona.grf', index_file: str = 'barcelona.idx',
+                  tables_file: str = 'cinemes') -> TravelTimes:
+    """Returns the travel times from all the origins to every cinema together."""
+    chunks = list(travel_times(origins, workers, chunk_size, graph_file, index_file, tables_file))
+    if not chunks:
+        tables = load_cinema_tables(tables_file)
+        empty = np.zeros((0, len(tables.names)))
+        return TravelTimes(0, tables.names, empty, empty, empty)
+    return TravelTimes(0, chunks[0].cinemas, *(np.concatenate([getattr(chunk, name) for chunk in chunks])
+                                                for name in ('durations', 'distances', 'walking_distances')))
+
+
+def read_origins(filename: str) -> list[Coord]:
+    """Returns the origins of a csv file with the columns x and y."""
+    with open(filename, newline='', encoding='utf-8') as f:
+        return [Coord(float(row['x']), float(row['y'])) for row in csv.DictReader(f)]
+
+
+def write_travel_times(chunk: TravelTimes, f: TextIO) -> None:
+    """Writes a row for each origin and cinema of the chunk: the position of the origin, the cinema, the duration
+    (s), the distance (m) and the walking distance (m), leaving the numbers empty if there is no path."""
+    writer = csv.writer(f)
+    for i in range(len(chunk.durations)):
+        for column, cinema in enumerate(chunk.cinemas):
+            numbers = (chunk.durations[i, column], chunk.distances[i, column], chunk.walking_distances[i, column])
+            writer.writerow([chunk.first + i, cinema] +
+                            [f'{number:.1f}' if np.isfinite(number) else '' for number in numbers])
+
+
+def write_matrix(origins: Sequence[Coord], f: TextIO, workers: int | None = None, chunk_size: int = CHUNK_SIZE) -> None:
+    """Writes the travel times from the origins to every cinema in the csv file as they are computed, showing the
+    progress."""
+    csv.writer(f).writerow(['origen', 'cinema', 'durada', 'distancia', 'distancia_caminant'])
+    start = time.perf_counter()
+    done = 0
+    for chunk in travel_times(origins, workers, chunk_size):
+        write_travel_times(chunk, f)
+        done += len(chunk.durations)
+        print(f"{done}/{len(origins)} origens ({done / (time.perf_counter() - start):.0f} origens/s)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('origins', help="csv file with the columns x and y")
+    parser.add_argument('output', help="csv file where the travel times are written")
+    parser.add_argument('--workers', type=int, default=None, help="number of processes (as many as cores by default)")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="number of origins of each task")
+    args = parser.parse_args()
+
+    build_and_save_graphs()
+    origins = read_origins(args.origins)
+    start = time.perf_counter()
+    with open(args.output, 'w', newline='', encoding='utf-8') as f:
+        write_matrix(origins, f, args.workers, args.chunk_size)
+    print(f"Matriu de {len(origins)} origens calculada en {time.perf_counter() - start:.1f}s.")
+
+
+if __name__ == '__main__':
+    main()
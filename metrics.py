@@ -0,0 +1,128 @@
+# metrics.py
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, TextIO
+
+# the stages are only measured if one of these environment variables is set
+METRICS_FILE = os.environ.get('CINEBUS_METRICS')  # json lines file where every run of a stage is appended
+PROMETHEUS_FILE = os.environ.get('CINEBUS_METRICS_PROM')  # file with the totals of each stage, in Prometheus format
+# the memory is only traced if this one is set too, since tracing every allocation makes everything several times slower
+MEMORY = os.environ.get('CINEBUS_METRICS_MEMORY') == '1'
+PROMETHEUS_INTERVAL = 10  # minimum time (s) between two writes of the Prometheus file, which is also written at exit
+
+
+@dataclass
+class StageTotals:
+    """What all the runs of a stage in this process add up to."""
+    calls: int = 0
+    seconds: float = 0.0
+    peak_memory: int | None = None  # largest increase (bytes) of the memory in use during a run, if it is traced
+
+
+totals: dict[str, StageTotals] = {}
+_lock = threading.Lock()
+_running = threading.local()  # memory in use when each running stage of the thread started and its peak since then
+_metrics_file: TextIO | None = None  # METRICS_FILE, opened the first time a run is recorded
+_prometheus_written = 0.0  # time.monotonic() of the last write of PROMETHEUS_FILE
+
+
+def enabled() -> bool:
+    """Checks if the stages are being measured."""
+    return bool(METRICS_FILE or PROMETHEUS_FILE)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Measures the time and the peak memory increase of the block (or of each call of the decorated function) and
+    records them as a run of the named stage, if the stages are being measured. The memory is only measured if
+    MEMORY is set: it is traced with tracemalloc, so it is only measured in the main thread, and the peaks of the
+    inner stages count for the outer ones."""
+    if not enabled():
+        yield
+        return
+
+    memory = MEMORY and threading.current_thread() is threading.main_thread()
+    stack = _running.__dict__.setdefault('stack', [])
+    if memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1][1] = max(stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        stack.append([current, current])
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        peak_memory = None
+        if memory:
+            started, peak = stack.pop()
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+            peak_memory = peak - started
+        record(name, seconds, peak_memory, outermost=not stack)
+
+
+def record(name: str, seconds: float, peak_memory: int | None, outermost: bool = True) -> None:
+    """Adds a run of the stage to the totals and to the json lines file, and writes the Prometheus file again after
+    an outermost stage if it hasn't been written in the last PROMETHEUS_INTERVAL seconds. The json lines file is kept
+    open, and each line is written as soon as it is recorded."""
+    global _metrics_file, _prometheus_written
+    with _lock:
+        stage_totals = totals.setdefault(name, StageTotals())
+        stage_totals.calls += 1
+        stage_totals.seconds += seconds
+        if peak_memory is not None:
+            stage_totals.peak_memory = max(stage_totals.peak_memory or 0, peak_memory)
+
+        if METRICS_FILE:
+            if _metrics_file is None:
+                _metrics_file = open(METRICS_FILE, 'a', encoding='utf-8', buffering=1)  # flushed after every line
+            line = {'stage': name, 'seconds': seconds, 'peak_memory': peak_memory, 'time': time.time(),
+                    'pid': os.getpid()}
+            _metrics_file.write(json.dumps(line) + '\n')
+        if PROMETHEUS_FILE and outermost and time.monotonic() - _prometheus_written >= PROMETHEUS_INTERVAL:
+            write_prometheus(PROMETHEUS_FILE)
+            _prometheus_written = time.monotonic()
+
+
+def prometheus_text() -> str:
+    """Returns the totals of every stage in the Prometheus text format."""
+    metrics = [('cinebus_stage_calls_total', 'counter', "Number of runs of each stage.", 'calls'),
+               ('cinebus_stage_seconds_total', 'counter', "Time (s) spent in each stage.", 'seconds'),
+               ('cinebus_stage_peak_memory_bytes', 'gauge', "Largest memory increase (bytes) during a run of each stage.",
+                'peak_memory')]
+    lines = []
+    for metric, kind, description, attr in metrics:
+        lines += [f'# HELP {metric} {description}', f'# TYPE {metric} {kind}']
+        lines += [f'{metric}{{stage="{name}"}} {getattr(stage_totals, attr)}' for name, stage_totals in totals.items()
+                  if getattr(stage_totals, attr) is not None]
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(filename: str) -> None:
+    """Writes the totals of every stage in the file, replacing it at once so that it is never read half written."""
+    with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(prometheus_text())
+    os.replace(filename + '.tmp', filename)
+
+
+@atexit.register
+def write_totals() -> None:
+    """Writes the Prometheus file one last time and closes the json lines file when the program ends."""
+    with _lock:
+        if PROMETHEUS_FILE and totals:
+            write_prometheus(PROMETHEUS_FILE)
+        if _metrics_file is not None:
+            _metrics_file.close()
@@ -0,0 +1,216 @@
+# osm.py
+from __future__ import annotations
+
+import json
+import os
+import re
+import tempfile
+import xml.etree.ElementTree as ET
+from functools import lru_cache
+from typing import Any, Iterator
+from xml.sax.saxutils import quoteattr
+
+import networkx as nx
+import osmnx as ox
+import requests
+from shapely.geometry import MultiPolygon, Polygon, mapping, shape
+
+try:
+    import osmium  # only needed to read .osm.pbf extracts
+except ImportError:
+    osmium = None
+
+OSM_EXTRACTS = ('barcelona.osm.pbf', 'barcelona.osm')  # local extracts used instead of downloading, if present
+OSM_CACHE_FILE = 'osm_extract.json'  # streets and nodes read from the extract, to avoid parsing it again
+PLACE = 'Barcelona, Spain'  # the street network is the one inside the boundary of this place
+BOUNDARY_FILE = 'barcelona_limits.json'  # boundary of PLACE, geocoded once so that the extract can be read offline
+BOUNDARY_BUFFER = 500  # distance (m) around the boundary kept while simplifying, like osmnx does
+
+# tags kept from each way: the ones osmnx keeps in the edges and the ones the filters look at
+WAY_TAGS = set(ox.settings.useful_tags_way) | {'foot', 'motor_vehicle', 'motorcar'}
+NODE_TAGS = set(ox.settings.useful_tags_node)
+
+# the same filters osmnx uses to download each kind of network: (tag, regex, whether the value must match it).
+# a way passes a filter that must not match if it doesn't have the tag at all. they are copied from the version of
+# osmnx pinned in requirements.txt (1.3.0), which only has them in a private function, and must be checked against
+# downloader._get_osm_filter when it is upgraded
+NETWORK_FILTERS: dict[str, list[tuple[str, str, bool]]] = {
+    'drive': [('highway', '', True), ('area', 'yes', False), ('access', 'private', False),
+              ('highway', 'abandoned|bridleway|bus_guideway|construction|corridor|cycleway|elevator|escalator|'
+                          'footway|path|pedestrian|planned|platform|proposed|raceway|service|steps|track', False),
+              ('motor_vehicle', 'no', False), ('motorcar', 'no', False),
+              ('service', 'alley|driveway|emergency_access|parking|parking_aisle|private', False)],
+    'walk': [('highway', '', True), ('area', 'yes', False), ('access', 'private', False),
+             ('highway', 'abandoned|bus_guideway|construction|cycleway|motor|planned|platform|proposed|raceway', False),
+             ('foot', 'no', False), ('service', 'private', False)],
+}
+
+
+def find_extract() -> str | None:
+    """Returns the local OSM extract to read the street networks from, or None if there is none."""
+    for filename in OSM_EXTRACTS:
+        if os.path.exists(filename):
+            return filename
+    return None
+
+
+def graph_from_extract(filename: str, network_type: str, place: str = PLACE) -> nx.MultiDiGraph:
+    """Returns the simplified street network of the given type ('drive' or 'walk') in the extract and inside the
+    boundary of the place, built in the same way graph_from_place builds the ones it downloads. The extract is only
+    parsed once for all the network types. If the boundary can't be obtained, the whole extract is used."""
+    elements = [element for element in read_extract(filename)['ways'] if passes(element['tags'], network_type)]
+    used = {node for way in elements for node in way['nodes']}
+    elements += [node for node in read_extract(filename)['nodes'] if node['id'] in used]
+
+    # the filtered streets are written as an .osm file, so that osmnx builds the graph as it does from any other one
+    bidirectional = network_type in ox.settings.bidirectional_network_types
+    with tempfile.TemporaryDirectory() as directory:
+        xml_file = os.path.join(directory, f'{network_type}.osm')
+        write_xml(elements, xml_file)
+        graph = ox.graph_from_xml(xml_file, bidirectional=bidirectional, simplify=False, retain_all=True)
+
+    polygon = place_polygon(place)
+    if polygon is None:
+        print(f"No s'ha pogut obtenir el límit de {place}: es fan servir tots els carrers de l'extracte.")
+        graph = ox.utils_graph.get_largest_component(ox.simplify_graph(graph))
+        nx.set_node_attributes(graph, ox.stats.count_streets_per_node(graph), name='street_count')
+        return graph
+
+    # as in graph_from_polygon, the graph is simplified with some margin around the boundary and then cut by it, so
+    # that the intersections just outside it still split the streets, and their streets are still counted
+    projected, crs = ox.projection.project_geometry(polygon)
+    buffered, _ = ox.projection.project_geometry(projected.buffer(BOUNDARY_BUFFER), crs=crs, to_latlong=True)
+    buffered_graph = ox.simplify_graph(ox.truncate.truncate_graph_polygon(graph, buffered, retain_all=True))
+    graph = ox.truncate.truncate_graph_polygon(buffered_graph, polygon, retain_all=False)
+    nx.set_node_attributes(graph, ox.stats.count_streets_per_node(buffered_graph, nodes=graph.nodes),
+                           name='street_count')
+    return graph
+
+
+def place_polygon(place: str = PLACE) -> Polygon | MultiPolygon | None:
+    """Returns the boundary of the place, the one graph_from_place uses, or None if it can't be obtained. It is
+    geocoded the first time and saved in BOUNDARY_FILE, so that afterwards no network is needed."""
+    if os.path.exists(BOUNDARY_FILE):
+        with open(BOUNDARY_FILE, encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached['place'] == place:
+            return shape(cached['geometry'])
+
+    try:
+        polygon = ox.geocode_to_gdf(place)['geometry'].unary_union
+    except (requests.RequestException, ValueError, TypeError):
+        return None
+    if not isinstance(polygon, (Polygon, MultiPolygon)):
+        return None
+
+    with open(BOUNDARY_FILE + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'place': place, 'geometry': mapping(polygon)}, f)
+    os.replace(BOUNDARY_FILE + '.tmp', BOUNDARY_FILE)
+    return polygon
+
+
+def write_xml(elements: list[dict], filename: str) -> None:
+    """Writes nodes and ways, as elements like the ones of the Overpass API, in an .osm file."""
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for element in elements:
+            tags = ''.join(f'<tag k={quoteattr(k)} v={quoteattr(str(v))}/>' for k, v in element['tags'].items())
+            if element['type'] == 'node':
+                f.write(f'<node id="{element["id"]}" lat="{element["lat"]!r}" lon="{element["lon"]!r}">{tags}</node>\n')
+            else:
+                nds = ''.join(f'<nd ref="{node}"/>' for node in element['nodes'])
+                f.write(f'<way id="{element["id"]}">{nds}{tags}</way>\n')
+        f.write('</osm>\n')
+
+
+def passes(tags: dict[str, str], network_type: str) -> bool:
+    """Checks if a way with the given tags belongs to the network of the given type."""
+    for tag, regex, must_match in NETWORK_FILTERS[network_type]:
+        if tag not in tags:
+            if must_match:
+                return False
+        elif bool(re.search(regex, tags[tag])) != must_match:
+            return False
+    return True
+
+
+@lru_cache(maxsize=1)
+def read_extract(filename: str) -> dict[str, Any]:
+    """Returns the streets (ways with a highway tag) of the extract and the nodes they go through, as elements like
+    the ones of the Overpass API. They are saved in the cache file and read from it while the extract doesn't change."""
+    stat = os.stat(filename)
+    source = {'filename': os.path.abspath(filename), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if os.path.exists(OSM_CACHE_FILE):
+        with open(OSM_CACHE_FILE, encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached['source'] == source:
+            return cached
+
+    print(f"S'està llegint l'extracte d'OpenStreetMap {filename}.")
+    nodes, ways = parse_pbf(filename) if filename.endswith('.pbf') else parse_xml(filename)
+    extract = {'source': source, 'ways': ways, 'nodes': nodes}
+    with open(OSM_CACHE_FILE + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(extract, f, ensure_ascii=False)
+    os.replace(OSM_CACHE_FILE + '.tmp', OSM_CACHE_FILE)
+    return extract
+
+
+def parse_xml(filename: str) -> tuple[list[dict], list[dict]]:
+    """Returns the streets of an .osm file and the nodes they go through, reading it as a stream twice: first the
+    streets, and then only the nodes they use, so that the rest of the nodes are never kept."""
+    ways = []
+    for element in iter_elements(filename, 'way'):
+        tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+        if 'highway' in tags:
+            ways.append({'type': 'way', 'id': int(element.get('id')),
+                         'nodes': [int(nd.get('ref')) for nd in element.iter('nd')],
+                         'tags': {k: v for k, v in tags.items() if k in WAY_TAGS}})
+
+    used = {node for way in ways for node in way['nodes']}
+    nodes = []
+    for element in iter_elements(filename, 'node'):
+        if int(element.get('id')) in used:
+            tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag') if tag.get('k') in NODE_TAGS}
+            nodes.append({'type': 'node', 'id': int(element.get('id')), 'lat': float(element.get('lat')),
+                          'lon': float(element.get('lon')), 'tags': tags})
+    return nodes, ways
+
+
+def iter_elements(filename: str, tag: str) -> Iterator[ET.Element]:
+    """Yields the complete elements of the given tag ('node', 'way' or 'relation') of an .osm file. Each element is
+    removed from the tree once it has been read, so that the memory used doesn't grow with the file."""
+    events = ET.iterparse(filename, events=('start', 'end'))
+    _, root = next(events)
+    for event, element in events:
+        if event == 'end' and element.tag in ('node', 'way', 'relation'):
+            if element.tag == tag:
+                yield element
+            root.clear()
+
+
+def parse_pbf(filename: str) -> tuple[list[dict], list[dict]]:
+    """Returns the streets of an .osm.pbf file and the nodes they go through, which needs the osmium library. Like
+    parse_xml, the file is read twice, so that only the nodes used by the streets are kept."""
+    if osmium is None:
+        raise ImportError("Cal instal·lar osmium (pyosmium) per llegir extractes .osm.pbf.")
+
+    ways = []
+    nodes = []
+
+    class WayHandler(osmium.SimpleHandler):
+        def way(self, w) -> None:
+            if 'highway' in w.tags:
+                ways.append({'type': 'way', 'id': w.id, 'nodes': [nd.ref for nd in w.nodes],
+                             'tags': {tag.k: tag.v for tag in w.tags if tag.k in WAY_TAGS}})
+
+    WayHandler().apply_file(filename)
+    used = {node for way in ways for node in way['nodes']}
+
+    class NodeHandler(osmium.SimpleHandler):
+        def node(self, n) -> None:
+            if n.id in used:
+                nodes.append({'type': 'node', 'id': n.id, 'lat': n.location.lat, 'lon': n.location.lon,
+                              'tags': {tag.k: tag.v for tag in n.tags if tag.k in NODE_TAGS}})
+
+    NodeHandler().apply_file(filename)
+    return nodes, ways
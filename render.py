@@ -0,0 +1,307 @@
+# render.py
+from __future__ import annotations
+
+import hashlib
+import math
+import os
+import shutil
+import weakref
+from collections import OrderedDict
+
+import networkx as nx
+import numpy as np
+import staticmap
+from PIL import Image, ImageDraw
+
+from routing import CompiledGraph, compile_graph, graph_version
+from tiles import TILE_SIZE, static_map
+
+RASTER_DIRECTORY = 'mapes'  # rendered maps of whole graphs, named after their image_version and size
+SIMPLIFY_TOLERANCE = 0.5  # maximum distance (px) between a simplified line and the real one
+MAX_ZOOM = 17  # the highest zoom staticmap chooses
+BASE_BUCKET = 64  # the centers of the base maps of the routes are rounded to multiples of this (px)
+BASE_CACHE_SIZE = 32  # number of base maps kept in memory
+MARKER_MARGIN = 10  # space (px) left around the features of a route, for the width of its markers
+
+Polyline = tuple[tuple[int, int, int], np.ndarray]  # (color, points in pixels)
+OverlayLine = tuple[list[tuple[float, float]], str, int]  # (points (lon, lat), color, width)
+OverlayMarker = tuple[tuple[float, float], str, int]  # (point (lon, lat), color, width), like staticmap.CircleMarker
+
+
+def edge_geometry(graph: nx.Graph | CompiledGraph) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the points (lon, lat) of the geometry of all the edges one after the other, where the points of each
+    edge start (one more position at the end) and the color of each edge. The arrays of a graph file are used as
+    they are, without building the attributes of its edges."""
+    if isinstance(graph, CompiledGraph) and hasattr(graph.edge_attrs, 'geometry'):
+        table = graph.edge_attrs
+        return np.asarray(table.geometry), np.asarray(table.geometry_offsets), np.asarray(table.colors)
+
+    points = []
+    offsets = [0]
+    colors = []
+    for _, _, attrs in graph.edges(data=True):
+        points.extend(coord.xy for coord in attrs['info'].coord_list)
+        offsets.append(len(points))
+        colors.append(attrs['color'])
+    return np.array(points, dtype=np.float64).reshape(-1, 2), np.array(offsets, dtype=np.int64), \
+        np.array(colors, dtype=np.uint8).reshape(-1, 3)
+
+
+def tile_x(lon: np.ndarray, zoom: int) -> np.ndarray:
+    """Returns the (fractional) tile column of the longitudes at the zoom, like staticmap."""
+    return (lon + 180.0) / 360 * 2**zoom
+
+
+def tile_y(lat: np.ndarray, zoom: int) -> np.ndarray:
+    """Returns the (fractional) tile row of the latitudes at the zoom, like staticmap."""
+    lat = np.radians(lat)
+    return (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / math.pi) / 2 * 2**zoom
+
+
+def tile_lon(x: np.ndarray, zoom: int) -> np.ndarray:
+    """Returns the longitudes of the (fractional) tile columns at the zoom (the inverse of tile_x)."""
+    return x / 2**zoom * 360 - 180
+
+
+def tile_lat(y: np.ndarray, zoom: int) -> np.ndarray:
+    """Returns the latitudes of the (fractional) tile rows at the zoom (the inverse of tile_y)."""
+    return np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * y / 2**zoom))))
+
+
+def map_view(points: np.ndarray, width: int, height: int) -> tuple[int, tuple[float, float]]:
+    """Returns the zoom and the center (lon, lat) that staticmap would choose for a map of the given size (px) with
+    all the points: the highest zoom at which all of them fit, and the center of their extent."""
+    min_lon, min_lat = points.min(axis=0)
+    max_lon, max_lat = points.max(axis=0)
+    zoom = 0
+    for z in range(MAX_ZOOM, -1, -1):
+        if (tile_x(max_lon, z) - tile_x(min_lon, z)) * TILE_SIZE <= width and \
+                (tile_y(min_lat, z) - tile_y(max_lat, z)) * TILE_SIZE <= height:
+            zoom = z
+            break
+    return zoom, ((min_lon + max_lon) / 2, (min_lat + max_lat) / 2)
+
+
+def merge_polylines(pixels: np.ndarray, offsets: np.ndarray, colors: np.ndarray) -> list[Polyline]:
+    """Returns the edges joined into polylines: edges of the same color that share an end are drawn as a single
+    line. The edges travelled in both directions (which have the same points) are only drawn once."""
+    lengths = np.diff(offsets)
+    keys: dict[tuple, int] = {}  # the points of each edge (in any direction) and its color -> edge kept
+    for e in np.flatnonzero(lengths >= 2).tolist():
+        points = pixels[offsets[e]:offsets[e + 1]]
+        forward, backward = points.tobytes(), points[::-1].tobytes()
+        keys.setdefault((min(forward, backward), colors[e].tobytes()), e)
+    edges = sorted(keys.values())
+
+    # the edges of each color that touch each end point
+    ends: dict[tuple, list[int]] = {}
+    for e in edges:
+        for point in (pixels[offsets[e]], pixels[offsets[e + 1] - 1]):
+            ends.setdefault((point.tobytes(), colors[e].tobytes()), []).append(e)
+
+    used = set()
+
+    def extend(points: list[np.ndarray], color: bytes) -> None:
+        """Adds to the end of the polyline the edges of its color that continue it, while there are any."""
+        while True:
+            last = points[-1][-1]
+            following = [e for e in ends[(last.tobytes(), color)] if e not in used]
+            if not following:
+                return
+            e = following[0]
+            used.add(e)
+            edge_points = pixels[offsets[e]:offsets[e + 1]]
+            if not np.array_equal(edge_points[0], last):
+                edge_points = edge_points[::-1]
+            points.append(edge_points[1:])
+
+    polylines = []
+    for e in edges:
+        if e in used:
+            continue
+        used.add(e)
+        color = colors[e].tobytes()
+        forward = [pixels[offsets[e]:offsets[e + 1]]]
+        extend(forward, color)
+        backward = [forward[0][::-1]]
+        extend(backward, color)
+        # the edges found backwards, turned around, end with the first edge, and the forward ones follow it
+        line = np.concatenate([np.concatenate(backward)[::-1]] + forward[1:])
+        polylines.append((tuple(colors[e].tolist()), line))
+    return polylines
+
+
+def simplify(points: np.ndarray, tolerance: float = SIMPLIFY_TOLERANCE) -> np.ndarray:
+    """Returns the points of the polyline that are needed to draw it without moving it more than tolerance
+    (Douglas-Peucker): between two kept points, the farthest one from the segment joining them is kept if it is
+    farther than tolerance."""
+    if len(points) <= 2:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        inner = points[first + 1:last]
+        segment = end - start
+        norm = math.hypot(*segment)
+        if norm == 0:
+            dist = np.hypot(*(inner - start).T)
+        else:
+            dist = np.abs(segment[0] * (inner[:, 1] - start[1]) - segment[1] * (inner[:, 0] - start[0])) / norm
+        farthest = int(np.argmax(dist))
+        if dist[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack += [(first, middle), (middle, last)]
+    return points[keep]
+
+
+def to_pixels(points: np.ndarray, zoom: int, center: tuple[float, float], width: int, height: int) -> np.ndarray:
+    """Returns the position (px) of the points (lon, lat) in an image of the given size, with the same projection as
+    staticmap."""
+    x0, y0 = tile_x(center[0], zoom), tile_y(center[1], zoom)
+    return np.column_stack(((tile_x(points[:, 0], zoom) - x0) * TILE_SIZE + width / 2,
+                            (tile_y(points[:, 1], zoom) - y0) * TILE_SIZE + height / 2))
+
+
+def from_pixels(pixels: np.ndarray, zoom: int, center: tuple[float, float], width: int, height: int) -> np.ndarray:
+    """Returns the points (lon, lat) at the positions (px) of an image of the given size (the inverse of to_pixels)."""
+    x = (pixels[:, 0] - width / 2) / TILE_SIZE + tile_x(center[0], zoom)
+    y = (pixels[:, 1] - height / 2) / TILE_SIZE + tile_y(center[1], zoom)
+    return np.column_stack((tile_lon(x, zoom), tile_lat(y, zoom)))
+
+
+def graph_polylines(graph: nx.Graph | CompiledGraph, width: int, height: int) \
+        -> tuple[int, tuple[float, float], list[Polyline]]:
+    """Returns the zoom and the center of the map of the graph and its edges merged into polylines, which are
+    simplified for that zoom, leaving out the ones smaller than a pixel."""
+    points, offsets, colors = edge_geometry(graph)
+    zoom, center = map_view(points, width, height)
+    polylines = []
+    for color, line in merge_polylines(to_pixels(points, zoom, center, width, height), offsets, colors):
+        line = simplify(line)
+        if np.ptp(line, axis=0).max() >= 1:
+            polylines.append((color, line))
+    return zoom, center, polylines
+
+
+def render_graph(graph: nx.Graph | CompiledGraph, width: int, height: int, line_width: int = 1) -> Image.Image:
+    """Returns an image of the edges of the graph over the map of the city, drawn as the polylines of
+    graph_polylines."""
+    zoom, center, polylines = graph_polylines(graph, width, height)
+    m = static_map(width, height)
+    for color, line in polylines:
+        # back to coordinates, which staticmap projects again
+        coords = from_pixels(line, zoom, center, width, height).tolist()
+        m.add_line(staticmap.Line(coords, '#%02x%02x%02x' % color, line_width, simplify=False))
+    return m.render(zoom=zoom, center=center)
+
+
+_image_versions: weakref.WeakKeyDictionary[CompiledGraph, str] = weakref.WeakKeyDictionary()
+
+
+def image_version(graph: nx.Graph | CompiledGraph) -> str:
+    """Returns a hash of everything the image of the graph depends on: its version and the geometry and color of
+    its edges, which the version doesn't take into account. Like graph_version, it is only computed once per graph."""
+    compiled = compile_graph(graph)
+    if compiled not in _image_versions:
+        points, offsets, colors = edge_geometry(graph)
+        h = hashlib.blake2b(graph_version(compiled).encode(), digest_size=16)
+        for array, dtype in ((points, np.float64), (offsets, np.int64), (colors, np.uint8)):
+            h.update(np.ascontiguousarray(array, dtype=dtype).tobytes())
+        _image_versions[compiled] = h.hexdigest()
+    return _image_versions[compiled]
+
+
+def save_graph_image(graph: nx.Graph | CompiledGraph, filename: str, width: int, height: int) -> None:
+    """Saves the image of the graph (see render_graph) in the file. It is only rendered once for each version of the
+    image (see image_version) and image size, and kept in RASTER_DIRECTORY."""
+    cached = os.path.join(RASTER_DIRECTORY, f'{image_version(graph)}_{width}x{height}.png')
+    if not os.path.exists(cached):
+        os.makedirs(RASTER_DIRECTORY, exist_ok=True)
+        render_graph(graph, width, height).save(cached + '.tmp', format='PNG')
+        os.replace(cached + '.tmp', cached)
+    shutil.copyfile(cached, filename)
+
+
+class BaseMapCache:
+    """Images of the map of the city with nothing drawn over it, for each size, zoom and center, keeping the maxsize
+    most recently used ones."""
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.images: OrderedDict[tuple, Image.Image] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, width: int, height: int, zoom: int, center: tuple[float, float]) -> Image.Image:
+        """Returns the base map, rendering it if it isn't kept. It must not be modified."""
+        key = (width, height, zoom, center)
+        image = self.images.get(key)
+        if image is not None:
+            self.hits += 1
+            self.images.move_to_end(key)
+            return image
+
+        self.misses += 1
+        image = static_map(width, height).render_base(zoom, center)
+        self.images[key] = image
+        if len(self.images) > self.maxsize:
+            self.images.popitem(last=False)
+        return image
+
+    def clear(self) -> None:
+        """Forgets all the base maps."""
+        self.images.clear()
+        self.hits = self.misses = 0
+
+
+base_maps = BaseMapCache(BASE_CACHE_SIZE)  # the base maps of all the routes of the process
+
+
+def base_view(points: np.ndarray, width: int, height: int) -> tuple[int, tuple[float, float]]:
+    """Returns the zoom and the center (lon, lat) of a map of the given size (px) with all the points. The center is
+    rounded to a multiple of BASE_BUCKET pixels, so that nearby routes share the same base map, and the zoom leaves
+    enough margin for the points to fit anyway."""
+    margin = BASE_BUCKET // 2 + MARKER_MARGIN
+    zoom, center = map_view(points, max(width - 2 * margin, 1), max(height - 2 * margin, 1))
+    x = round(float(tile_x(center[0], zoom)) * TILE_SIZE / BASE_BUCKET) * BASE_BUCKET / TILE_SIZE
+    y = round(float(tile_y(center[1], zoom)) * TILE_SIZE / BASE_BUCKET) * BASE_BUCKET / TILE_SIZE
+    return zoom, (float(tile_lon(x, zoom)), float(tile_lat(y, zoom)))
+
+
+def overlay_map(lines: list[OverlayLine], markers: list[OverlayMarker], width: int, height: int) -> Image.Image:
+    """Returns an image of the lines and markers over the map of the city. The base map comes from base_maps and
+    only the lines and markers are drawn, like staticmap does: at twice the size, and then reduced so that their
+    borders are smooth."""
+    points = np.array([point for coords, _, _ in lines for point in coords] + [point for point, _, _ in markers],
+                      dtype=np.float64).reshape(-1, 2)
+    zoom, center = base_view(points, width, height)
+
+    overlay = Image.new('RGBA', (width * 2, height * 2), (255, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    for coords, color, line_width in lines:
+        pixels = [tuple(point) for point in (to_pixels(np.array(coords).reshape(-1, 2), zoom, center, width, height)
+                                             * 2).tolist()]
+        for x, y in pixels:
+            # the joints of the segments are rounded
+            draw.ellipse((x - line_width + 1, y - line_width + 1, x + line_width - 1, y + line_width - 1), fill=color)
+        draw.line(pixels, fill=color, width=line_width * 2)
+    for point, color, marker_width in markers:
+        x, y = (to_pixels(np.array([point]), zoom, center, width, height)[0] * 2).tolist()
+        draw.ellipse((x - marker_width, y - marker_width, x + marker_width, y + marker_width), fill=color)
+
+    image = base_maps.get(width, height, zoom, center).copy()
+    box = overlay.getbbox()
+    if box is not None:
+        # only the part with something drawn is reduced, averaging each 2x2 block with premultiplied alpha, which
+        # smooths the borders like staticmap's resize but much faster
+        left, top = box[0] // 2 * 2, box[1] // 2 * 2
+        right, bottom = -(-box[2] // 2) * 2, -(-box[3] // 2) * 2
+        part = overlay.crop((left, top, right, bottom)).convert('RGBa').reduce(2).convert('RGBA')
+        image.paste(part, (left // 2, top // 2), part)
+    return image
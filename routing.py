@@ -0,0 +1,487 @@
+# routing.py
+from __future__ import annotations
+
+import hashlib
+import heapq
+import math
+import os
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import TYPE_CHECKING, Any, Iterable, Iterator, Mapping, Sequence
+
+import networkx as nx
+import numpy as np
+
+if TYPE_CHECKING:
+    from buses import Node
+
+EARTH_RADIUS = 6371008.8  # mean radius (m) of the Earth, the same one used by the haversine library
+LANDMARKS = 8  # number of landmarks whose times bound the remaining time of the A* searches
+
+
+@dataclass(eq=False)
+class CompiledGraph:
+    """Array-backed (CSR) representation of a weighted directed graph. Each node is identified by its position
+    in `nodes`, and the edges leaving node i are the ones from offsets[i] to offsets[i+1].
+    It can also be read like a networkx DiGraph (nodes, edges, get_edge_data, subgraph)."""
+    nodes: Sequence[Node]  # side table: integer id -> original node (Cruilla, MultiParada, Parada...)
+    offsets: np.ndarray  # int64 array of length len(nodes) + 1
+    targets: np.ndarray  # int64 array with the target node id of each edge
+    weights: np.ndarray  # float64 array with the weight ('time') of each edge
+    edge_attrs: Sequence[dict[str, Any]]  # side table: edge id -> attributes of the original edge
+    coords: np.ndarray | None = None  # float64 (nodes x 2) array with the (x, y) coordinates of each node
+    index: Mapping[Node, int] | None = field(default=None, repr=False)  # original node -> integer id
+    version: str | None = field(default=None, repr=False)  # graph_version, if it is already known (graph file)
+
+    def __post_init__(self) -> None:
+        if self.coords is None:
+            self.coords = np.array([node.coord.xy for node in self.nodes], dtype=np.float64).reshape(-1, 2)
+        if self.index is None:
+            self.index = {node: i for i, node in enumerate(self.nodes)}
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __iter__(self) -> Iterator[Node]:
+        return iter(self.nodes)
+
+    def number_of_edges(self) -> int:
+        """Returns the number of edges of the graph."""
+        return len(self.targets)
+
+    def edges(self, data: bool = False) -> Iterator[tuple]:
+        """Iterates over the edges as (node1, node2) or, if data is True, (node1, node2, attributes)."""
+        sources = self.edge_sources()
+        for e, (i, j) in enumerate(zip(sources.tolist(), self.targets.tolist())):
+            if data:
+                yield self.nodes[i], self.nodes[j], self.edge_attrs[e]
+            else:
+                yield self.nodes[i], self.nodes[j]
+
+    def edge_id(self, node1: Node, node2: Node) -> int | None:
+        """Returns the id of the edge from node1 to node2, or None if there is no such edge."""
+        i = self.index.get(node1)
+        j = self.index.get(node2)
+        if i is None or j is None:
+            return None
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        found = np.flatnonzero(self.targets[start:end] == j)
+        return start + int(found[0]) if len(found) else None
+
+    def get_edge_data(self, node1: Node, node2: Node, default: Any = None) -> dict[str, Any] | Any:
+        """Returns the attributes of the edge from node1 to node2, or default if there is no such edge."""
+        e = self.edge_id(node1, node2)
+        return default if e is None else self.edge_attrs[e]
+
+    def to_networkx(self, nodes: Iterable[Node] | None = None) -> nx.DiGraph:
+        """Returns a networkx DiGraph with the given nodes (all of them if None) and the edges between them."""
+        graph = nx.DiGraph()
+        if nodes is None:
+            graph.add_nodes_from(self.nodes)
+            graph.add_edges_from(self.edges(data=True))
+            return graph
+
+        ids = sorted({self.index[node] for node in nodes})
+        graph.add_nodes_from(self.nodes[i] for i in ids)
+        for i in ids:
+            for e in range(int(self.offsets[i]), int(self.offsets[i + 1])):
+                j = int(self.targets[e])
+                if self.nodes[j] in graph:
+                    graph.add_edge(self.nodes[i], self.nodes[j], **self.edge_attrs[e])
+        return graph
+
+    def subgraph(self, nodes: Iterable[Node]) -> nx.DiGraph:
+        """Returns the subgraph induced by the given nodes, as a networkx DiGraph."""
+        return self.to_networkx(nodes)
+
+    @cached_property
+    def adjacency(self) -> tuple[memoryview, memoryview, memoryview]:
+        """Returns the CSR arrays as memoryviews, which are as fast as python lists to index one element at a time
+        but don't copy the arrays, so the processes that map the same graph file still share its pages."""
+        return (memoryview(np.ascontiguousarray(self.offsets, dtype=np.int64)),
+                memoryview(np.ascontiguousarray(self.targets, dtype=np.int64)),
+                memoryview(np.ascontiguousarray(self.weights, dtype=np.float64)))
+
+    def edge_sources(self) -> np.ndarray:
+        """Returns the source node id of each edge."""
+        return np.repeat(np.arange(len(self.nodes)), np.diff(self.offsets))
+
+    @cached_property
+    def reverse_adjacency(self) -> tuple[memoryview, memoryview, memoryview]:
+        """Returns the CSR arrays of the reversed graph, as memoryviews: the edges arriving at node i are
+        edge_ids[offsets[i]:offsets[i+1]], and sources holds the node each of them comes from."""
+        order = np.argsort(self.targets, kind='stable')
+        offsets = np.zeros(len(self.nodes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.targets, minlength=len(self.nodes)), out=offsets[1:])
+        return memoryview(offsets), memoryview(self.edge_sources()[order]), memoryview(order.astype(np.int64))
+
+
+_compiled_graphs: weakref.WeakKeyDictionary[nx.DiGraph, CompiledGraph] = weakref.WeakKeyDictionary()
+
+
+def compile_graph(graph: nx.DiGraph | CompiledGraph, weight: str = 'time') -> CompiledGraph:
+    """Returns the CSR representation of the graph. It is only built the first time it is asked for a given graph."""
+    if isinstance(graph, CompiledGraph):
+        return graph
+    if graph not in _compiled_graphs:
+        _compiled_graphs[graph] = from_networkx(graph, weight)
+    return _compiled_graphs[graph]
+
+
+def from_networkx(graph: nx.DiGraph, weight: str = 'time', coords: np.ndarray | None = None) -> CompiledGraph:
+    """Builds the CSR representation of a networkx directed graph, using the given edge attribute as weight.
+    The coordinates of the nodes are taken from their coord attribute unless they are given."""
+    nodes = list(graph.nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+
+    offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+    targets = []
+    weights = []
+    edge_attrs = []
+    for i, node in enumerate(nodes):
+        for neighbour, attrs in graph.adj[node].items():
+            targets.append(index[neighbour])
+            weights.append(attrs[weight])
+            edge_attrs.append(attrs)
+        offsets[i + 1] = len(targets)
+
+    return CompiledGraph(nodes, offsets, np.array(targets, dtype=np.int64),
+                         np.array(weights, dtype=np.float64), edge_attrs, coords, index)
+
+
+def graph_version(graph: CompiledGraph) -> str:
+    """Returns a hash of the edges and weights of the graph, which only changes if the routes found on it can
+    change. It is the same for the same graph loaded in another process, and it is only computed once per graph:
+    a graph loaded from a file already has the one computed when it was saved."""
+    if graph.version is None:
+        h = hashlib.blake2b(digest_size=16)
+        for array, dtype in ((graph.offsets, np.int64), (graph.targets, np.int64), (graph.weights, np.float64)):
+            h.update(np.ascontiguousarray(array, dtype=dtype).tobytes())
+        graph.version = h.hexdigest()
+    return graph.version
+
+
+RouteKey = tuple[int, int, str]  # (source node id, destination node id, graph version)
+
+
+class RouteCache:
+    """Least recently used routes found by the searches, as the edge ids from a source node to a destination node
+    of a graph, keeping at most maxsize of them. It counts the hits, the misses and the evicted routes."""
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.routes: OrderedDict[RouteKey, list[int]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.routes)
+
+    def get(self, key: RouteKey) -> list[int] | None:
+        """Returns the route with the given key, or None if it isn't in the cache."""
+        edges = self.routes.get(key)
+        if edges is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.routes.move_to_end(key)
+        return edges
+
+    def put(self, key: RouteKey, edges: list[int]) -> None:
+        """Adds the route with the given key, evicting the least recently used ones if the cache is full."""
+        self.routes[key] = edges
+        self.routes.move_to_end(key)
+        while len(self.routes) > self.maxsize:
+            self.routes.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """Removes all the routes and resets the counters."""
+        self.routes.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def save(self, filename: str) -> None:
+        """Saves the routes in a file, from the least to the most recently used."""
+        keys = list(self.routes)
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum([len(edges) for edges in self.routes.values()], out=offsets[1:])
+        edges = [e for route in self.routes.values() for e in route]
+        with open(filename + '.tmp', 'wb') as f:
+            np.savez(f, nodes=np.array([key[:2] for key in keys], dtype=np.int64).reshape(-1, 2),
+                     versions=np.array([key[2] for key in keys], dtype=str), offsets=offsets,
+                     edges=np.array(edges, dtype=np.int64))
+        os.replace(filename + '.tmp', filename)
+
+    def load(self, filename: str, version: str | None = None) -> None:
+        """Adds the routes saved in a file, as more recently used than the ones already in the cache. If a graph
+        version is given, the routes of other versions of the graph are left out."""
+        with np.load(filename) as arrays:
+            nodes, versions = arrays['nodes'].tolist(), arrays['versions'].tolist()
+            offsets, edges = arrays['offsets'].tolist(), arrays['edges'].tolist()
+        for i, ((src, dst), route_version) in enumerate(zip(nodes, versions)):
+            if version is None or route_version == version:
+                self.put((src, dst, route_version), edges[offsets[i]:offsets[i + 1]])
+
+
+def haversine_distances(lon: np.ndarray, lat: np.ndarray, lon0: float, lat0: float) -> np.ndarray:
+    """Returns the great circle distances (m) from the point (lon0, lat0) to all the given points, all in radians."""
+    a = np.sin((lat - lat0) / 2) ** 2 + np.cos(lat) * math.cos(lat0) * np.sin((lon - lon0) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def haversine_pairs(lon1: np.ndarray, lat1: np.ndarray, lon2: np.ndarray, lat2: np.ndarray) -> np.ndarray:
+    """Returns the great circle distance (m) between each pair of points, all in radians."""
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def dijkstra(graph: CompiledGraph, src: int, dst: int) -> tuple[list[int] | None, int]:
+    """Returns the ids of the edges of the shortest path from src to dst (None if dst is not reachable),
+    and the number of nodes settled by the search."""
+    paths, settled = dijkstra_many(graph, src, [dst])
+    return paths[dst], settled
+
+
+def dijkstra_many(graph: CompiledGraph, src: int, dsts: Iterable[int]) -> tuple[dict[int, list[int] | None], int]:
+    """Runs a single Dijkstra search from src, which stops as soon as all the destinations have been settled.
+    Returns the edge ids of the shortest path to each destination (None if it is not reachable),
+    and the number of nodes settled by the search."""
+    offsets, targets, weights = graph.adjacency
+
+    pending = set(dsts)
+    paths: dict[int, list[int] | None] = {dst: None for dst in pending}
+    dist = {src: 0.0}
+    pred_edge: dict[int, int] = {}
+    settled = set()
+    heap = [(0.0, src)]
+
+    while heap and pending:
+        d, u = heapq.heappop(heap)
+        if u in settled:
+            continue
+        settled.add(u)
+        if u in pending:
+            pending.remove(u)
+            paths[u] = edges_to(pred_edge, src, u, offsets)
+
+        for e in range(offsets[u], offsets[u + 1]):
+            v = targets[e]
+            new_dist = d + weights[e]
+            if new_dist < dist.get(v, float('inf')):
+                dist[v] = new_dist
+                pred_edge[v] = e
+                heapq.heappush(heap, (new_dist, v))
+
+    return paths, len(settled)
+
+
+def astar(graph: CompiledGraph, src: int, dst: int, max_speed: float) -> tuple[list[int] | None, int]:
+    """Same as dijkstra, but the search is guided towards dst using as heuristic a lower bound of the time to dst:
+    the largest of the straight line distance to dst divided by max_speed and the bounds given by the landmarks of
+    the graph (see landmark_bounds). It finds the shortest path as long as no edge can be travelled faster than
+    max_speed."""
+    offsets, targets, weights = graph.adjacency
+    h = landmark_bounds(graph, dst, max_speed).tolist()
+
+    dist = {src: 0.0}
+    pred_edge: dict[int, int] = {}
+    settled = set()
+    heap = [(h[src], src)]
+
+    while heap:
+        _, u = heapq.heappop(heap)
+        if u in settled:
+            continue
+        settled.add(u)
+        if u == dst:
+            return edges_to(pred_edge, src, dst, offsets), len(settled)
+
+        d = dist[u]
+        for e in range(offsets[u], offsets[u + 1]):
+            v = targets[e]
+            new_dist = d + weights[e]
+            if new_dist < dist.get(v, float('inf')) and h[v] != float('inf'):
+                dist[v] = new_dist
+                pred_edge[v] = e
+                heapq.heappush(heap, (new_dist + h[v], v))
+
+    return None, len(settled)
+
+
+@dataclass(frozen=True)
+class Landmarks:
+    """A few nodes far apart from each other, with the time from each of them to every node (to_nodes) and from every
+    node to each of them (from_nodes), inf where there is no path. By the triangle inequality, they bound the time
+    between any two nodes (see landmark_bounds)."""
+    nodes: list[int]
+    to_nodes: np.ndarray  # float64 (landmarks x nodes)
+    from_nodes: np.ndarray  # float64 (landmarks x nodes)
+
+
+_landmarks: weakref.WeakKeyDictionary[CompiledGraph, Landmarks] = weakref.WeakKeyDictionary()
+
+
+def landmarks(graph: CompiledGraph, count: int = LANDMARKS) -> Landmarks:
+    """Returns the landmarks of the graph, which are chosen the first time they are asked for: each one is the node
+    farthest from the ones already chosen, among the ones they can reach, starting from the first node."""
+    if graph not in _landmarks:
+        nodes: list[int] = []
+        to_nodes = []
+        from_nodes = []
+        nearest = np.full(len(graph), np.inf)  # time from the nearest landmark to each node
+        node = 0
+        for _ in range(min(count, len(graph))):
+            nodes.append(node)
+            to_nodes.append(dijkstra_times(graph, node))
+            from_nodes.append(reverse_dijkstra(graph, node)[0])
+            nearest = np.minimum(nearest, to_nodes[-1])
+            reachable = np.flatnonzero(np.isfinite(nearest))
+            node = int(reachable[np.argmax(nearest[reachable])])
+            if nearest[node] == 0:
+                break
+        _landmarks[graph] = Landmarks(nodes, np.array(to_nodes), np.array(from_nodes))
+    return _landmarks[graph]
+
+
+def landmark_bounds(graph: CompiledGraph, dst: int, max_speed: float) -> np.ndarray:
+    """Returns a lower bound of the time (s) from every node to dst: the straight line distance divided by
+    max_speed, or the landmark bounds if they are larger. For a landmark L, the time from v to dst is at least
+    time(L, dst) - time(L, v) and time(v, L) - time(dst, L). It is inf for the nodes that can't reach dst."""
+    lon, lat = np.radians(np.asarray(graph.coords, dtype=np.float64)).T
+    bounds = haversine_distances(lon, lat, lon[dst], lat[dst]) / max_speed
+
+    marks = landmarks(graph)
+    with np.errstate(invalid='ignore'):
+        bounds_to = marks.to_nodes[:, dst, None] - marks.to_nodes
+        bounds_from = marks.from_nodes - marks.from_nodes[:, dst, None]
+    # inf - inf means the landmark tells nothing about the node
+    for landmark_bound in (bounds_to, bounds_from):
+        np.nan_to_num(landmark_bound, copy=False, nan=0.0, posinf=np.inf, neginf=0.0)
+        bounds = np.maximum(bounds, landmark_bound.max(axis=0, initial=0.0))
+    return bounds
+
+
+def dijkstra_times(graph: CompiledGraph, src: int) -> np.ndarray:
+    """Runs a complete Dijkstra search from src. Returns the travel time from src to every node (inf if it can't be
+    reached)."""
+    offsets, targets, weights = graph.adjacency
+
+    dist = [float('inf')] * len(graph)
+    settled = [False] * len(graph)
+    dist[src] = 0.0
+    heap = [(0.0, src)]
+
+    while heap:
+        d, u = heapq.heappop(heap)
+        if settled[u]:
+            continue
+        settled[u] = True
+
+        for e in range(offsets[u], offsets[u + 1]):
+            v = targets[e]
+            new_dist = d + weights[e]
+            if new_dist < dist[v]:
+                dist[v] = new_dist
+                heapq.heappush(heap, (new_dist, v))
+
+    return np.array(dist)
+
+
+def haversine(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    """Returns the great circle distance (m) between two points given in radians."""
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def reverse_dijkstra(graph: CompiledGraph, dst: int) -> tuple[np.ndarray, np.ndarray]:
+    """Runs a complete backward Dijkstra search to dst. Returns the travel time from every node to dst (inf if it
+    can't reach it) and the id of the first edge of the shortest path from every node to dst (-1 if there is none)."""
+    offsets, sources, edge_ids = graph.reverse_adjacency
+    _, _, weights = graph.adjacency
+
+    dist = [float('inf')] * len(graph)
+    succ_edge = [-1] * len(graph)
+    settled = [False] * len(graph)
+    dist[dst] = 0.0
+    heap = [(0.0, dst)]
+
+    while heap:
+        d, v = heapq.heappop(heap)
+        if settled[v]:
+            continue
+        settled[v] = True
+
+        for i in range(offsets[v], offsets[v + 1]):
+            u = sources[i]
+            e = edge_ids[i]
+            new_dist = d + weights[e]
+            if new_dist < dist[u]:
+                dist[u] = new_dist
+                succ_edge[u] = e
+                heapq.heappush(heap, (new_dist, u))
+
+    return np.array(dist), np.array(succ_edge, dtype=np.int64)
+
+
+def edges_from(succ_edge: Sequence[int], src: int, targets: list[int]) -> list[int]:
+    """Follows the successor edges from src until reaching a node without successor (the destination of the
+    backward search), and returns the ids of the edges travelled."""
+    edges = []
+    node = src
+    while (e := int(succ_edge[node])) != -1:
+        edges.append(e)
+        node = targets[e]
+    return edges
+
+
+def path_sums(succ_edge: Sequence[int], targets: Sequence[int], values: np.ndarray) -> np.ndarray:
+    """Returns, for every node, the sum of the values of the edges travelled following the successor edges from it
+    (see edges_from), for all the nodes at once: each step doubles the number of edges every node has added up, so
+    it only takes as many steps as the logarithm of the longest path. values can have a column for each quantity."""
+    succ_edge = np.asarray(succ_edge, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    has_successor = succ_edge != -1
+    edges = succ_edge[has_successor]
+
+    nxt = np.arange(len(succ_edge))
+    nxt[has_successor] = np.asarray(targets)[edges]
+    sums = np.zeros((len(succ_edge),) + values.shape[1:])
+    sums[has_successor] = values[edges]
+
+    while not np.array_equal(jumped := nxt[nxt], nxt):
+        sums += sums[nxt]
+        nxt = jumped
+    return sums
+
+
+def edges_to(pred_edge: dict[int, int], src: int, dst: int, offsets: list[int]) -> list[int]:
+    """Follows the predecessor edges back from dst to src and returns the edge ids in the order they are travelled."""
+    edges = []
+    node = dst
+    while node != src:
+        e = pred_edge[node]
+        edges.append(e)
+        node = source_of(e, offsets)
+    edges.reverse()
+    return edges
+
+
+def source_of(edge: int, offsets: list[int]) -> int:
+    """Returns the source node id of an edge, by binary search on the CSR offsets."""
+    lo, hi = 0, len(offsets) - 1
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if offsets[mid] <= edge:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def route_nodes(graph: CompiledGraph, src: int, edges: list[int]) -> list[Node]:
+    """Returns the original nodes visited when following the edges from src."""
+    _, targets, _ = graph.adjacency
+    return [graph.nodes[src]] + [graph.nodes[targets[e]] for e in edges]
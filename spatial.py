@@ -0,0 +1,149 @@
+# spatial.py
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+from typing import Sequence
+
+import numpy as np
+
+from routing import EARTH_RADIUS, haversine_distances
+
+CELL_SIZE = 100  # side (m) of each cell of the grid
+PROJECTION_ERROR = 0.01  # maximum relative error of the projected distances over a city, compared to the real ones
+
+
+@dataclass(frozen=True)
+class SpatialIndex:
+    """Grid of square cells over the points, projected to metres around their mean latitude. The points of each
+    cell are stored together, sorted by cell, so that the ones near a coordinate are found looking only at the
+    nearby cells. The reported distances are great circle distances."""
+    ids: np.ndarray  # id of each point (the node it stands for)
+    lon: np.ndarray  # coordinates of each point, in degrees
+    lat: np.ndarray
+    cell_offsets: np.ndarray  # points of cell c are the ones from cell_offsets[c] to cell_offsets[c+1]
+    grid: np.ndarray  # [x of the first column, y of the first row, scale of the x axis, cell size, columns, rows]
+
+    def project(self, X: Sequence[float], Y: Sequence[float]) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the projected coordinates (m) of the points (X[k], Y[k])."""
+        scale = self.grid[2]
+        return np.radians(np.asarray(X, dtype=np.float64)) * EARTH_RADIUS * scale, \
+            np.radians(np.asarray(Y, dtype=np.float64)) * EARTH_RADIUS
+
+    def cell_of(self, x: float, y: float) -> tuple[int, int]:
+        """Returns the column and row of the cell of the projected point, or of the closest cell if it is outside."""
+        x0, y0, _, cell, columns, rows = self.grid
+        return min(max(int((x - x0) // cell), 0), int(columns) - 1), min(max(int((y - y0) // cell), 0), int(rows) - 1)
+
+    def points_in(self, column_range: range, row_range: range) -> np.ndarray:
+        """Returns the positions of the points in the cells of the given columns and rows."""
+        columns = int(self.grid[4])
+        pieces = [np.arange(self.cell_offsets[row * columns + column_range.start],
+                            self.cell_offsets[row * columns + column_range.stop]) for row in row_range]
+        return np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.int64)
+
+    def distances(self, points: np.ndarray, x: float, y: float) -> np.ndarray:
+        """Returns the great circle distances (m) from the coordinate (x, y), in degrees, to the given points."""
+        return haversine_distances(np.radians(self.lon[points]), np.radians(self.lat[points]),
+                                   math.radians(x), math.radians(y))
+
+    def nearest(self, X: Sequence[float], Y: Sequence[float], k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        """Returns, for each coordinate (X[i], Y[i]), the ids of its k nearest points and the distances (m) to them,
+        closest first, as two arrays of shape (len(X), k)."""
+        k = min(k, len(self.ids))
+        ids = np.empty((len(X), k), dtype=self.ids.dtype)
+        dists = np.empty((len(X), k), dtype=np.float64)
+        x0, y0, _, cell, columns, rows = self.grid
+        columns, rows = int(columns), int(rows)
+
+        for i, (px, py) in enumerate(zip(*self.project(X, Y))):
+            column, row = self.cell_of(px, py)
+            # distance from the point to the grid along each axis, 0 if it is inside
+            gx = max(x0 - px, 0, px - (x0 + columns * cell))
+            gy = max(y0 - py, 0, py - (y0 + rows * cell))
+            points = np.zeros(0, dtype=np.int64)
+            dist = np.zeros(0)
+            ring = 0
+            while True:
+                # the square of cells at distance ring from the cell of the point, clipped to the grid
+                first_column, last_column = max(column - ring, 0), min(column + ring, columns - 1)
+                first_row, last_row = max(row - ring, 0), min(row + ring, rows - 1)
+                found = []
+                for r in range(first_row, last_row + 1):
+                    if r in (row - ring, row + ring):
+                        found.append(self.points_in(range(first_column, last_column + 1), range(r, r + 1)))
+                    else:
+                        for c in {column - ring, column + ring} & {first_column, last_column}:
+                            found.append(self.points_in(range(c, c + 1), range(r, r + 1)))
+                new_points = np.concatenate(found)
+                if len(new_points):
+                    points = np.concatenate((points, new_points))
+                    dist = np.concatenate((dist, self.distances(new_points, X[i], Y[i])))
+
+                # the points not seen yet are beyond the sides of the square that are not on the border of the grid
+                sides = [math.hypot(px - (x0 + first_column * cell), gy) if first_column > 0 else math.inf,
+                         math.hypot(x0 + (last_column + 1) * cell - px, gy) if last_column < columns - 1 else math.inf,
+                         math.hypot(py - (y0 + first_row * cell), gx) if first_row > 0 else math.inf,
+                         math.hypot(y0 + (last_row + 1) * cell - py, gx) if last_row < rows - 1 else math.inf]
+                unseen = min(sides) * (1 - PROJECTION_ERROR)
+
+                if len(points) >= k:
+                    best = np.argsort(dist, kind='stable')[:k]
+                    if dist[best[-1]] <= unseen:
+                        ids[i] = self.ids[points[best]]
+                        dists[i] = dist[best]
+                        break
+                ring += 1
+
+        return ids, dists
+
+    def within(self, X: Sequence[float], Y: Sequence[float], radius: float) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Returns, for each coordinate (X[i], Y[i]), the ids of the points at most radius (m) away from it and the
+        distances (m) to them, closest first."""
+        result = []
+        reach = radius / (1 - PROJECTION_ERROR)
+        for i, (px, py) in enumerate(zip(*self.project(X, Y))):
+            first_column, first_row = self.cell_of(px - reach, py - reach)
+            last_column, last_row = self.cell_of(px + reach, py + reach)
+            points = self.points_in(range(first_column, last_column + 1), range(first_row, last_row + 1))
+            dist = self.distances(points, X[i], Y[i])
+            order = np.argsort(dist, kind='stable')
+            order = order[dist[order] <= radius]
+            result.append((self.ids[points[order]], dist[order]))
+        return result
+
+
+def build_index(ids: Sequence[int], lon: Sequence[float], lat: Sequence[float], cell_size: float = CELL_SIZE) -> SpatialIndex:
+    """Returns the spatial index of the points with the given ids and coordinates (in degrees)."""
+    ids = np.asarray(ids, dtype=np.int64)
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    if len(ids) == 0:
+        raise ValueError("No es pot crear un índex espacial sense punts.")
+
+    scale = math.cos(math.radians(float(lat.mean())))
+    x = np.radians(lon) * EARTH_RADIUS * scale
+    y = np.radians(lat) * EARTH_RADIUS
+    x0, y0 = float(x.min()), float(y.min())
+    columns = int((x.max() - x0) // cell_size) + 1
+    rows = int((y.max() - y0) // cell_size) + 1
+
+    cells = ((y - y0) // cell_size).astype(np.int64) * columns + ((x - x0) // cell_size).astype(np.int64)
+    order = np.argsort(cells, kind='stable')
+    cell_offsets = np.zeros(columns * rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cells, minlength=columns * rows), out=cell_offsets[1:])
+
+    return SpatialIndex(ids[order], lon[order], lat[order], cell_offsets,
+                        np.array([x0, y0, scale, cell_size, columns, rows], dtype=np.float64))
+
+
+def save_index(index: SpatialIndex, filename: str) -> None:
+    """Saves the spatial index in a file."""
+    with open(filename, 'wb') as f:
+        np.savez(f, **{name: getattr(index, name) for name in index.__dataclass_fields__})
+
+
+def load_index(filename: str) -> SpatialIndex:
+    """Loads the spatial index in the file."""
+    with np.load(filename) as arrays:
+        return SpatialIndex(**{name: arrays[name] for name in SpatialIndex.__dataclass_fields__})
@@ -0,0 +1,199 @@
+# tiles.py
+from __future__ import annotations
+
+import argparse
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import requests
+import staticmap
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+TILE_URL = 'http://a.tile.komoot.de/komoot-2/{z}/{x}/{y}.png'  # the tiles staticmap uses by default
+TILE_SIZE = 256  # side (px) of each tile
+TILE_DIRECTORY = os.environ.get('CINEBUS_TILES', 'tiles')  # tiles kept as directory/z/x/y.png
+TILE_CACHE_BYTES = 500 * 2**20  # the least recently used tiles are removed when the cache is bigger than this
+OFFLINE = os.environ.get('CINEBUS_TILES_OFFLINE') == '1'  # only the tiles in the directory are used
+TIMEOUT = 10  # maximum time (s) waiting for a tile
+DOWNLOADS = 8  # number of tiles downloaded at the same time
+BARCELONA = (2.05, 41.31, 2.24, 41.47)  # extent (min lon, min lat, max lon, max lat) prefetched by default
+
+Tile = tuple[int, int, int]  # (z, x, y)
+
+
+class TileProvider:
+    """Map tiles read from a directory and, if they are not there, downloaded and saved in it. The directory is
+    kept under max_bytes removing the least recently used tiles. In offline mode nothing is downloaded and the
+    missing tiles are left blank."""
+
+    def __init__(self, url: str = TILE_URL, directory: str = TILE_DIRECTORY, max_bytes: int = TILE_CACHE_BYTES,
+                 offline: bool = OFFLINE) -> None:
+        self.url = url
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.used: OrderedDict[str, int] | None = None  # size of each tile file, least recently used first
+        self.total_bytes = 0
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'Cinebus'
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=DOWNLOADS))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=DOWNLOADS))
+
+    def path(self, tile: Tile) -> str:
+        """Returns the file of the tile."""
+        z, x, y = tile
+        return os.path.join(self.directory, str(z), str(x), f'{y}.png')
+
+    def get(self, tile: Tile) -> bytes | None:
+        """Returns the png image of the tile, or None if it isn't in the directory and it can't be downloaded."""
+        path = self.path(tile)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            pass
+        else:
+            self.touch(path)
+            return content
+
+        if self.offline:
+            return None
+        try:
+            response = self.session.get(self.url.format(z=tile[0], x=tile[1], y=tile[2]), timeout=TIMEOUT)
+        except requests.RequestException:
+            return None
+        if response.status_code != 200:
+            return None
+        self.add(path, response.content)
+        return response.content
+
+    def prefetch(self, tiles: list[Tile]) -> int:
+        """Downloads at the same time the tiles that aren't in the directory yet. Returns how many are missing."""
+        missing = [tile for tile in tiles if not os.path.exists(self.path(tile))]
+        if self.offline:
+            return len(missing)
+        with ThreadPoolExecutor(DOWNLOADS) as executor:
+            return sum(content is None for content in executor.map(self.get, missing))
+
+    def scan(self) -> None:
+        """Finds the tiles already in the directory, ordered by their last use, the first time it is needed."""
+        if self.used is not None:
+            return
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.png'):
+                    stat = os.stat(os.path.join(root, name))
+                    files.append((stat.st_mtime_ns, os.path.join(root, name), stat.st_size))
+        self.used = OrderedDict((path, size) for _, path, size in sorted(files))
+        self.total_bytes = sum(self.used.values())
+
+    def touch(self, path: str) -> None:
+        """Marks the tile file as the most recently used one."""
+        if self.offline:
+            return
+        with self.lock:
+            self.scan()
+            if path in self.used:
+                self.used.move_to_end(path)
+            os.utime(path)  # so that the order is kept for the next time
+
+    def add(self, path: str, content: bytes) -> None:
+        """Saves a downloaded tile, removing the least recently used ones if the directory gets too big."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the file is written aside, so that no other thread or process reads it half written
+        temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(content)
+        os.replace(temporary, path)
+
+        with self.lock:
+            self.scan()
+            self.total_bytes += len(content) - self.used.pop(path, 0)
+            self.used[path] = len(content)
+            while self.total_bytes > self.max_bytes and len(self.used) > 1:
+                old_path, size = self.used.popitem(last=False)
+                self.total_bytes -= size
+                try:
+                    os.remove(old_path)
+                except FileNotFoundError:
+                    pass
+
+
+class CachedStaticMap(staticmap.StaticMap):
+    """StaticMap that takes its tiles from a TileProvider instead of asking the tile server for them every time."""
+
+    def __init__(self, width: int, height: int, provider: TileProvider, **kwargs) -> None:
+        # the 'url' of each tile is just its z/x/y, which the provider turns into a file or a real url
+        super().__init__(width, height, url_template='{z}/{x}/{y}', tile_size=TILE_SIZE, **kwargs)
+        self.provider = provider
+
+    def get(self, url: str, **kwargs) -> tuple[int, bytes | None]:
+        z, x, y = map(int, url.split('/'))
+        content = self.provider.get((z, x, y))
+        if content is None and self.provider.offline:
+            return 200, blank_tile()
+        return (404, None) if content is None else (200, content)
+
+    def render_base(self, zoom: int, center: tuple[float, float]) -> Image.Image:
+        """Returns the map with only its tiles, like render with no features but without drawing and reducing an
+        empty layer over them."""
+        self.zoom = zoom
+        self.x_center = (center[0] + 180) / 360 * 2**zoom
+        lat = math.radians(center[1])
+        self.y_center = (1 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi) / 2 * 2**zoom
+        image = Image.new('RGB', (self.width, self.height), self.background_color)
+        self._draw_base_layer(image)
+        return image
+
+
+_blank_tile: bytes | None = None
+
+
+def blank_tile() -> bytes:
+    """Returns a transparent tile, drawn where the map has no tile in offline mode."""
+    global _blank_tile
+    if _blank_tile is None:
+        buffer = BytesIO()
+        Image.new('RGBA', (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0)).save(buffer, format='PNG')
+        _blank_tile = buffer.getvalue()
+    return _blank_tile
+
+
+tile_provider = TileProvider()  # the tiles of all the maps of the application
+
+
+def static_map(width: int, height: int) -> CachedStaticMap:
+    """Returns an empty map of the given size (px), whose tiles come from tile_provider."""
+    return CachedStaticMap(width, height, tile_provider)
+
+
+def tiles_in(extent: tuple[float, float, float, float], zoom: int) -> list[Tile]:
+    """Returns the tiles that cover the extent (min lon, min lat, max lon, max lat) at the given zoom."""
+    def tile_x(lon: float) -> int:
+        return int((lon + 180) / 360 * 2**zoom)
+
+    def tile_y(lat: float) -> int:
+        lat = math.radians(lat)
+        return int((1 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi) / 2 * 2**zoom)
+
+    min_lon, min_lat, max_lon, max_lat = extent
+    return [(zoom, x, y) for x in range(tile_x(min_lon), tile_x(max_lon) + 1)
+            for y in range(tile_y(max_lat), tile_y(min_lat) + 1)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Downloads the map tiles of Barcelona that aren't saved yet.")
+    parser.add_argument('--zoom', type=int, nargs='+', default=[12, 13, 14, 15], help="zoom levels to download")
+    args = parser.parse_args()
+
+    for zoom in args.zoom:
+        tiles = tiles_in(BARCELONA, zoom)
+        failed = tile_provider.prefetch(tiles)
+        print(f"Zoom {zoom}: {len(tiles) - failed}/{len(tiles)} rajoles desades a {tile_provider.directory}.")
@@ -0,0 +1,265 @@
+# transit.py
+from __future__ import annotations
+
+import heapq
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from buses import BUS_SPEED, MultiParada, Parada
+from routing import CompiledGraph, haversine_distances, haversine_pairs, source_of
+
+MAX_ROUNDS = 5  # maximum number of buses taken in a journey (transfers + 1)
+EGRESS_WALKING_TIME = 900  # time (s) walking to the destination from the stops used to bound the journey early
+
+# kind of each node of the city graph, as seen by the transit network
+STREET, STOP, PARADA = 0, 1, 2
+
+
+@dataclass(frozen=True)
+class TransitNetwork:
+    """Bus lines of a compiled city graph, as routes for a round-based (RAPTOR) search. Stops are the MultiParada
+    nodes, where people get on and off the buses, and each route is a sequence of consecutive Parada nodes of a line
+    joined by Bus edges. All the times are the weights of the edges of the graph, so the paths found can be
+    followed in it."""
+    graph: CompiledGraph
+    kinds: list[int]  # STREET, STOP or PARADA, for each node of the graph
+    stops: list[int]  # graph node of each stop
+    stop_of: dict[int, int]  # stop of each MultiParada node of the graph
+    stop_routes: list[list[tuple[int, int]]]  # (route, position) of each of the times a route goes through each stop
+    route_stops: list[list[int]]  # stop at each position of each route
+    route_times: list[list[float]]  # time (s) riding from the first position of each route to each position
+    route_edges: list[list[int]]  # Bus edge from each position of each route to the next one
+    board_edges: list[list[int]]  # edge from the stop to the Parada at each position of each route (getting on)
+    alight_edges: list[list[int]]  # edge from the Parada to the stop at each position of each route (getting off)
+    walking_speed: float  # maximum straight line speed (m/s) along the streets of the graph
+    boarding_time: float  # minimum time (s) getting on a bus
+
+
+def build_network(graph: CompiledGraph, orig_parades: list[Parada], dest_parades: list[Parada],
+                  verbose: bool = False) -> TransitNetwork:
+    """Builds the transit network of the city graph from the lines of get_orig_dest_parades: consecutive pairs of
+    stops form a route as long as each one starts where the previous one ends and the graph has its Bus edge."""
+    start = time.perf_counter()
+    kinds = np.full(len(graph), STREET, dtype=np.int8)
+    stops: list[int] = []
+    stop_of: dict[int, int] = {}
+    routes: list[list[int]] = []  # Parada nodes of each route
+    route_edges: list[list[int]] = []
+
+    for orig, dest in zip(orig_parades, dest_parades):
+        if orig == dest:
+            continue
+        e = graph.edge_id(orig, dest)
+        if e is None:
+            continue
+        i, j = graph.index[orig], graph.index[dest]
+        if routes and routes[-1][-1] == i:
+            routes[-1].append(j)
+            route_edges[-1].append(e)
+        else:
+            routes.append([i, j])
+            route_edges.append([e])
+
+    _, _, weights = graph.adjacency
+    route_stops, route_times, board_edges, alight_edges = [], [], [], []
+    for nodes, edges in zip(routes, route_edges):
+        route_stops.append([])
+        board_edges.append([])
+        alight_edges.append([])
+        for node in nodes:
+            parada = graph.nodes[node]
+            multiparada = MultiParada(parada.id, parada.coord, nom=parada.nom)
+            m = graph.index[multiparada]
+            if m not in stop_of:
+                stop_of[m] = len(stops)
+                stops.append(m)
+            kinds[node] = PARADA
+            kinds[m] = STOP
+            route_stops[-1].append(stop_of[m])
+            board_edges[-1].append(graph.edge_id(multiparada, parada))
+            alight_edges[-1].append(graph.edge_id(parada, multiparada))
+        route_times.append(np.concatenate(([0.0], np.cumsum([weights[e] for e in edges]))).tolist())
+
+    stop_routes: list[list[tuple[int, int]]] = [[] for _ in stops]
+    for r, positions in enumerate(route_stops):
+        for p, s in enumerate(positions):
+            stop_routes[s].append((r, p))
+
+    # the straight line between the ends of a street is never longer than the street itself
+    lon, lat = np.radians(graph.coords).T
+    sources, targets = graph.edge_sources(), graph.targets
+    streets = (kinds[sources] == STREET) & (kinds[targets] == STREET) & (graph.weights > 0)
+    lengths = haversine_pairs(lon[sources[streets]], lat[sources[streets]], lon[targets[streets]], lat[targets[streets]])
+    walking_speed = float(np.max(lengths / graph.weights[streets], initial=0))
+
+    boarding_time = min((weights[e] for edges in board_edges for e in edges), default=0.0)
+
+    network = TransitNetwork(graph, kinds.tolist(), stops, stop_of, stop_routes, route_stops, route_times,
+                             route_edges, board_edges, alight_edges, walking_speed, boarding_time)
+    if verbose:
+        print(f"Xarxa de transport creada en {time.perf_counter() - start:.1f}s: {len(stops)} parades, "
+              f"{len(routes)} recorreguts.")
+    return network
+
+
+def walk(network: TransitNetwork, seeds: dict[int, float], dst: int, reached: list[float], pred_edge: dict[int, int],
+         lower_bound: list[float], limit: float = float('inf'), bound: float = float('inf'),
+         reverse: bool = False) -> tuple[dict[int, float], int]:
+    """Runs an A* search along the streets (buses are never taken) from all the seeds at once, each one starting
+    at the given time, guided by the lower bound of the time from each node to dst. reached holds the earliest
+    time each node has been reached so far, in this search or in any previous one, and only the nodes reached
+    earlier than that (and not later than limit) are updated, in place, together with the edges used to reach them.
+    Nodes from which dst can't be reached earlier than it already has, or than bound, are left out.
+    If reverse is True, the search goes backwards, finding the time from each node to the seeds.
+    Returns the time each node has been updated to and the number of nodes settled."""
+    offsets, targets, weights = network.graph.adjacency
+    if reverse:
+        offsets, targets, edge_ids = network.graph.reverse_adjacency
+    kinds = network.kinds
+
+    heap = [(d + lower_bound[node], d, node) for node, d in seeds.items()]
+    heapq.heapify(heap)
+    updated = dict(seeds)
+    settled = 0
+    best = min(reached[dst], bound)
+
+    while heap:
+        estimate, d, u = heapq.heappop(heap)
+        if estimate >= best:
+            break
+        if d > reached[u]:
+            continue
+        settled += 1
+
+        for i in range(offsets[u], offsets[u + 1]):
+            v = targets[i]
+            e = edge_ids[i] if reverse else i
+            new_dist = d + weights[e]
+            if new_dist < reached[v] and new_dist + lower_bound[v] < best and new_dist <= limit and kinds[v] != PARADA:
+                reached[v] = updated[v] = new_dist
+                pred_edge[v] = e
+                heapq.heappush(heap, (new_dist + lower_bound[v], new_dist, v))
+                if v == dst:
+                    best = new_dist
+
+    return updated, settled
+
+
+@dataclass
+class Search:
+    """State of a round-based search: the earliest time each node has been reached in any round, how it was
+    reached in each round (the edge used to walk to each node and the bus taken to each stop, with the time of
+    arrival, the route and the positions where it was taken and left), and the round where dst was reached."""
+    reached: list[float]
+    pred_edges: list[dict[int, int]]
+    rides: list[dict[int, tuple[float, int, int, int]]]
+    best_round: int = -1
+    settled: int = 0
+
+
+def rounds(network: TransitNetwork, src: int, dst: int, lower_bound: list[float], max_rounds: int) -> Search:
+    """Runs the rounds of a search from src to dst: round 0 walks from src to all the stops (and to dst) that can
+    still be part of a journey faster than walking to dst, and each of the next rounds takes one more bus, riding
+    the routes that go through the stops reached in the previous round, and walks from the stops where it gets off,
+    to other stops or to dst. The time from the stops around dst to dst is found first, so that the first buses
+    that get near dst already bound the time of the journey, and the rest of the searches can be pruned from the
+    start."""
+    _, _, weights = network.graph.adjacency
+    kinds, stops, stop_of = network.kinds, network.stops, network.stop_of
+    route_stops, route_times = network.route_stops, network.route_times
+
+    egress = [float('inf')] * len(kinds)
+    egress[dst] = 0.0
+    egress_stops, settled = walk(network, {dst: 0.0}, src, egress, {}, [0.0] * len(kinds), EGRESS_WALKING_TIME,
+                                 reverse=True)
+    bound = float('inf')  # time of the best journey known, walking from a stop around dst, and a bit more
+
+    search = Search([float('inf')] * len(kinds), [{}], [{}], settled=settled)
+    reached = search.reached
+    reached[src] = 0.0
+    updated, settled = walk(network, {src: 0.0}, dst, reached, search.pred_edges[0], lower_bound)
+    search.settled += settled
+    labels = [{stop_of[node]: d for node, d in updated.items() if kinds[node] == STOP}]  # stops reached in each round
+    if dst in updated:
+        search.best_round = 0
+
+    for k in range(1, max_rounds + 1):
+        first_position: dict[int, int] = {}
+        for s in labels[k - 1]:
+            for r, p in network.stop_routes[s]:
+                first_position[r] = min(p, first_position.get(r, p))
+
+        ride: dict[int, tuple[float, int, int, int]] = {}
+        for r, first in first_position.items():
+            boarded = float('inf')  # time at the first position of the route of the bus taken, if it had been there
+            board_position = -1
+            for p in range(first, len(route_stops[r])):
+                s = route_stops[r][p]
+                if board_position != -1:
+                    arrival = boarded + route_times[r][p] + weights[network.alight_edges[r][p]]
+                    node = stops[s]
+                    if arrival < reached[node] and arrival + lower_bound[node] < min(reached[dst], bound):
+                        reached[node] = arrival
+                        ride[s] = (arrival, r, board_position, p)
+                        if node in egress_stops:
+                            # a bit more, so that the walk to dst from this stop isn't left out
+                            bound = min(bound, (arrival + egress_stops[node]) * (1 + 1e-9))
+                if s in labels[k - 1]:
+                    boarding = labels[k - 1][s] + weights[network.board_edges[r][p]] - route_times[r][p]
+                    if boarding < boarded:
+                        boarded, board_position = boarding, p
+        search.settled += len(first_position)
+
+        search.rides.append(ride)
+        search.pred_edges.append({})
+        updated, settled = walk(network, {stops[s]: arrival for s, (arrival, *_) in ride.items()}, dst, reached,
+                                search.pred_edges[k], lower_bound, bound=bound)
+        search.settled += settled
+        labels.append({stop_of[node]: d for node, d in updated.items() if kinds[node] == STOP})
+        if dst in updated:
+            search.best_round = k
+        if not labels[k]:
+            break
+
+    return search
+
+
+def raptor(network: TransitNetwork, src: int, dst: int, max_rounds: int = MAX_ROUNDS) -> tuple[list[int] | None, int]:
+    """Returns the ids of the edges of the fastest journey from src to dst (None if dst is not reachable) taking up
+    to max_rounds buses, or walking all the way, and the number of nodes settled by the searches along the streets
+    plus the number of routes ridden. From any node, the rest of the journey either walks to dst or gets on a bus
+    and goes at most at its speed, so the straight line distance to dst bounds the time left, and the nodes and
+    stops that can't improve the best journey found so far are pruned. The walk of the first round isn't limited,
+    so walking all the way is one of the journeys compared, and its time bounds the rounds that take buses."""
+    lon, lat = np.radians(network.graph.coords).T
+    distances = haversine_distances(lon, lat, lon[dst], lat[dst])
+    walking = distances / network.walking_speed if network.walking_speed else np.zeros(len(distances))
+    lower_bound = np.minimum(walking, network.boarding_time + distances / BUS_SPEED).tolist()
+    search = rounds(network, src, dst, lower_bound, max_rounds)
+
+    if search.best_round == -1:
+        return None, search.settled
+
+    # the journey is followed backwards from dst: the walk of each round leads to the stop where the bus of that
+    # round was left, and the bus leads to a stop reached in the previous round
+    offsets, _, _ = network.graph.adjacency
+    edges: list[int] = []
+    node = dst
+    k = search.best_round
+    while True:
+        while node in search.pred_edges[k]:
+            edges.append(search.pred_edges[k][node])
+            node = source_of(edges[-1], offsets)
+        if k == 0:
+            break
+        _, r, board_position, alight_position = search.rides[k][network.stop_of[node]]
+        edges.append(network.alight_edges[r][alight_position])
+        edges.extend(reversed(network.route_edges[r][board_position:alight_position]))
+        edges.append(network.board_edges[r][board_position])
+        node = network.stops[network.route_stops[r][board_position]]
+        k -= 1
+
+    edges.reverse()
+    return edges, search.settled